@@ -0,0 +1,88 @@
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING
+
+from util import Log
+from gentle_client import GentleClient
+from consts import SPEECH_SPEED, GENTLE_URLS
+
+if TYPE_CHECKING:
+  from render_video import RenderJob
+
+# turns a job's speech into a list of (start_time, word) for subtitles
+class Aligner(ABC):
+  # name and version identify the alignment output, bump the version when the timings would change
+  name = "none"
+  version = "0"
+  # whether synthesis has to collect word timings from the TTS model for this aligner
+  needs_tts_timings = False
+
+  # returns None if the speech could not be aligned
+  @abstractmethod
+  def align(self, job: "RenderJob") -> list[tuple[float, str]] | None:
+    ...
+
+# align text using gentle, which runs forced alignment on the sped up speech
+class GentleAligner(Aligner):
+  name = "gentle"
+  version = "1"
+
+  # takes a single url or a shared client for several gentle servers
+  def __init__(self, gentle: str | GentleClient):
+    self.client = gentle if isinstance(gentle, GentleClient) else GentleClient([gentle])
+
+  def align(self, job: "RenderJob") -> list[tuple[float, str]] | None:
+    Log.info(f"Aligning speech text using gentle ({', '.join(self.client.urls)})")
+    aligned_words = self.client.align_files(job.speech_file, job.transcript_file)
+    Log.info("Completed aligning text")
+
+    word_timings = [] # list of tuple (start_time, word)
+    for word in aligned_words:
+      # if failed to align, just skip word
+      if "start" in word and "word" in word:
+        word_timings.append((word["start"], word["word"]))
+    return word_timings or None
+
+# takes word timings from the durations the TTS model predicted while synthesizing (VITS),
+# scaled by whatever speed up was applied after synthesis. no gentle server needed
+class TTSDurationAligner(Aligner):
+  name = "tts"
+  version = "1"
+  needs_tts_timings = True
+
+  def align(self, job: "RenderJob") -> list[tuple[float, str]] | None:
+    if len(job.tts_word_timings) == 0:
+      return None
+    Log.info("Aligning speech text using TTS durations")
+    rate = SPEECH_SPEED / job.speed_applied
+    return [(start / rate, word) for start, word in job.tts_word_timings]
+
+# tries `primary` first, then `fallback` if it fails or returns nothing
+class FallbackAligner(Aligner):
+  def __init__(self, primary: Aligner, fallback: Aligner):
+    self.primary = primary
+    self.fallback = fallback
+    self.name = f"{primary.name}+{fallback.name}"
+    self.version = f"{primary.version}+{fallback.version}"
+    self.needs_tts_timings = primary.needs_tts_timings or fallback.needs_tts_timings
+
+  def align(self, job: "RenderJob") -> list[tuple[float, str]] | None:
+    try:
+      word_timings = self.primary.align(job)
+      if word_timings:
+        return word_timings
+      Log.warn(f"Aligner '{self.primary.name}' could not align speech, falling back to '{self.fallback.name}'")
+    except Exception as ex:
+      Log.warn(f"Aligner '{self.primary.name}' failed, falling back to '{self.fallback.name}'")
+      Log.warn(ex)
+    return self.fallback.align(job)
+
+# create an aligner by name: "gentle" or "tts", optionally falling back to gentle
+# gentle requests go to `gentle_url` and any additional servers in GENTLE_URLS
+def create_aligner(name: str, gentle_url: str, fallback_to_gentle: bool = True) -> Aligner:
+  gentle_urls = [gentle_url] + [url for url in GENTLE_URLS if url != gentle_url]
+  if name == "gentle":
+    return GentleAligner(GentleClient(gentle_urls))
+  if name == "tts":
+    aligner = TTSDurationAligner()
+    return FallbackAligner(aligner, GentleAligner(GentleClient(gentle_urls))) if fallback_to_gentle else aligner
+  raise ValueError(f"Unknown aligner '{name}', expected 'gentle' or 'tts'")
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Any
+
+from util import Log
+from consts import CACHE_DIR, CACHE_MAX_BYTES
+
+# hash of all parts that determine an artifact, used as its cache key
+def cache_key(*parts: Any) -> str:
+  return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# content-addressed on-disk cache for expensive render artifacts (speech, alignments, subtitles).
+# artifacts are files stored under their key, an sqlite index tracks size and last use for LRU eviction
+# and counts hits/misses per artifact name. safe to share between threads and processes
+class ArtifactCache:
+  def __init__(self, root: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+    self.root = root
+    self.max_bytes = max_bytes
+    Path(root).mkdir(parents=True, exist_ok=True)
+    self._lock = Lock()
+    self._db = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=30, check_same_thread=False)
+    with self._db:
+      self._db.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, misses INTEGER NOT NULL DEFAULT 0)")
+
+  def _path(self, key: str, name: str) -> str:
+    return os.path.join(self.root, key[:2], key, name)
+
+  def _count(self, name: str, hit: bool) -> None:
+    column = "hits" if hit else "misses"
+    with self._lock, self._db:
+      self._db.execute("INSERT OR IGNORE INTO counters (name) VALUES (?)", (name,))
+      self._db.execute(f"UPDATE counters SET {column} = {column} + 1 WHERE name = ?", (name,))
+
+  # path of the cached artifact, or None on a miss
+  def get(self, key: str, name: str) -> str | None:
+    path = self._path(key, name)
+    with self._lock, self._db:
+      found = self._db.execute("UPDATE entries SET last_used = ? WHERE path = ?", (time.time(), path)).rowcount > 0
+    found = found and os.path.exists(path)
+    self._count(name, found)
+    return path if found else None
+
+  # copy a cached artifact to `destination`, returns False on a miss
+  def fetch(self, key: str, name: str, destination: str) -> bool:
+    path = self.get(key, name)
+    if path is None:
+      return False
+    shutil.copyfile(path, destination)
+    return True
+
+  # store a copy of `source` as an artifact
+  def put(self, key: str, name: str, source: str) -> None:
+    path = self._path(key, name)
+    Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    # copy next to the final path then rename, so readers never see a half written file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.copyfile(source, temp_path)
+    os.replace(temp_path, path)
+    self._record(path)
+
+  def _record(self, path: str) -> None:
+    with self._lock, self._db:
+      self._db.execute("INSERT OR REPLACE INTO entries (path, size, last_used) VALUES (?, ?, ?)", (path, os.path.getsize(path), time.time()))
+    self.evict()
+
+  def get_json(self, key: str, name: str) -> Any | None:
+    path = self.get(key, name)
+    if path is None:
+      return None
+    with open(path, "r", encoding="utf-8") as f:
+      return json.load(f)
+
+  def put_json(self, key: str, name: str, value: Any) -> None:
+    path = self._path(key, name)
+    Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+      json.dump(value, f)
+    os.replace(temp_path, path)
+    self._record(path)
+
+  # remove least recently used artifacts until the cache fits in max_bytes
+  def evict(self) -> None:
+    with self._lock, self._db:
+      total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+      if total <= self.max_bytes:
+        return
+      for path, size in self._db.execute("SELECT path, size FROM entries ORDER BY last_used ASC").fetchall():
+        if total <= self.max_bytes:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        self._db.execute("DELETE FROM entries WHERE path = ?", (path,))
+        total -= size
+        Log.verbose(f"Evicted {path} from artifact cache")
+
+  # {artifact name: (hits, misses)} counted over all runs
+  def stats(self) -> dict[str, tuple[int, int]]:
+    with self._lock:
+      return {name: (hits, misses) for name, hits, misses in self._db.execute("SELECT name, hits, misses FROM counters ORDER BY name")}
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+# log hits and misses per artifact since `before` (an earlier result of `ArtifactCache.stats`)
+def log_cache_stats(cache: ArtifactCache, before: dict[str, tuple[int, int]]) -> None:
+  for name, (hits, misses) in cache.stats().items():
+    prev_hits, prev_misses = before.get(name, (0, 0))
+    Log.info(f"Artifact cache {name}: {hits - prev_hits} hits, {misses - prev_misses} misses")
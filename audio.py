@@ -0,0 +1,83 @@
+import wave
+import numpy as np
+
+# write a mono float waveform to a 16 bit wav file, peak normalized the same way Coqui TTS saves its output
+def write_wav(filename: str, wav: np.ndarray, sample_rate: int) -> None:
+  wav = np.asarray(wav, dtype=np.float32)
+  peak = max(0.01, float(np.max(np.abs(wav)))) if wav.size > 0 else 1.0
+  samples = (wav * (32767 / peak)).astype(np.int16)
+  with wave.open(filename, "wb") as f:
+    f.setnchannels(1)
+    f.setsampwidth(2)
+    f.setframerate(sample_rate)
+    f.writeframes(samples.tobytes())
+
+# read a 16 bit wav file, returns (mono float waveform in -1..1, sample rate)
+def read_wav(filename: str) -> tuple[np.ndarray, int]:
+  with wave.open(filename, "rb") as f:
+    if f.getsampwidth() != 2:
+      raise ValueError(f"Only 16 bit wav files are supported, '{filename}' has {f.getsampwidth() * 8} bit samples")
+    sample_rate = f.getframerate()
+    channels = f.getnchannels()
+    samples = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+  # mix down to mono
+  if channels > 1:
+    samples = samples.reshape(-1, channels).mean(axis=1)
+  return (samples.astype(np.float32) / 32768, sample_rate)
+
+# join waveforms in order with `silence` seconds of silence between each
+# returns (waveform, list of (start, end) in seconds of each input within the result)
+def concatenate_with_silence(wavs: list[np.ndarray], sample_rate: int, silence: float) -> tuple[np.ndarray, list[tuple[float, float]]]:
+  gap = np.zeros(int(round(silence * sample_rate)), dtype=np.float32)
+  parts: list[np.ndarray] = []
+  bounds: list[tuple[float, float]] = []
+  position = 0
+  for i, wav in enumerate(wavs):
+    if i > 0 and gap.size > 0:
+      parts.append(gap)
+      position += gap.size
+    wav = np.asarray(wav, dtype=np.float32)
+    parts.append(wav)
+    bounds.append((position / sample_rate, (position + wav.size) / sample_rate))
+    position += wav.size
+  if not parts:
+    return (np.zeros(0, dtype=np.float32), bounds)
+  return (np.concatenate(parts), bounds)
+
+# change the speed of speech by `rate` without changing its pitch, using waveform similarity overlap-add (WSOLA):
+# overlapping windowed frames are read every `hop * rate` samples and written every `hop` samples, and each frame
+# is nudged by up to `search_ms` to the position that best continues the previous frame, which avoids phasing
+def time_stretch(wav: np.ndarray, rate: float, sample_rate: int, frame_ms: float = 40, search_ms: float = 10) -> np.ndarray:
+  wav = np.asarray(wav, dtype=np.float32)
+  if rate == 1 or wav.size == 0:
+    return wav
+
+  frame = max(2, int(sample_rate * frame_ms / 1000) // 2 * 2)
+  hop_out = frame // 2
+  hop_in = hop_out * rate
+  tolerance = int(sample_rate * search_ms / 1000)
+  # the similarity search runs on every `step`th sample, plenty for speech and much cheaper
+  step = 4
+  window = np.hanning(frame).astype(np.float32)
+
+  num_frames = max(1, int((wav.size - frame) / hop_in) + 1)
+  padded = np.concatenate([np.zeros(tolerance, dtype=np.float32), wav, np.zeros(frame + 2 * tolerance + hop_out, dtype=np.float32)])
+  out = np.zeros((num_frames - 1) * hop_out + frame, dtype=np.float32)
+  norm = np.zeros_like(out)
+
+  previous = tolerance
+  for k in range(num_frames):
+    nominal = tolerance + int(round(k * hop_in))
+    position = nominal
+    if k > 0:
+      # the natural continuation of the previous frame is what should overlap with this one
+      target = padded[previous + hop_out:previous + hop_out + frame:step]
+      region = padded[nominal - tolerance:nominal + tolerance + frame:step]
+      similarity = np.correlate(region, target, mode="valid")
+      position = nominal - tolerance + int(np.argmax(similarity)) * step
+    out[k * hop_out:k * hop_out + frame] += padded[position:position + frame] * window
+    norm[k * hop_out:k * hop_out + frame] += window
+    previous = position
+
+  out /= np.where(norm > 1e-3, norm, 1)
+  return out[:int(round(wav.size / rate))]
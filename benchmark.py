@@ -0,0 +1,333 @@
+import argparse
+import email.parser
+import email.policy
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import wave
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import ceil
+from pathlib import Path
+from threading import Thread
+from typing import Callable
+
+import numpy as np
+
+from util import Log, validate_file_extension
+from audio import write_wav
+from chunked_tts import transcript_words
+from ffmpeg_runner import run_ffmpeg
+from consts import BENCH_DIR, BENCH_BASELINE_PATH, BENCH_REPEATS, BENCH_REGRESSION_THRESHOLD, BENCH_COMMENTS, CLIP_LENGTH, XFADE_LENGTH, SPEECH_SPEED, ENCODE_PROFILE
+
+# stub TTS: every word is a tone of this many seconds followed by a short pause, so speech length only depends on the word count
+STUB_WORD_SECONDS = 0.25
+STUB_PAUSE_SECONDS = 0.05
+STUB_SAMPLE_RATE = 22050
+
+# background videos made with lavfi: (name, width, height, fps, seconds). the portrait source is narrower than 9:16 and
+# takes the scale path of normalization, the horizontal and the 60 fps square source take the crop path
+FIXTURE_VIDEOS = [("bench-portrait", 600, 1280, 30, 30), ("bench-horizontal", 1280, 720, 30, 30), ("bench-square", 960, 960, 60, 20)]
+
+# words the canned comments are made of, seeded so every run renders the same text
+_FIXTURE_WORDS = ["the", "my", "friend", "said", "that", "we", "should", "never", "go", "back", "to", "school", "after", "dark",
+                  "because", "something", "weird", "happened", "last", "time", "and", "honestly", "I", "still", "think", "about", "it"]
+
+# stands in for Coqui's `TTS` object in benchmarks: no model to load and a fixed speaking rate, so
+# renders are fast and their length is predictable. implements what the render stages use
+class StubTTS:
+  class _Synthesizer:
+    output_sample_rate = STUB_SAMPLE_RATE
+    # no length_scale, so the speed up is applied after synthesis like with models without rate control
+    tts_model = object()
+
+  def __init__(self):
+    self.synthesizer = StubTTS._Synthesizer()
+
+  def to(self, device: str) -> "StubTTS":
+    return self
+
+  def tts(self, text: str, **kwargs) -> list[float]:
+    t = np.arange(int(STUB_WORD_SECONDS * STUB_SAMPLE_RATE)) / STUB_SAMPLE_RATE
+    word = (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    pause = np.zeros(int(STUB_PAUSE_SECONDS * STUB_SAMPLE_RATE), dtype=np.float32)
+    num_words = max(1, len(transcript_words(text)))
+    return np.tile(np.concatenate([word, pause]), num_words).tolist()
+
+  def tts_to_file(self, text: str, file_path: str, **kwargs) -> None:
+    write_wav(file_path, np.asarray(self.tts(text), dtype=np.float32), STUB_SAMPLE_RATE)
+
+# answers gentle's /transcriptions endpoint on localhost, with the transcript's words spread evenly over the audio
+class FakeGentle:
+  def __init__(self):
+    class Handler(BaseHTTPRequestHandler):
+      def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        parts = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True) for part in message.iter_parts()}
+        words = transcript_words(parts["transcript"].decode("utf-8"))
+        with wave.open(io.BytesIO(parts["audio"]), "rb") as audio:
+          step = audio.getnframes() / audio.getframerate() / max(1, len(words))
+        response = json.dumps({"words": [{"word": word, "start": i * step, "end": (i + 1) * step, "case": "success"} for i, word in enumerate(words)]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+    self._thread = Thread(target=self._server.serve_forever, name="fake-gentle", daemon=True)
+
+  def __enter__(self) -> "FakeGentle":
+    self._thread.start()
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self._server.shutdown()
+    self._server.server_close()
+
+# canned comments, long enough to pass MIN_VIDEO_LENGTH with the stub TTS and a few too short to render
+def fixture_comments(num_comments: int = BENCH_COMMENTS, seed: int = 0) -> list[dict[str, str]]:
+  rng = random.Random(seed)
+  seconds_per_word = (STUB_WORD_SECONDS + STUB_PAUSE_SECONDS) / SPEECH_SPEED
+  comments = []
+  for i in range(num_comments):
+    num_words = rng.randint(5, 15) if i % 5 == 4 else rng.randint(int(25 / seconds_per_word), int(45 / seconds_per_word))
+    text = " ".join(rng.choice(_FIXTURE_WORDS) for _ in range(num_words))
+    comments.append({"title": f"Benchmark thread {i // 3}", "comment_text": text[0].upper() + text[1:] + "."})
+  return comments
+
+# background videos, background music and a comments file in `root`, made once and reused by later runs
+def make_fixtures(root: str = BENCH_DIR) -> None:
+  Path(os.path.join(root, "video")).mkdir(parents=True, exist_ok=True)
+  Path(os.path.join(root, "audio")).mkdir(parents=True, exist_ok=True)
+  Path(os.path.join(root, "content")).mkdir(parents=True, exist_ok=True)
+
+  # videos of older fixture sets would be normalized and rendered too
+  fixture_files = {f"{name}.mp4" for name, *_ in FIXTURE_VIDEOS}
+  for filename in os.listdir(os.path.join(root, "video")):
+    if validate_file_extension(filename) and filename not in fixture_files:
+      Log.info(f"Removing old fixture video {filename}")
+      os.remove(os.path.join(root, "video", filename))
+
+  for name, width, height, fps, seconds in FIXTURE_VIDEOS:
+    path = os.path.join(root, "video", f"{name}.mp4")
+    if not os.path.exists(path):
+      Log.info(f"Generating fixture video {path}")
+      run_ffmpeg(["ffmpeg", "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={seconds}",
+                  "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-y", path], f"fixture {name}", path, seconds)
+
+  music = os.path.join(root, "audio", "bench-music.m4a")
+  if not os.path.exists(music):
+    Log.info(f"Generating fixture audio {music}")
+    run_ffmpeg(["ffmpeg", "-f", "lavfi", "-i", "sine=frequency=330:duration=240", "-c:a", "aac", "-y", music], "fixture music", music, 240)
+
+  with open(os.path.join(root, "content", "comments-bench.json"), "w", encoding="utf-8") as f:
+    json.dump(fixture_comments(), f, indent=2)
+
+# time `run` `repeats` times, calling `setup` untimed before each run
+def measure(run: Callable[[], None], repeats: int, setup: Callable[[], None] | None = None) -> dict[str, float | list[float]]:
+  times = []
+  for _ in range(repeats):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    run()
+    times.append(time.perf_counter() - start)
+  return {"median": statistics.median(times), "min": min(times), "runs": times}
+
+def _remove(*paths: str) -> None:
+  for path in paths:
+    if os.path.isdir(path):
+      shutil.rmtree(path)
+    elif os.path.exists(path):
+      os.remove(path)
+
+def bench_normalize_all(repeats: int) -> dict:
+  from normalize_videos import normalize_all
+  return measure(normalize_all, repeats, lambda: _remove("video/splits", "video/manifest.sqlite"))
+
+def bench_clean_text(repeats: int) -> dict:
+  from content_filter import clean_text
+  texts = [comment["comment_text"] for comment in fixture_comments()]
+  return measure(lambda: [clean_text(text) for text in texts], repeats)
+
+# the substitution rules alone, without the better_profanity pass that dominates clean_text. every run gets a
+# fresh engine so its per word cache starts empty
+def bench_substitute(repeats: int) -> dict:
+  from content_filter import SubstitutionEngine, substitutions
+  rng = random.Random(2)
+  vocabulary = _FIXTURE_WORDS + [pattern.upper() for pattern, _ in substitutions] + [pattern + "!" for pattern, _ in substitutions]
+  texts = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(1, 60))) for _ in range(5000)]
+  engine = SubstitutionEngine(substitutions)
+
+  def setup() -> None:
+    nonlocal engine
+    engine = SubstitutionEngine(substitutions)
+  return measure(lambda: [engine.substitute(text) for text in texts], repeats, setup)
+
+# the clip selection for every video of a large batch, what `select_videos` used to do
+def bench_select_clips(repeats: int) -> dict:
+  from clip_scheduler import ClipScheduler
+  pool = [f"./video/splits/source{i % 40}_{i}.mp4" for i in range(2000)]
+  clips_per_video = ceil(60 / (CLIP_LENGTH - XFADE_LENGTH))
+
+  def run() -> None:
+    scheduler = ClipScheduler(pool, state_path="")
+    for _ in range(1000):
+      scheduler.draw(clips_per_video)
+  return measure(run, repeats)
+
+def bench_create_srt(repeats: int) -> dict:
+  from render_video import create_srt
+  word_timings = [(i * 0.2, word) for i, word in enumerate(transcript_words(" ".join(comment["comment_text"] for comment in fixture_comments())))]
+  return measure(lambda: [create_srt(word_timings) for _ in range(20)], repeats)
+
+# one encode of a 30 second video from normalized clips, the way compose_video calls ffmpeg
+def bench_encode(repeats: int) -> dict:
+  from clip_manifest import load_clip_pool
+  from normalize_videos import normalize_all
+  from render_video import build_ffmpeg_command, create_srt
+  from util import add_hwaccel_to_ffmpeg_command
+  from consts import FFMPEG_ACCELERATION
+
+  # splits are only made for sources that do not have them yet
+  normalize_all()
+  pool = load_clip_pool()
+  length = 30
+  Path("work").mkdir(parents=True, exist_ok=True)
+  text = " ".join(_FIXTURE_WORDS * 4)
+  StubTTS().tts_to_file(text, "work/bench-speech.wav")
+  srt, _ = create_srt([(i * length / len(text.split()), word) for i, word in enumerate(text.split())])
+  with open("work/bench-sub.srt", "w", encoding="utf-8") as f:
+    f.write(srt)
+  clips = [pool[i % len(pool)] for i in range(ceil(length / (CLIP_LENGTH - XFADE_LENGTH)))]
+  cmd = add_hwaccel_to_ffmpeg_command(build_ffmpeg_command(clips, "work/bench-speech.wav", "work/bench-sub.srt", length, "work/bench-out.mp4", "audio/bench-music.m4a"), FFMPEG_ACCELERATION)
+  return measure(lambda: run_ffmpeg(cmd, "bench encode", "work/bench-out.mp4", length), repeats)
+
+# a whole render_all_videos batch of the canned comments with the stub TTS and fake gentle, from empty state
+# every time. parallel mode can not use the stub since its workers load their own TTS, serial mode is used instead
+def bench_render_all(repeats: int) -> dict:
+  import render_all_video
+  from normalize_videos import normalize_all
+
+  # splits are only made for sources that do not have them yet
+  normalize_all()
+  render_all_video.load_tts = lambda *args, **kwargs: StubTTS()
+  render_all_video.ALIGNER = "gentle"
+  render_all_video.TTS_CHUNKED = False
+  if render_all_video.RENDER_MODE == "parallel":
+    Log.warn("Benchmarking render_all_videos in serial mode, parallel workers can not use the stub TTS")
+    render_all_video.RENDER_MODE = "serial"
+
+  def setup() -> None:
+    from consts import JOB_STORE_PATH, JOB_CHECKPOINT_DIR, DEDUP_INDEX_PATH, CACHE_DIR, LENGTH_MODEL_PATH, CLIP_SCHEDULER_STATE
+    _remove("out", "work", "content/comments-bench.json.progress", JOB_STORE_PATH, JOB_CHECKPOINT_DIR, DEDUP_INDEX_PATH, CACHE_DIR, LENGTH_MODEL_PATH, CLIP_SCHEDULER_STATE)
+
+  with FakeGentle() as gentle:
+    return measure(lambda: render_all_video.render_all_videos("content/comments-bench.json", gentle.url), repeats, setup)
+
+# name -> benchmark, in the order they run. every benchmark sets up what it needs, so any of them can run alone
+BENCHMARKS: dict[str, Callable[[int], dict]] = {
+  "normalize_all": bench_normalize_all,
+  "clean_text": bench_clean_text,
+  "substitute": bench_substitute,
+  "select_clips": bench_select_clips,
+  "create_srt": bench_create_srt,
+  "encode": bench_encode,
+  "render_all_videos": bench_render_all,
+}
+
+def _ffmpeg_version() -> str:
+  try:
+    return subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.split("\n")[0]
+  except OSError:
+    return "unknown"
+
+# benchmarks whose median got slower than the baseline's by more than `threshold`, as (name, baseline, now)
+def find_regressions(results: dict, baseline: dict, threshold: float = BENCH_REGRESSION_THRESHOLD) -> list[tuple[str, float, float]]:
+  regressions = []
+  for name, result in results["benchmarks"].items():
+    if name in baseline.get("benchmarks", {}):
+      before = baseline["benchmarks"][name]["median"]
+      if result["median"] > before * (1 + threshold):
+        regressions.append((name, before, result["median"]))
+  return regressions
+
+def log_comparison(results: dict, baseline: dict | None) -> None:
+  for name, result in results["benchmarks"].items():
+    before = baseline.get("benchmarks", {}).get(name) if baseline is not None else None
+    if before is None:
+      Log.info(f"  {name}: {result['median']:.3f}s (min {result['min']:.3f}s)", show_timestamp=False)
+    else:
+      change = result["median"] / before["median"] - 1 if before["median"] > 0 else 0
+      Log.info(f"  {name}: {result['median']:.3f}s (min {result['min']:.3f}s), baseline {before['median']:.3f}s ({change:+.0%})", show_timestamp=False)
+
+# generate fixtures, run the benchmarks in BENCH_DIR and compare them to the baseline. returns 1 if any regressed
+def run_benchmarks(names: list[str], repeats: int = BENCH_REPEATS, save_baseline: bool = False) -> int:
+  baseline_path = os.path.abspath(BENCH_BASELINE_PATH)
+  bench_dir = os.path.abspath(BENCH_DIR)
+  make_fixtures(bench_dir)
+
+  results = {"time": datetime.now().isoformat(timespec="seconds"), "machine": platform.node(), "cpus": os.cpu_count(),
+             "python": platform.python_version(), "ffmpeg": _ffmpeg_version(), "encode_profile": ENCODE_PROFILE, "repeats": repeats, "benchmarks": {}}
+  # every path the renderer uses is relative, so the fixtures stand in for video/, audio/, content/ and state/
+  cwd = os.getcwd()
+  os.chdir(bench_dir)
+  try:
+    for name in names:
+      Log.info(f"Running benchmark '{name}' {repeats} times")
+      results["benchmarks"][name] = BENCHMARKS[name](repeats)
+  finally:
+    os.chdir(cwd)
+
+  with open(os.path.join(bench_dir, f"results-{datetime.now().strftime('%m-%d-%y-%H-%M-%S')}.json"), "w") as f:
+    json.dump(results, f, indent=2)
+
+  baseline = None
+  if os.path.exists(baseline_path):
+    with open(baseline_path, "r") as f:
+      baseline = json.load(f)
+    if baseline.get("machine") != results["machine"] or baseline.get("ffmpeg") != results["ffmpeg"]:
+      Log.warn(f"Baseline was measured on {baseline.get('machine')} with {baseline.get('ffmpeg')}, comparisons may not mean much")
+    if baseline.get("encode_profile", ENCODE_PROFILE) != ENCODE_PROFILE:
+      Log.warn(f"Baseline was measured with the '{baseline['encode_profile']}' encode profile, this run uses '{ENCODE_PROFILE}'")
+  Log.info("Benchmark results (median of each run):")
+  log_comparison(results, baseline)
+
+  if save_baseline:
+    # benchmarks that did not run this time keep their old baseline
+    if baseline is not None:
+      results["benchmarks"] = {**baseline.get("benchmarks", {}), **results["benchmarks"]}
+    Path(os.path.dirname(baseline_path)).mkdir(parents=True, exist_ok=True)
+    with open(baseline_path, "w") as f:
+      json.dump(results, f, indent=2)
+    Log.info(f"Saved results as the baseline in {baseline_path}")
+    return 0
+
+  regressions = find_regressions(results, baseline) if baseline is not None else []
+  for name, before, now in regressions:
+    Log.error(f"Regression: '{name}' took {now:.3f}s, {now / before - 1:.0%} slower than the baseline of {before:.3f}s")
+  return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark the render pipeline on synthetic fixtures and compare against a baseline")
+  parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+  parser.add_argument("--repeats", type=int, default=BENCH_REPEATS, help="runs per benchmark, the median is compared")
+  parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+  args = parser.parse_args()
+  unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+  if len(unknown) > 0:
+    parser.error(f"unknown benchmarks: {', '.join(unknown)} (choose from {', '.join(BENCHMARKS)})")
+  sys.exit(run_benchmarks(args.benchmarks or list(BENCHMARKS), args.repeats, args.save_baseline))
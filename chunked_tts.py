@@ -0,0 +1,179 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import multiprocessing
+import os
+import re
+import numpy as np
+from TTS.api import TTS
+
+from util import Log
+from audio import concatenate_with_silence
+from consts import TTS_MODEL, TTS_CHUNK_MAX_CHARS, TTS_SENTENCE_SILENCE
+
+# one synthesized piece of the transcript and where it sits in the final speech, in seconds (before speed up)
+class SpeechChunk(NamedTuple):
+  text: str
+  start: float
+  end: float
+
+# split text on sentence endings, then split sentences longer than `max_chars` on clause punctuation
+def split_sentences(text: str, max_chars: int = TTS_CHUNK_MAX_CHARS) -> list[str]:
+  sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence.strip()]
+
+  chunks: list[str] = []
+  for sentence in sentences:
+    if len(sentence) <= max_chars:
+      chunks.append(sentence)
+      continue
+    # greedily pack clauses up to max_chars, a single clause longer than that is kept whole
+    current = ""
+    for clause in re.split(r"(?<=[,;:])\s+", sentence):
+      if current and len(current) + 1 + len(clause) > max_chars:
+        chunks.append(current)
+        current = clause
+      else:
+        current = f"{current} {clause}" if current else clause
+    if current:
+      chunks.append(current)
+  return chunks
+
+# make the model itself speak `rate` times faster, e.g. through the duration predictor scale of VITS
+# returns False if the loaded model has no speaking rate control
+def set_speaking_rate(tts: TTS, rate: float) -> bool:
+  model = tts.synthesizer.tts_model
+  if not hasattr(model, "length_scale"):
+    return False
+  base_scale = getattr(getattr(model, "args", None), "length_scale", 1.0)
+  model.length_scale = base_scale / rate
+  return True
+
+# how many times faster than normal the model currently speaks
+def get_speaking_rate(tts: TTS) -> float:
+  model = tts.synthesizer.tts_model
+  if not getattr(model, "length_scale", None):
+    return 1.0
+  base_scale = getattr(getattr(model, "args", None), "length_scale", 1.0)
+  return base_scale / model.length_scale
+
+# per worker process model, set up once by `_init_worker`
+_worker_tts: TTS | None = None
+
+def _init_worker(model: str, num_workers: int, speaking_rate: float) -> None:
+  global _worker_tts
+  import torch
+  torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+  _worker_tts = TTS(model).to("cpu")
+  if speaking_rate != 1:
+    set_speaking_rate(_worker_tts, speaking_rate)
+
+# characters stripped from words so they match what the transcript aligners report
+WORD_PUNCTUATION = ".,!?;:\"'()[]{}-*_~`"
+
+# words of text as they appear in subtitles, without surrounding punctuation
+def transcript_words(text: str) -> list[str]:
+  return [word for word in (raw.strip(WORD_PUNCTUATION) for raw in text.split()) if word]
+
+# synthesize one sentence and take word start times (seconds) from the durations the model predicted for
+# each input token (VITS). tokens are grouped into words on spaces, if the phonemized words do not line up
+# with the transcript (e.g. numbers read out as several words) time is shared out by word length instead
+def synthesize_with_timings(tts: TTS, text: str) -> tuple[np.ndarray, list[tuple[float, str]]]:
+  from TTS.tts.utils.synthesis import synthesis
+
+  model = tts.synthesizer.tts_model
+  sample_rate = tts.synthesizer.output_sample_rate
+  outputs = synthesis(model=model, text=text, CONFIG=tts.synthesizer.tts_config, use_cuda=next(model.parameters()).is_cuda)
+  wav = np.asarray(outputs["wav"], dtype=np.float32).squeeze()
+  words = transcript_words(text)
+
+  durations = outputs["outputs"].get("durations") if isinstance(outputs.get("outputs"), dict) else None
+  if durations is None or len(words) == 0:
+    raise ValueError(f"TTS model {type(model).__name__} does not predict token durations")
+
+  # frames per token -> seconds per token
+  seconds_per_frame = model.config.audio.hop_length / sample_rate
+  token_ids = np.asarray(outputs["text_inputs"].cpu() if hasattr(outputs["text_inputs"], "cpu") else outputs["text_inputs"]).reshape(-1)
+  token_seconds = np.asarray(durations.cpu() if hasattr(durations, "cpu") else durations, dtype=np.float32).reshape(-1) * seconds_per_frame
+
+  # start time of every group of spoken tokens between spaces
+  characters = model.tokenizer.characters
+  group_starts: list[float] = []
+  elapsed = 0.0
+  in_word = False
+  for token_id, seconds in zip(token_ids, token_seconds):
+    char = characters.id_to_char(int(token_id))
+    if char == " ":
+      in_word = False
+    elif char != characters.blank and char not in WORD_PUNCTUATION and not in_word:
+      group_starts.append(elapsed)
+      in_word = True
+    elapsed += float(seconds)
+
+  if len(group_starts) == len(words):
+    return (wav, list(zip(group_starts, words)))
+
+  Log.verbose(f"Phonemized {len(group_starts)} words for {len(words)} transcript words, spreading timings by length")
+  total = wav.size / sample_rate
+  start = group_starts[0] if group_starts else 0.0
+  end = elapsed if elapsed > start else total
+  num_chars = sum(len(word) + 1 for word in words)
+  timings: list[tuple[float, str]] = []
+  position = start
+  for word in words:
+    timings.append((position, word))
+    position += (end - start) * (len(word) + 1) / num_chars
+  return (wav, timings)
+
+# returns (waveform, sample rate, word timings or None if not requested)
+def _synthesize_sentence(tts: TTS, text: str, with_timings: bool) -> tuple[np.ndarray, int, list[tuple[float, str]] | None]:
+  sample_rate = tts.synthesizer.output_sample_rate
+  if with_timings:
+    wav, timings = synthesize_with_timings(tts, text)
+    return (wav, sample_rate, timings)
+  return (np.asarray(tts.tts(text=text, split_sentences=False), dtype=np.float32), sample_rate, None)
+
+def _synthesize_chunk(text: str, with_timings: bool) -> tuple[np.ndarray, int, list[tuple[float, str]] | None]:
+  assert _worker_tts is not None
+  return _synthesize_sentence(_worker_tts, text, with_timings)
+
+# synthesizes text sentence by sentence on a pool of worker processes that each hold their own model,
+# then joins the pieces back together in order. keep one instance for the whole batch so models load once
+class ChunkedSynthesizer:
+  # `speaking_rate` is applied to the worker models, match whatever was set on `tts` with `set_speaking_rate`
+  def __init__(self, tts: TTS, num_workers: int, model: str = TTS_MODEL, silence: float = TTS_SENTENCE_SILENCE, speaking_rate: float = 1):
+    self.tts = tts
+    self.silence = silence
+    self.pool: ProcessPoolExecutor | None = None
+
+    # worker processes (e.g. parallel render mode) can not start their own pool, synthesize chunks in order instead
+    if num_workers > 1 and not multiprocessing.current_process().daemon:
+      Log.info(f"Starting {num_workers} TTS workers")
+      self.pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(model, num_workers, speaking_rate))
+
+  # returns (waveform, sample rate, chunks, word timings in seconds of the waveform)
+  # word timings are only collected if `with_timings` is set, otherwise the list is empty
+  def synthesize(self, text: str, with_timings: bool = False) -> tuple[np.ndarray, int, list[SpeechChunk], list[tuple[float, str]]]:
+    sentences = split_sentences(text)
+    if len(sentences) == 0:
+      raise ValueError("No text to synthesize")
+
+    Log.verbose(f"Synthesizing {len(sentences)} chunks")
+    if self.pool is not None:
+      # map keeps results in submission order
+      results = list(self.pool.map(_synthesize_chunk, sentences, [with_timings] * len(sentences)))
+    else:
+      results = [_synthesize_sentence(self.tts, sentence, with_timings) for sentence in sentences]
+
+    sample_rate = results[0][1]
+    wav, bounds = concatenate_with_silence([result[0] for result in results], sample_rate, self.silence)
+    chunks = [SpeechChunk(sentence, start, end) for sentence, (start, end) in zip(sentences, bounds)]
+
+    # shift each sentence's word timings to where the sentence starts
+    word_timings: list[tuple[float, str]] = []
+    for (start, _), result in zip(bounds, results):
+      word_timings.extend((start + offset, word) for offset, word in result[2] or [])
+    return (wav, sample_rate, chunks, word_timings)
+
+  def close(self) -> None:
+    if self.pool is not None:
+      self.pool.shutdown()
+      self.pool = None
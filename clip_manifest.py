@@ -0,0 +1,133 @@
+import hashlib
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, NamedTuple
+
+from util import Log, validate_file_extension
+from consts import CLIP_MANIFEST_PATH
+
+# a source video in video/ and what it looked like when it was split
+class SourceVideo(NamedTuple):
+  path: str
+  mtime: float
+  size: int
+  hash: str
+  width: int
+  height: int
+  duration: float
+  fps: float
+
+# one clip of a source video, `offset` is where it starts in the source in seconds
+# split clips have their own file in `path`, virtual clips point `path` at the source and are cut while rendering
+class Clip(NamedTuple):
+  path: str
+  source: str
+  offset: float
+  duration: float
+  width: int
+  height: int
+  fps: float
+  size: int
+
+# identifies a pool entry across runs, virtual clips share their source file so include the offset
+def clip_id(clip: str | Clip) -> str:
+  return f"{clip.path}#{clip.offset}" if isinstance(clip, Clip) else clip
+
+# hash of the size and the first and last MiB of a file. cheap even for huge recordings and
+# enough to tell a changed source from a renamed or touched one
+def quick_file_hash(filename: str, block_size: int = 1024 * 1024) -> str:
+  size = os.path.getsize(filename)
+  digest = hashlib.sha256(str(size).encode("utf-8"))
+  with open(filename, "rb") as f:
+    digest.update(f.read(block_size))
+    if size > block_size:
+      f.seek(max(block_size, size - block_size))
+      digest.update(f.read(block_size))
+  return digest.hexdigest()
+
+# persistent index of source videos and their split clips, written by normalize_videos.py and read by the
+# renderer, so neither has to list video/splits or run ffprobe at startup
+class ClipManifest:
+  def __init__(self, path: str = CLIP_MANIFEST_PATH):
+    self.path = path
+    Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+    self._lock = Lock()
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self._db:
+      self._db.execute("CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL, duration REAL NOT NULL, fps REAL NOT NULL)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS clips (path TEXT PRIMARY KEY, source TEXT NOT NULL, offset REAL NOT NULL, duration REAL NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL, fps REAL NOT NULL, size INTEGER NOT NULL)")
+      self._db.execute("CREATE INDEX IF NOT EXISTS clips_source ON clips (source)")
+
+  def get_source(self, path: str) -> SourceVideo | None:
+    with self._lock:
+      row = self._db.execute("SELECT * FROM sources WHERE path = ?", (path,)).fetchone()
+    return SourceVideo(*row) if row is not None else None
+
+  # whether `path` is known and has not changed since. a matching size and mtime is trusted,
+  # otherwise the file is hashed so touched or copied sources are not split or probed again
+  def is_unchanged(self, path: str) -> bool:
+    source = self.get_source(path)
+    stat = os.stat(path)
+    if source is not None and source.size == stat.st_size and source.mtime == stat.st_mtime:
+      return True
+    if source is None:
+      return False
+    if source.size == stat.st_size and source.hash == quick_file_hash(path):
+      # same content, remember the new mtime so the next check is cheap again
+      with self._lock, self._db:
+        self._db.execute("UPDATE sources SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+      return True
+    return False
+
+  # replace everything known about a source and its clips
+  def add_source(self, source: SourceVideo, clips: Iterable[Clip]) -> None:
+    with self._lock, self._db:
+      self._db.execute("DELETE FROM clips WHERE source = ?", (source.path,))
+      self._db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?, ?)", source)
+      self._db.executemany("INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?, ?)", clips)
+
+  def has_clips(self, source: str) -> bool:
+    with self._lock:
+      return self._db.execute("SELECT 1 FROM clips WHERE source = ? LIMIT 1", (source,)).fetchone() is not None
+
+  # forget clips whose files were deleted, returns how many were removed
+  def prune_missing(self) -> int:
+    with self._lock:
+      paths = [path for (path,) in self._db.execute("SELECT path FROM clips")]
+    missing = [(path,) for path in paths if not os.path.exists(path)]
+    with self._lock, self._db:
+      self._db.executemany("DELETE FROM clips WHERE path = ?", missing)
+    return len(missing)
+
+  def clips(self) -> list[Clip]:
+    with self._lock:
+      return [Clip(*row) for row in self._db.execute("SELECT * FROM clips ORDER BY path")]
+
+  # paths of all clips, one query no matter how many splits there are
+  def clip_paths(self) -> list[str]:
+    with self._lock:
+      return [path for (path,) in self._db.execute("SELECT path FROM clips ORDER BY path")]
+
+  def num_clips(self) -> int:
+    with self._lock:
+      return self._db.execute("SELECT COUNT(*) FROM clips").fetchone()[0]
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+# background clip pool for rendering, from the manifest if there is one, otherwise by listing `splits_dir`
+def load_clip_pool(splits_dir: str = "./video/splits", manifest_path: str = CLIP_MANIFEST_PATH) -> list[str]:
+  if os.path.exists(manifest_path):
+    manifest = ClipManifest(manifest_path)
+    try:
+      clip_paths = manifest.clip_paths()
+    finally:
+      manifest.close()
+    if len(clip_paths) > 0:
+      return clip_paths
+
+  Log.warn(f"No clip manifest at {manifest_path}, listing {splits_dir} instead. Run normalize_videos.py to create it")
+  return [os.path.join(splits_dir, video) for video in os.listdir(splits_dir) if validate_file_extension(video)]
@@ -0,0 +1,116 @@
+import json
+import os
+import random
+from multiprocessing.managers import BaseManager
+from pathlib import Path
+from threading import Lock
+
+from util import Log
+from clip_manifest import Clip, clip_id
+from consts import CLIP_SCHEDULER_STATE
+
+# how many later bag positions to try when the next clip comes from the same source as the previous one
+MAX_SOURCE_SWAPS = 8
+
+# save the state every this many draws, a crash only loses that much of the rotation
+SAVE_EVERY = 20
+
+# source video a clip was cut from, split files are named `<source>_<offset>.mp4`
+def clip_source(clip: str | Clip) -> str:
+  if isinstance(clip, Clip):
+    return clip.source
+  name = os.path.basename(clip)
+  return name[:name.rfind("_")] if name.rfind("_") != -1 else name
+
+# hands out background clips from a shuffle bag: every clip is used once before any clip is used again,
+# then the bag is reshuffled. drawing k clips costs O(k), and consecutive clips from the same source are
+# avoided where the pool allows it. share one instance across a batch (through `SchedulerManager` for
+# worker processes) so usage is spread over all videos, the rotation optionally survives between runs
+class ClipScheduler:
+  def __init__(self, pool: list[str] | list[Clip], state_path: str = CLIP_SCHEDULER_STATE):
+    if len(pool) == 0:
+      raise ValueError("No videos were provided in the clip pool, please place videos in video/ folder and run the video normalizer")
+    self.pool = list(pool)
+    self.state_path = state_path
+    self.bag: list[int] = [] # indices into pool, drawn from the front
+    self.position = 0
+    self.last_source: str | None = None
+    self._unsaved = 0
+    self._lock = Lock()
+
+    if state_path and os.path.exists(state_path):
+      try:
+        self._load()
+      except (OSError, ValueError, KeyError) as ex:
+        Log.warn(f"Could not load clip scheduler state from '{state_path}', starting a new rotation")
+        Log.warn(ex)
+    if self.position >= len(self.bag):
+      self._refill()
+
+  # continue the saved rotation with the clips that are still in the pool, new clips join the rest of it
+  def _load(self) -> None:
+    with open(self.state_path, "r") as f:
+      state = json.load(f)
+    index_of = {clip_id(clip): i for i, clip in enumerate(self.pool)}
+    used = [index_of[id] for id in state["bag"][:state["position"]] if id in index_of]
+    remaining = [index_of[id] for id in state["bag"][state["position"]:] if id in index_of]
+    seen = set(state["bag"])
+    new = [i for id, i in index_of.items() if id not in seen]
+    # keep the clips used this rotation in front so they are not drawn again before the rest
+    upcoming = remaining + new
+    random.shuffle(upcoming)
+    self.bag = used + upcoming
+    self.position = len(used)
+    self.last_source = state.get("last_source")
+    Log.verbose(f"Continuing clip rotation, {len(remaining)} clips left and {len(new)} new")
+
+  def _refill(self) -> None:
+    self.bag = list(range(len(self.pool)))
+    random.shuffle(self.bag)
+    self.position = 0
+
+  # take the next clip, swapping in a later one from a different source if it would repeat the last source
+  def _next(self) -> str | Clip:
+    if self.position >= len(self.bag):
+      self._refill()
+    if self.last_source is not None and clip_source(self.pool[self.bag[self.position]]) == self.last_source:
+      remaining = len(self.bag) - self.position - 1
+      for _ in range(min(MAX_SOURCE_SWAPS, remaining)):
+        swap = self.position + random.randint(1, remaining)
+        if clip_source(self.pool[self.bag[swap]]) != self.last_source:
+          self.bag[self.position], self.bag[swap] = self.bag[swap], self.bag[self.position]
+          break
+    clip = self.pool[self.bag[self.position]]
+    self.position += 1
+    self.last_source = clip_source(clip)
+    return clip
+
+  # background clips for one video
+  def draw(self, num_clips: int) -> list[str] | list[Clip]:
+    with self._lock:
+      clips = [self._next() for _ in range(num_clips)]
+      self._unsaved += 1
+      if self.state_path and self._unsaved >= SAVE_EVERY:
+        self._save()
+    return clips
+
+  def _save(self) -> None:
+    Path(os.path.dirname(self.state_path) or ".").mkdir(parents=True, exist_ok=True)
+    state = {"bag": [clip_id(self.pool[i]) for i in self.bag], "position": self.position, "last_source": self.last_source}
+    temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+      json.dump(state, f)
+    os.replace(temp_path, self.state_path)
+    self._unsaved = 0
+
+  def save(self) -> None:
+    if not self.state_path:
+      return
+    with self._lock:
+      self._save()
+
+# serves one ClipScheduler to worker processes, which draw from it through a proxy
+class SchedulerManager(BaseManager):
+  pass
+
+SchedulerManager.register("ClipScheduler", ClipScheduler, exposed=["draw", "save"])
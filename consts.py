@@ -1,4 +1,23 @@
-from util import GpuDevice
+from util import GpuDevice, EncodeProfile
+
+# ---
+# general constants
+# ---
+
+# minimum log level to print and save: "verbose", "info", "warn", "error", "fatal"
+LOG_VERBOSITY = "verbose"
+
+# where per job metrics (seconds per stage, counters) are written as json lines, with a summary per run and a
+# prometheus text file (calersvm.prom) that is kept up to date while rendering or uploading. "" to turn off
+METRICS_DIR = "metrics"
+
+# stages to run under a profiler, results are saved per job to METRICS_DIR/profiles/. example: ["tts", "encode"]
+# render stages: "filter", "tts", "speed", "align", "srt", "encode", and "upload" in upload-yt.py
+PROFILE_STAGES: list[str] = []
+
+# "cprofile": where the cpu time goes (.prof files, open with pstats or snakeviz)
+# "tracemalloc": peak memory and the lines that allocated the most (.txt files), render serially for clean results
+PROFILE_MODE = "cprofile"
 
 # ---
 # scrape / playwright related constants
@@ -17,6 +36,35 @@ SCRAPE_ONLY_POST = False
 # skip not safe for work posts (highly recommended)
 SKIP_NSFW = True
 
+# how to scrape
+# "playwright": one browser page loading every thread in turn (original behaviour)
+# "async": a pool of SCRAPE_CONCURRENCY browser pages loading threads at once, with images, media, fonts,
+#          stylesheets and third-party scripts blocked
+# "http": no browser, read reddit's .json endpoints over plain http with SCRAPE_CONCURRENCY requests at once
+SCRAPE_BACKEND = "playwright"
+
+# additional subreddits to scrape in the same run, each is saved to its own file, example: ["/r/NoStupidQuestions"]
+SUBREDDITS: list[str] = []
+
+# async / http backends: number of threads loaded at once. async backend: whether the browser window is hidden
+SCRAPE_CONCURRENCY = 4
+SCRAPE_HEADLESS = True
+
+# http backend: max requests per second to reddit, and the user agent sent with them
+SCRAPE_REQUESTS_PER_SECOND = 2
+SCRAPE_USER_AGENT = "calersvm-scraper/1.0"
+
+# format of the scraped content files
+# "json": one json list written when the scrape of a subreddit is done
+# "jsonl": one record per line, appended as threads are scraped so render_all_video.py can render while scraping
+SCRAPE_OUTPUT = "json"
+
+# index of threads and comments already scraped, later runs skip those threads and only save new comments. "" to turn off
+SCRAPE_INDEX_PATH = "content/scraped.sqlite"
+
+# top comments of a thread scraped before are fetched again after this many hours, post bodies never are
+SCRAPE_REVISIT_HOURS = 24
+
 # ---
 # video related constants
 # ---
@@ -27,21 +75,67 @@ XFADE_LENGTH = 1
 # multiplier to speed up / down audio retaining pitch, normal = 1.0, faster = 1.5
 SPEECH_SPEED = 1.5
 
+# how to apply SPEECH_SPEED
+# "stretch": time-stretch the TTS waveform in-process, no extra ffmpeg / ffprobe calls
+# "model": have the TTS model speak faster itself (VITS models), falls back to "stretch" for other models
+# "ffmpeg": run the speech through ffmpeg's atempo filter (original behaviour)
+SPEECH_SPEED_METHOD = "stretch"
+
 # min and max acceptable video length in seconds, set either / both to -1 to disable
 MIN_VIDEO_LENGTH = 20
 MAX_VIDEO_LENGTH = 180
 
+# skip content whose predicted speech length is clearly outside the range above before running TTS
+PREFILTER_BY_LENGTH = True
+
+# where measured speech lengths are kept to calibrate the length prediction
+LENGTH_MODEL_PATH = "state/length_model.json"
+
+# minimum relative error allowed for the length prediction, content within this margin is still rendered and checked after TTS
+LENGTH_ESTIMATE_MARGIN = 0.25
+
 # which device to use for ffmpeg encode/decode
 FFMPEG_ACCELERATION: GpuDevice = GpuDevice.CPU
 
-# ffmpeg video bitrate
+# ffmpeg video bitrate of the standard encode profile, and the bitrate cap of the fast one
 FFMPEG_VIDEO_BITRATE = "10M"
 
+# encoder settings used for splits, reels and final videos, pick one of ENCODE_PROFILES per run
+# "draft": fastest, for checking a batch before the real render. "fast": a much faster preset at constant quality,
+# capped at FFMPEG_VIDEO_BITRATE. "standard": x264's default preset at a constant FFMPEG_VIDEO_BITRATE, the same
+# output as before there were profiles. "archive": slow, for keeping high quality masters
+ENCODE_PROFILE = "standard"
+
+# x264 preset, crf (None for a constant bitrate), bitrate (the cap with a crf, also used by hardware encoders),
+# tune (None for none) and seconds between keyframes (None for the encoder's default)
+ENCODE_PROFILES: dict[str, EncodeProfile] = {
+  "draft": EncodeProfile(preset="ultrafast", crf=30, bitrate="4M", tune="fastdecode", gop_seconds=2),
+  "fast": EncodeProfile(preset="veryfast", crf=21, bitrate=FFMPEG_VIDEO_BITRATE, tune=None, gop_seconds=2),
+  "standard": EncodeProfile(preset="medium", crf=None, bitrate=FFMPEG_VIDEO_BITRATE, tune=None, gop_seconds=None),
+  "archive": EncodeProfile(preset="slow", crf=17, bitrate="40M", tune="film", gop_seconds=2),
+}
+
+# threads per x264 encode, 0 to split the cpu cores between the encodes running at once
+# (RENDER_WORKERS in parallel mode, encode workers in pipeline mode, NORMALIZE_WORKERS when splitting)
+ENCODE_THREADS = 0
+
 # Coqui TTS model string. List available models using TTS().list_models()
 TTS_MODEL = "tts_models/en/ljspeech/vits"
 
+# split speech into sentences and synthesize them concurrently, good for long story posts
+TTS_CHUNKED = False
+
+# number of TTS worker processes for chunked synthesis, each holds its own model in memory
+TTS_CHUNK_WORKERS = 4
+
+# sentences longer than this many characters are split further on , ; and :
+TTS_CHUNK_MAX_CHARS = 200
+
+# seconds of silence inserted between synthesized sentences (before speed up)
+TTS_SENTENCE_SILENCE = 0.2
+
 # idea: make each video have a unique title
-# supported tags: %title %date %index %uuid %randnum %mystr
+# supported tags: %title %date %index %uuid %randnum %mystr %hash (first 8 characters of the content fingerprint)
 TITLE_FORMAT = "%title #reddit #shorts %index %date"
 # content format supported tags: %title %content
 CONTENT_FORMAT = "%title %content"
@@ -56,21 +150,133 @@ HEIGHT = 1920
 # desired frame rate of mini clip splits
 FPS = 60
 
+# number of source videos normalize_videos.py splits at once, each runs its own ffmpeg process
+NORMALIZE_WORKERS = 2
+
+# index of source videos and their splits, kept up to date by normalize_videos.py and read when rendering
+CLIP_MANIFEST_PATH = "video/manifest.sqlite"
+
+# where background clips come from when rendering
+# "splits": clips split and normalized up front by normalize_videos.py
+# "virtual": cut straight out of the videos in video/ and cropped / scaled while rendering, no normalize step needed
+CLIP_SOURCE = "splits"
+
+# where the clip rotation is kept between runs so clips are not reused before the whole pool has been used, "" to start fresh every run
+CLIP_SCHEDULER_STATE = "state/clip_scheduler.json"
+
+# how the final video is composed from background clips
+# "filtergraph": one ffmpeg process opening every clip at once, memory grows with the video length
+# "streaming": clips are crossfaded a window at a time and piped into the final encoder, so at most two
+# clips are decoded at once and memory stays flat however long the video is
+COMPOSE_MODE = "filtergraph"
+
+# pre-render long crossfaded reels from the clip pool once, so each video reads one reel at an offset
+# instead of opening and crossfading every clip itself. new reels are rendered as new clips arrive
+BACKGROUND_REELS = False
+
+# where background reels are kept, and how many clips go into each reel (60 clips of 5s with 1s crossfades = 241s).
+# reels are crossfaded two clips at a time, so this sets the reel length and not how many clips are decoded at once
+REEL_DIR = "video/reels"
+REEL_CLIPS = 60
+
 # ---
 # final render related constants
 # ---
 
+# how to get word timings for subtitles
+# "gentle": forced alignment of the sped up speech with the gentle server at GENTLE_URL
+# "tts": use the word durations predicted by the TTS model (VITS models), no gentle server needed
+ALIGNER = "gentle"
+
+# if the "tts" aligner can not align a video, try gentle instead
+ALIGNER_FALLBACK_TO_GENTLE = True
+
 # base url of gentle forced aligner
 GENTLE_URL = "http://localhost:32768"
 
+# additional gentle servers to spread alignments over, e.g. ["http://localhost:32769"]
+GENTLE_URLS: list[str] = []
+
+# max gentle requests in flight at once (per render process)
+GENTLE_MAX_IN_FLIGHT = 2
+
+# seconds to wait for a gentle response before giving up on the request
+GENTLE_TIMEOUT = 600
+
+# retries per alignment, waiting GENTLE_BACKOFF seconds before the first retry and doubling after that
+GENTLE_MAX_RETRIES = 3
+GENTLE_BACKOFF = 2
+
+# stop using a gentle server after this many failures in a row, and try it again after GENTLE_BREAKER_RESET seconds
+GENTLE_BREAKER_THRESHOLD = 5
+GENTLE_BREAKER_RESET = 60
+
 # start and end indices of videos to render
 # to render all, set start index to 0 and end index to -1
 COMMENTS_START_INDEX = 0
 COMMENTS_END_INDEX = -1
 
-# path of the content you want to use
+# reuse synthesized speech, alignments and subtitles from earlier runs when the text and speech settings match
+CACHE_ENABLED = True
+
+# where cached artifacts are stored, and how many bytes they may take before the least recently used are removed
+CACHE_DIR = "cache"
+CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# render job state, every comment's progress through the render stages is kept here so an interrupted run
+# continues each video after its last completed stage. "" to turn off
+JOB_STORE_PATH = "state/jobs.sqlite"
+
+# where the work files of unfinished jobs are kept between runs
+JOB_CHECKPOINT_DIR = "state/jobs"
+
+# failed jobs are retried by later runs until they failed this many times
+JOB_MAX_ATTEMPTS = 3
+
+# fingerprints of all content that was rendered or uploaded, from any content file. comments whose normalized
+# text was rendered before are skipped before filtering, TTS or encoding. "" to turn off
+DEDUP_INDEX_PATH = "state/fingerprints.sqlite"
+
+# also skip near duplicates, e.g. reposted copypasta with small edits, that share at least DEDUP_SIMILARITY
+# of their word shingles (estimated with minhash) with rendered content
+DEDUP_NEAR_DUPLICATES = False
+DEDUP_SIMILARITY = 0.8
+
+# ffmpeg: seconds after which a call is stopped (0 for no limit), seconds without progress after which a hung call
+# is stopped (0 to never), and seconds between progress logs of long encodes
+FFMPEG_TIMEOUT = 0
+FFMPEG_STALL_TIMEOUT = 300
+FFMPEG_PROGRESS_INTERVAL = 10
+
+# path of the content you want to use, .json or .jsonl. "latest" uses the newest comments file in content/
+# .jsonl files are followed while the scraper is still appending to them, and rendering resumes where the last run stopped
 COMMENTS_FILE_PATH = "content/INSERT-FILE-NAME-HERE.json"
 
+# .jsonl content: seconds between checks for new records, and how long to wait for new records before giving up
+# on a file the scraper has not marked as done
+CONTENT_POLL_INTERVAL = 1.0
+CONTENT_IDLE_TIMEOUT = 600
+
+# how to schedule renders
+# "serial": render one video at a time, start to finish
+# "pipeline": overlap videos by running each stage (tts, speed, align, srt, encode) on its own worker
+# "parallel": render several videos at once on separate worker processes, see RENDER_WORKERS
+RENDER_MODE = "serial"
+
+# parallel mode: number of worker processes, each holds its own TTS model in memory
+RENDER_WORKERS = 4
+
+# parallel mode: how many jobs are read ahead of the workers. the longest predicted of them is rendered next, so
+# long renders start early. the file is not read further ahead, a .jsonl file still being scraped renders as it grows
+PARALLEL_LOOKAHEAD = 16
+
+# pipeline mode: how many jobs may wait between two stages
+PIPELINE_QUEUE_SIZE = 2
+
+# pipeline mode: number of workers per stage name, stages not listed get one worker
+# the align stage defaults to GENTLE_MAX_IN_FLIGHT workers, example: {"tts": 1, "align": 4}
+PIPELINE_STAGE_WORKERS: dict[str, int] = {}
+
 # ---
 # auto-upload related constants
 # ---
@@ -90,3 +296,22 @@ UPLOAD_INTERVAL = 2.4 * 60 * 60
 # to render all, set start index to 0 and end index to -1
 UPLOAD_START_INDEX = 0
 UPLOAD_END_INDEX = -1
+
+# ---
+# benchmark related constants
+# ---
+
+# where benchmark.py generates its fixtures and renders, and writes the results of every run
+BENCH_DIR = "bench"
+
+# results to compare against, written by `python benchmark.py --save-baseline`
+BENCH_BASELINE_PATH = "bench/baseline.json"
+
+# runs per benchmark, the median of them is compared with the baseline
+BENCH_REPEATS = 3
+
+# a benchmark whose median is this much slower than the baseline (0.2 = 20%) counts as a regression
+BENCH_REGRESSION_THRESHOLD = 0.2
+
+# number of canned comments rendered by the render_all_videos benchmark
+BENCH_COMMENTS = 10
@@ -1,5 +1,8 @@
 import re
-from fnmatch import fnmatchcase
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import translate
+from functools import lru_cache
+from typing import Iterable
 from better_profanity import profanity
 
 substitutions = [
@@ -103,29 +106,72 @@ substitutions = [
   ("wbu", "what about you"),
 ]
 
-def clean_text(text: str) -> str:
-  words = text.split()
-    
-  def replace_word(word):
-    lower_word = word.lower()
-    for pattern, substitute in substitutions:
+# characters that make a substitution pattern a wildcard pattern for fnmatch
+WILDCARD_CHARACTERS = "*?["
+
+# the substitution rules compiled once: literal patterns are looked up in a dict, wildcard patterns are tried
+# together in one regex. like the rule list, the first matching rule wins
+class SubstitutionEngine:
+  def __init__(self, rules: list[tuple[str, str]]):
+    self.literals: dict[str, tuple[int, str, re.Pattern, str]] = {} # lowercase pattern -> (rule index, replacement, regex, template)
+    self.wildcards: list[tuple[re.Pattern, str]] = [] # (regex, template) per rule, used with re.sub like clean_text did
+    self.wildcard_rules: list[int] = [] # rule index of each wildcard
+    alternatives = []
+    for i, (pattern, substitute) in enumerate(rules):
       lower_pattern = pattern.lower()
-      if fnmatchcase(lower_word, lower_pattern):
-        final_substitute = substitute
-        # *word*
-        if lower_pattern[0] == "*" and lower_pattern[-1] == "*":
-          final_substitute = f"\\1{substitute}\\2"
-        # *word
-        elif lower_pattern[0] == "*":
-          final_substitute = f"\\1{substitute}"
-        # word*
-        elif lower_pattern[-1] == "*":
-          final_substitute = f"{substitute}\\1"
+      if not any(c in lower_pattern for c in WILDCARD_CHARACTERS) and lower_pattern.isascii():
+        # an ascii word equal to the pattern is replaced by the whole substitute
+        regex = re.compile(re.escape(lower_pattern), flags=re.IGNORECASE)
+        self.literals.setdefault(lower_pattern, (i, regex.sub(substitute, lower_pattern), regex, substitute))
+        continue
+
+      final_substitute = substitute
+      # *word*
+      if lower_pattern[0] == "*" and lower_pattern[-1] == "*":
+        final_substitute = f"\\1{substitute}\\2"
+      # *word
+      elif lower_pattern[0] == "*":
+        final_substitute = f"\\1{substitute}"
+      # word*
+      elif lower_pattern[-1] == "*":
+        final_substitute = f"{substitute}\\1"
+      self.wildcards.append((re.compile(re.escape(lower_pattern).replace('\\*', '(.*)'), flags=re.IGNORECASE), final_substitute))
+      self.wildcard_rules.append(i)
+      alternatives.append(f"(?P<w{len(self.wildcards) - 1}>{translate(lower_pattern)})")
+
+    # alternation keeps rule order, so the first wildcard that matches the whole word is the one reported
+    self.wildcard_regex = re.compile("|".join(alternatives)) if alternatives else None
+    self.replace_word = lru_cache(maxsize=65536)(self._replace_word)
+
+  def _replace_word(self, word: str) -> str:
+    lower_word = word.lower()
+    literal = self.literals.get(lower_word)
+    match = self.wildcard_regex.match(lower_word) if self.wildcard_regex is not None else None
+    wildcard = int(match.lastgroup[1:]) if match is not None and match.lastgroup is not None else None
 
-        return re.sub(re.escape(lower_pattern).replace('\\*', '(.*)'), final_substitute, word, flags=re.IGNORECASE)
+    # a literal rule only wins over a matching wildcard rule if it comes first in the rule list
+    if literal is not None and (wildcard is None or literal[0] < self.wildcard_rules[wildcard]):
+      # non-ascii words can lowercase to an ascii pattern, substitute them the way the rule list does
+      return literal[1] if word.isascii() else literal[2].sub(literal[3], word)
+    if wildcard is not None:
+      regex, final_substitute = self.wildcards[wildcard]
+      return regex.sub(final_substitute, word)
     return word
-    
-  pre_text = ' '.join(replace_word(word) for word in words)
+
+  def substitute(self, text: str) -> str:
+    return ' '.join(self.replace_word(word) for word in text.split())
+
+_engine = SubstitutionEngine(substitutions)
+
+def clean_text(text: str) -> str:
+  pre_text = _engine.substitute(text)
 
   # just in case: catch remaining words with package
   return profanity.censor(pre_text).replace("****", "beep")
+
+# clean many texts, e.g. the titles and contents of a whole comments file, on `workers` processes if more than 1
+def clean_texts(texts: Iterable[str], workers: int = 1) -> list[str]:
+  if workers <= 1:
+    return [clean_text(text) for text in texts]
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(clean_text, texts, chunksize=64))
@@ -0,0 +1,125 @@
+import glob
+import json
+import os
+import time
+from threading import Lock
+from typing import Iterator
+
+from util import Log
+from consts import CONTENT_POLL_INTERVAL, CONTENT_IDLE_TIMEOUT
+
+# a scraper that streams into `path` creates this file once it is done appending
+def done_marker(path: str) -> str:
+  return path + ".done"
+
+# where the renderer remembers how far it got in `path`
+def progress_file(path: str) -> str:
+  return path + ".progress"
+
+# newest comments file in `content_dir`, used for COMMENTS_FILE_PATH = "latest"
+def latest_content_file(content_dir: str = "./content") -> str:
+  files = glob.glob(os.path.join(content_dir, "comments-*.json")) + glob.glob(os.path.join(content_dir, "comments-*.jsonl"))
+  if len(files) == 0:
+    raise FileNotFoundError(f"No comments files in {content_dir}, run scrape.py first")
+  return max(files, key=os.path.getmtime)
+
+# appends records to a jsonl file one line at a time, each line is flushed so a reader tailing the file sees it right away
+class JsonlWriter:
+  def __init__(self, path: str):
+    self.path = path
+    self.num_records = 0
+    self._file = open(path, "a", encoding="utf-8")
+    # appending to a finished file reopens it for readers
+    if os.path.exists(done_marker(path)):
+      os.remove(done_marker(path))
+
+  def write(self, record: dict[str, str]) -> None:
+    self._file.write(json.dumps(record) + "\n")
+    self._file.flush()
+    self.num_records += 1
+
+  # close the file and mark it as complete for readers
+  def close(self) -> None:
+    self._file.close()
+    open(done_marker(self.path), "w").close()
+
+# yield (record, start offset, end offset) for every line of a jsonl file from byte `offset` on, following the
+# file while a scraper is still appending to it. stops at the end of the file once the writer marked it done,
+# or when nothing was appended for `idle_timeout` seconds. a line without its newline yet is read again later
+def tail_jsonl(path: str, offset: int = 0, poll_interval: float = CONTENT_POLL_INTERVAL, idle_timeout: float = CONTENT_IDLE_TIMEOUT) -> Iterator[tuple[dict[str, str], int, int]]:
+  with open(path, "rb") as f:
+    f.seek(offset)
+    last_data = time.monotonic()
+    while True:
+      line = f.readline()
+      if line.endswith(b"\n"):
+        last_data = time.monotonic()
+        start, offset = offset, offset + len(line)
+        if line.strip():
+          try:
+            yield json.loads(line), start, offset
+          except ValueError:
+            Log.warn(f"Skipping malformed line at byte {start} of {path}")
+        continue
+
+      # no complete line, go back to its start and wait for the writer
+      f.seek(offset)
+      if os.path.exists(done_marker(path)) and os.path.getsize(path) == offset:
+        return
+      if time.monotonic() - last_data > idle_timeout:
+        Log.warn(f"Nothing was appended to {path} for {idle_timeout:.0f}s, stopping")
+        return
+      time.sleep(poll_interval)
+
+# yield (index, record, start offset, end offset) for the records of a json or jsonl content file,
+# jsonl files are tailed from `offset`, starting at record number `index`
+def read_content(path: str, offset: int = 0, index: int = 0) -> Iterator[tuple[int, dict[str, str], int, int]]:
+  if path.endswith(".jsonl"):
+    for record, start, end in tail_jsonl(path, offset):
+      yield index, record, start, end
+      index += 1
+  else:
+    with open(path, "r") as f:
+      records = json.load(f)
+    for i in range(index, len(records)):
+      yield i, records[i], 0, 0
+
+# tracks which records of a content file finished rendering, jobs may finish out of order. the saved offset is
+# the start of the earliest record still in flight, so resuming never skips a record that was not rendered
+class ContentProgress:
+  def __init__(self, path: str):
+    self.path = path
+    self.offset = 0
+    self.index = 0
+    self._pending: dict[int, tuple[int, int]] = {} # record index -> (start offset, end offset)
+    self._finished_end = (0, 0) # (end offset, next index) after the furthest finished record
+    self._lock = Lock()
+
+  # (offset, index) to resume from, (0, 0) if the file was not rendered before
+  def load(self) -> tuple[int, int]:
+    try:
+      with open(progress_file(self.path), "r") as f:
+        progress = json.load(f)
+      self.offset, self.index = progress["offset"], progress["index"]
+      self._finished_end = (self.offset, self.index)
+    except (OSError, ValueError, KeyError):
+      pass
+    return self.offset, self.index
+
+  def start(self, index: int, start: int, end: int) -> None:
+    with self._lock:
+      self._pending[index] = (start, end)
+
+  def finish(self, index: int) -> None:
+    with self._lock:
+      _, end = self._pending.pop(index)
+      self._finished_end = max(self._finished_end, (end, index + 1))
+      if len(self._pending) > 0:
+        first = min(self._pending)
+        self.offset, self.index = self._pending[first][0], first
+      else:
+        self.offset, self.index = self._finished_end
+      temp_path = f"{progress_file(self.path)}.tmp"
+      with open(temp_path, "w") as f:
+        json.dump({"offset": self.offset, "index": self.index}, f)
+      os.replace(temp_path, progress_file(self.path))
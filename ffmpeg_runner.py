@@ -0,0 +1,197 @@
+import os
+import signal
+import subprocess
+import tempfile
+import time
+from threading import Event, Thread
+from typing import Callable, IO, NamedTuple
+
+from util import Log
+from consts import FFMPEG_TIMEOUT, FFMPEG_STALL_TIMEOUT, FFMPEG_PROGRESS_INTERVAL
+
+# one `-progress` report of a running ffmpeg, `out_time` is how many seconds of output were written
+class FfmpegProgress(NamedTuple):
+  out_time: float
+  frame: int
+  fps: float
+  speed: float
+  total_size: int
+  done: bool
+
+# what one ffmpeg call cost. realtime factor is seconds of output per second of wall time,
+# peak RSS is the largest resident memory of the process in bytes
+class FfmpegStats(NamedTuple):
+  name: str
+  wall_time: float
+  media_time: float
+  realtime_factor: float
+  output_size: int
+  peak_rss: int
+  returncode: int
+
+class FfmpegError(Exception):
+  def __init__(self, message: str, stats: FfmpegStats | None = None, log: str = ""):
+    super().__init__(message)
+    self.stats = stats
+    # the end of ffmpeg's stderr
+    self.log = log
+
+# ffmpeg was stopped by `cancel`, a timeout, or because it stopped making progress
+class FfmpegCancelled(FfmpegError):
+  pass
+
+# reap a finished process ourselves to get its resource usage, returns its peak RSS in bytes
+# or None if it is still running and `block` is off
+def wait_peak_rss(process: subprocess.Popen, block: bool = True) -> int | None:
+  pid, status, rusage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+  if pid == 0:
+    return None
+  process.returncode = os.waitstatus_to_exitcode(status)
+  # ru_maxrss is in KiB on linux
+  return rusage.ru_maxrss * 1024
+
+def _parse_number(value: str | None, default: float = 0) -> float:
+  try:
+    return float(value.rstrip("x")) if value is not None else default
+  except ValueError:
+    return default
+
+# logs progress every FFMPEG_PROGRESS_INTERVAL seconds, with percentage and ETA if the output length is known
+def log_progress(name: str, duration: float | None = None, interval: float = FFMPEG_PROGRESS_INTERVAL) -> Callable[[FfmpegProgress], None]:
+  last_log = time.monotonic()
+
+  def on_progress(progress: FfmpegProgress) -> None:
+    nonlocal last_log
+    if progress.done or time.monotonic() - last_log < interval:
+      return
+    last_log = time.monotonic()
+    if duration:
+      eta = (duration - progress.out_time) / progress.speed if progress.speed > 0 else 0
+      Log.info(f"{name}: {progress.out_time:.1f}/{duration:.0f}s ({min(100, progress.out_time / duration * 100):.0f}%), {progress.fps:.0f} fps, {progress.speed:.2f}x, ETA {eta:.0f}s")
+    else:
+      Log.info(f"{name}: {progress.out_time:.1f}s, {progress.fps:.0f} fps, {progress.speed:.2f}x")
+
+  return on_progress
+
+# a running ffmpeg started from an argument list, without a shell. progress is read from `-progress` on a
+# pipe of its own so stdin and stdout stay free for piping media, stderr is kept in a temporary file.
+# `wait` enforces the timeouts and returns the stats. `cancel` or setting the `cancel` event stops it from any thread
+class FfmpegProcess:
+  def __init__(self, cmd: list[str], name: str = "ffmpeg", output_file: str | None = None, duration: float | None = None,
+               stdin: int | IO | None = subprocess.DEVNULL, stdout: int | IO | None = subprocess.DEVNULL, on_progress: Callable[[FfmpegProgress], None] | None = None, cancel: Event | None = None):
+    self.name = name
+    self.output_file = output_file
+    self.progress = FfmpegProgress(0, 0, 0, 0, 0, False)
+    self.last_progress = time.monotonic()
+    self._on_progress = on_progress if on_progress is not None else log_progress(name, duration)
+    self._cancelled = cancel if cancel is not None else Event()
+
+    progress_read, progress_write = os.pipe()
+    cmd = [cmd[0], "-progress", f"pipe:{progress_write}", "-nostats"] + cmd[1:]
+    Log.verbose(f"Calling ffmpeg ({name}): " + subprocess.list2cmdline(cmd))
+    self._log = tempfile.TemporaryFile()
+    self.start_time = time.monotonic()
+    try:
+      self.process = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=self._log, pass_fds=(progress_write,))
+    except OSError:
+      os.close(progress_read)
+      self._log.close()
+      raise
+    finally:
+      os.close(progress_write)
+    self.stdin = self.process.stdin
+    self._reader = Thread(target=self._read_progress, args=(progress_read,), name=f"ffmpeg-progress-{name}", daemon=True)
+    self._reader.start()
+    self._stats: FfmpegStats | None = None
+
+  def _read_progress(self, fd: int) -> None:
+    values: dict[str, str] = {}
+    with os.fdopen(fd, "r", errors="replace") as f:
+      for line in f:
+        key, _, value = line.strip().partition("=")
+        values[key] = value
+        if key != "progress":
+          continue
+        # out_time_ms is in microseconds as well in older versions
+        out_time = _parse_number(values.get("out_time_us", values.get("out_time_ms")), 0) / 1e6
+        self.progress = FfmpegProgress(max(0, out_time), int(_parse_number(values.get("frame"))), _parse_number(values.get("fps")),
+                                       _parse_number(values.get("speed")), int(_parse_number(values.get("total_size"))), value == "end")
+        self.last_progress = time.monotonic()
+        try:
+          self._on_progress(self.progress)
+        except Exception as ex:
+          Log.warn(f"Progress callback of {self.name} failed: {ex}")
+        values = {}
+
+  # stop ffmpeg, `wait` then raises FfmpegCancelled
+  def cancel(self) -> None:
+    self._cancelled.set()
+
+  # returns the peak RSS. signals go to the pid directly, Popen would reap the process and lose its resource usage
+  def _stop(self) -> int:
+    # SIGTERM lets ffmpeg close its files, kill it if it does not exit soon after
+    os.kill(self.process.pid, signal.SIGTERM)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+      peak_rss = wait_peak_rss(self.process, block=False)
+      if peak_rss is not None:
+        return peak_rss
+      time.sleep(0.1)
+    os.kill(self.process.pid, signal.SIGKILL)
+    return wait_peak_rss(self.process) or 0
+
+  def _finish(self, peak_rss: int) -> FfmpegStats:
+    self._reader.join(timeout=5)
+    wall_time = time.monotonic() - self.start_time
+    output_size = os.path.getsize(self.output_file) if self.output_file is not None and os.path.exists(self.output_file) else self.progress.total_size
+    self._stats = FfmpegStats(self.name, wall_time, self.progress.out_time, self.progress.out_time / wall_time if wall_time > 0 else 0, output_size, peak_rss, self.process.returncode)
+    return self._stats
+
+  # the end of stderr, for error messages
+  def log_tail(self, num_chars: int = 4000) -> str:
+    self._log.seek(0, os.SEEK_END)
+    self._log.seek(max(0, self._log.tell() - num_chars))
+    return self._log.read().decode("utf-8", errors="replace")
+
+  # stats if ffmpeg has exited, None if it is still running
+  def poll(self) -> FfmpegStats | None:
+    if self._stats is not None:
+      return self._stats
+    peak_rss = wait_peak_rss(self.process, block=False)
+    return self._finish(peak_rss) if peak_rss is not None else None
+
+  # wait for ffmpeg to exit and return its stats. raises FfmpegError if it failed and `check` is on, or
+  # FfmpegCancelled if it was cancelled, ran longer than `timeout` or made no progress for `stall_timeout` seconds
+  def wait(self, timeout: float = FFMPEG_TIMEOUT, stall_timeout: float = FFMPEG_STALL_TIMEOUT, check: bool = True) -> FfmpegStats:
+    reason = None
+    while self._stats is None and self.poll() is None:
+      now = time.monotonic()
+      if self._cancelled.is_set():
+        reason = "was cancelled"
+      elif timeout > 0 and now - self.start_time > timeout:
+        reason = f"timed out after {timeout:.0f}s"
+      elif stall_timeout > 0 and now - self.last_progress > stall_timeout:
+        reason = f"made no progress for {stall_timeout:.0f}s"
+      if reason is not None:
+        self._finish(self._stop())
+        break
+      time.sleep(0.1)
+
+    stats = self._stats
+    assert stats is not None
+    try:
+      if reason is not None:
+        raise FfmpegCancelled(f"ffmpeg ({self.name}) {reason}", stats, self.log_tail())
+      if check and stats.returncode != 0:
+        raise FfmpegError(f"ffmpeg ({self.name}) exited with code {stats.returncode}", stats, self.log_tail())
+    finally:
+      self._log.close()
+    Log.verbose(format_stats(stats))
+    return stats
+
+def format_stats(stats: FfmpegStats) -> str:
+  return f"ffmpeg ({stats.name}): {stats.media_time:.1f}s of output in {stats.wall_time:.1f}s ({stats.realtime_factor:.2f}x realtime), {stats.output_size / 2 ** 20:.1f} MiB, peak memory {stats.peak_rss / 2 ** 20:.0f} MiB"
+
+# run ffmpeg to completion, see `FfmpegProcess` and `FfmpegProcess.wait`
+def run_ffmpeg(cmd: list[str], name: str = "ffmpeg", output_file: str | None = None, duration: float | None = None, timeout: float = FFMPEG_TIMEOUT, cancel: Event | None = None) -> FfmpegStats:
+  return FfmpegProcess(cmd, name, output_file, duration, cancel=cancel).wait(timeout)
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+from util import Log
+from consts import DEDUP_INDEX_PATH, DEDUP_NEAR_DUPLICATES, DEDUP_SIMILARITY
+
+# minhash signature size and how it is split into bands for lookup. 16 bands of 8 rows find pairs from
+# a similarity of about 0.7 up, candidates are then checked against DEDUP_SIMILARITY
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 16
+
+# words per shingle for near duplicate detection
+SHINGLE_WORDS = 3
+
+# permutations (a * x + b) mod p with a fixed seed so signatures stay comparable between runs. p is the largest
+# prime below 2^32 and a, b, x are below p, so a * x + b stays below 2^64 and never wraps in uint64
+_MINHASH_PRIME = np.uint64(4294967291)
+_minhash_rng = np.random.default_rng(20250625)
+_MINHASH_A = _minhash_rng.integers(1, int(_MINHASH_PRIME), MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_B = _minhash_rng.integers(0, int(_MINHASH_PRIME), MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+# text reduced to lowercase words, so case, punctuation, emoji names and spacing do not change the fingerprint
+def normalize_content(text: str) -> str:
+  text = unicodedata.normalize("NFKC", text).casefold()
+  return " ".join(re.findall(r"\w+", text))
+
+# stable id of a comment's content, the same text scraped from any thread or file has the same fingerprint
+def content_fingerprint(text: str) -> str:
+  return hashlib.sha256(normalize_content(text).encode("utf-8")).hexdigest()
+
+# minhash signature over word shingles of the normalized text, similar texts share most of the values
+def minhash_signature(text: str) -> np.ndarray:
+  words = normalize_content(text).split(" ")
+  shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+  hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in shingles], dtype=np.uint64) % _MINHASH_PRIME
+  return ((np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+# lookup keys of a signature, one per band
+def _band_keys(signature: np.ndarray) -> list[str]:
+  rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+  return [hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).hexdigest() for band in range(MINHASH_BANDS)]
+
+# corpus wide index of content fingerprints that were rendered or uploaded, shared by every content file.
+# a comment whose fingerprint is known is skipped before any filtering, TTS or encoding, whatever its title.
+# with `near_duplicates` the minhash signatures of rendered content are indexed too, to catch reposted
+# copies with small edits. content claimed during this run counts as seen, so duplicates within a batch are skipped too
+class FingerprintIndex:
+  def __init__(self, path: str = DEDUP_INDEX_PATH, near_duplicates: bool = DEDUP_NEAR_DUPLICATES, similarity: float = DEDUP_SIMILARITY):
+    self.near_duplicates = near_duplicates
+    self.similarity = similarity
+    Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+    self._lock = Lock()
+    self._claimed: set[str] = set()
+    self._claimed_signatures: dict[str, np.ndarray] = {}
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self._db:
+      self._db.execute("CREATE TABLE IF NOT EXISTS fingerprints (hash TEXT PRIMARY KEY, status TEXT NOT NULL, output TEXT NOT NULL DEFAULT '', signature BLOB, updated REAL NOT NULL)")
+      self._db.execute("CREATE INDEX IF NOT EXISTS fingerprints_output ON fingerprints (output)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS bands (key TEXT NOT NULL, hash TEXT NOT NULL)")
+      self._db.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (key)")
+
+  def _similar(self, signature: np.ndarray) -> str | None:
+    keys = _band_keys(signature)
+    candidates = set()
+    for key in keys:
+      candidates.update(hash for (hash,) in self._db.execute("SELECT hash FROM bands WHERE key = ?", (key,)))
+    for hash in candidates:
+      row = self._db.execute("SELECT signature FROM fingerprints WHERE hash = ?", (hash,)).fetchone()
+      if row is not None and row[0] is not None and np.mean(np.frombuffer(row[0], dtype=np.uint32) == signature) >= self.similarity:
+        return hash
+    for hash, claimed in self._claimed_signatures.items():
+      if np.mean(claimed == signature) >= self.similarity:
+        return hash
+    return None
+
+  # claim content for rendering in this run, returns the fingerprint it duplicates or None if it is new
+  def claim(self, fingerprint: str, text: str) -> str | None:
+    with self._lock:
+      if fingerprint in self._claimed or self._db.execute("SELECT 1 FROM fingerprints WHERE hash = ?", (fingerprint,)).fetchone() is not None:
+        return fingerprint
+      if self.near_duplicates:
+        signature = minhash_signature(text)
+        duplicate = self._similar(signature)
+        if duplicate is not None:
+          return duplicate
+        self._claimed_signatures[fingerprint] = signature
+      self._claimed.add(fingerprint)
+      return None
+
+  # give up a claim, e.g. when the render failed, so a later run tries the content again
+  def release(self, fingerprint: str) -> None:
+    with self._lock:
+      self._claimed.discard(fingerprint)
+      self._claimed_signatures.pop(fingerprint, None)
+
+  # remember claimed content as rendered into the video file `output`
+  def add(self, fingerprint: str, output: str) -> None:
+    with self._lock, self._db:
+      signature = self._claimed_signatures.pop(fingerprint, None)
+      self._claimed.discard(fingerprint)
+      self._db.execute("INSERT OR REPLACE INTO fingerprints (hash, status, output, signature, updated) VALUES (?, 'rendered', ?, ?, ?)", (fingerprint, os.path.basename(output), signature.tobytes() if signature is not None else None, time.time()))
+      self._db.execute("DELETE FROM bands WHERE hash = ?", (fingerprint,))
+      if signature is not None:
+        self._db.executemany("INSERT INTO bands (key, hash) VALUES (?, ?)", [(key, fingerprint) for key in _band_keys(signature)])
+
+  # mark the content rendered into the video file `output` as uploaded, returns False if the video is unknown
+  def mark_uploaded(self, output: str) -> bool:
+    with self._lock, self._db:
+      return self._db.execute("UPDATE fingerprints SET status = 'uploaded', updated = ? WHERE output = ?", (time.time(), os.path.basename(output))).rowcount > 0
+
+  # number of fingerprints per status
+  def summary(self) -> dict[str, int]:
+    with self._lock:
+      return dict(self._db.execute("SELECT status, COUNT(*) FROM fingerprints GROUP BY status").fetchall())
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+# the index at DEDUP_INDEX_PATH, or None if duplicates are not skipped
+def open_fingerprint_index() -> FingerprintIndex | None:
+  if not DEDUP_INDEX_PATH:
+    return None
+  index = FingerprintIndex()
+  Log.verbose("Content fingerprints: " + ", ".join(f"{count} {status}" for status, count in sorted(index.summary().items())))
+  return index
@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from util import Log
+from consts import GENTLE_MAX_IN_FLIGHT, GENTLE_TIMEOUT, GENTLE_MAX_RETRIES, GENTLE_BACKOFF, GENTLE_BREAKER_THRESHOLD, GENTLE_BREAKER_RESET
+
+class GentleError(Exception):
+  pass
+
+# stops sending requests to a server after `threshold` failures in a row. after `reset_timeout` seconds
+# one trial request is let through (half open), success closes the breaker again, failure re-opens it
+class CircuitBreaker:
+  def __init__(self, threshold: int = GENTLE_BREAKER_THRESHOLD, reset_timeout: float = GENTLE_BREAKER_RESET):
+    self.threshold = threshold
+    self.reset_timeout = reset_timeout
+    self.failures = 0
+    self.opened_at: float | None = None
+    self.trial_in_flight = False
+    self._lock = Lock()
+
+  def allow(self) -> bool:
+    with self._lock:
+      if self.opened_at is None:
+        return True
+      if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial_in_flight:
+        self.trial_in_flight = True
+        return True
+      return False
+
+  def record_success(self) -> None:
+    with self._lock:
+      self.failures = 0
+      self.opened_at = None
+      self.trial_in_flight = False
+
+  def record_failure(self) -> None:
+    with self._lock:
+      self.failures += 1
+      self.trial_in_flight = False
+      if self.failures >= self.threshold:
+        self.opened_at = time.monotonic()
+
+# client for one or more gentle servers sharing a pooled keep-alive session. limits requests in flight,
+# times out hung requests, retries failures with exponential backoff on the next server and skips servers
+# whose circuit breaker is open
+class GentleClient:
+  def __init__(self, urls: list[str], max_in_flight: int = GENTLE_MAX_IN_FLIGHT, timeout: float = GENTLE_TIMEOUT, max_retries: int = GENTLE_MAX_RETRIES, backoff: float = GENTLE_BACKOFF,
+               breaker_threshold: int = GENTLE_BREAKER_THRESHOLD, breaker_reset: float = GENTLE_BREAKER_RESET):
+    if len(urls) == 0:
+      raise ValueError("At least one gentle url is required")
+    self.urls = [url.rstrip("/") for url in urls]
+    self.max_in_flight = max(1, max_in_flight)
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.breakers = {url: CircuitBreaker(breaker_threshold, breaker_reset) for url in self.urls}
+    self._in_flight = BoundedSemaphore(self.max_in_flight)
+    self._next_url = 0
+    self._lock = Lock()
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=len(self.urls), pool_maxsize=self.max_in_flight)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  # round robin over the servers whose breaker lets a request through
+  def _pick_url(self) -> str | None:
+    with self._lock:
+      for _ in range(len(self.urls)):
+        url = self.urls[self._next_url]
+        self._next_url = (self._next_url + 1) % len(self.urls)
+        if self.breakers[url].allow():
+          return url
+    return None
+
+  # align a transcript to speech, returns gentle's list of word dicts
+  def align(self, audio: bytes, transcript: str) -> list[dict]:
+    last_error: Exception | None = None
+    for attempt in range(self.max_retries + 1):
+      if attempt > 0:
+        # exponential backoff with jitter so retries from many jobs do not arrive together
+        time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+      url = self._pick_url()
+      if url is None:
+        last_error = GentleError("All gentle servers are unavailable (circuit breaker open)")
+        continue
+
+      request_url = url + "/transcriptions?async=false"
+      files = {
+        "audio": ("speech.wav", audio, "audio/wav"),
+        "transcript": ("speech.txt", transcript, "text/plain"),
+      }
+      try:
+        with self._in_flight:
+          Log.verbose(f"Aligning speech text using {request_url} (attempt {attempt + 1})")
+          response = self.session.post(request_url, files=files, timeout=self.timeout)
+        response.raise_for_status()
+        words = response.json()["words"]
+      except (requests.RequestException, ValueError, KeyError) as ex:
+        self.breakers[url].record_failure()
+        Log.warn(f"Gentle request to {url} failed: {ex}")
+        last_error = ex
+        continue
+
+      self.breakers[url].record_success()
+      return words
+
+    raise GentleError(f"Failed to align after {self.max_retries + 1} attempts: {last_error}")
+
+  # read the files and align them
+  def align_files(self, audio_file: str, transcript_file: str) -> list[dict]:
+    with open(audio_file, "rb") as f:
+      audio = f.read()
+    with open(transcript_file, "r") as f:
+      transcript = f.read()
+    return self.align(audio, transcript)
+
+  # align several (audio file, transcript file) pairs at once, spread over all servers
+  # results are in the same order, with the exception in place of the words for failed items
+  def align_many(self, items: list[tuple[str, str]]) -> list[list[dict] | Exception]:
+    def align_item(item: tuple[str, str]) -> list[dict] | Exception:
+      try:
+        return self.align_files(*item)
+      except Exception as ex:
+        return ex
+
+    with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+      return list(pool.map(align_item, items))
+
+  def close(self) -> None:
+    self.session.close()
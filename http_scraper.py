@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from threading import Lock
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from util import Log
+from scrape import thread_records, ContentWriter
+from scrape_index import ScrapeIndex
+from consts import BASE_URL, SKIP_NSFW, SCRAPE_ONLY_POST, SCRAPE_CONCURRENCY, SCRAPE_REQUESTS_PER_SECOND, SCRAPE_USER_AGENT
+
+# text of an html fragment the way the browser's textContent reads it, all text nodes joined as they are
+class _TextExtractor(HTMLParser):
+  def __init__(self):
+    super().__init__(convert_charrefs=True)
+    self.parts: list[str] = []
+
+  def handle_data(self, data: str) -> None:
+    self.parts.append(data)
+
+def html_to_text(html: str) -> str:
+  parser = _TextExtractor()
+  parser.feed(html)
+  parser.close()
+  return "".join(parser.parts)
+
+# seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP-date.
+# `default` if the header is missing or can not be parsed
+def retry_after_seconds(value: str | None, default: float) -> float:
+  if value is None:
+    return default
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    retry_at = parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return default
+  if retry_at.tzinfo is None:
+    retry_at = retry_at.replace(tzinfo=timezone.utc)
+  return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+# spaces requests out to at most `per_second` across all threads
+class RateLimiter:
+  def __init__(self, per_second: float):
+    self.interval = 1 / per_second if per_second > 0 else 0
+    self.next_time = 0.0
+    self._lock = Lock()
+
+  def wait(self) -> None:
+    with self._lock:
+      now = time.monotonic()
+      delay = self.next_time - now
+      self.next_time = max(now, self.next_time) + self.interval
+    if delay > 0:
+      time.sleep(delay)
+
+# scrapes reddit's json endpoints over plain http instead of rendering old.reddit in a browser.
+# requests share a keep-alive session, at most `concurrency` are in flight and they are rate limited
+class RedditHttpScraper:
+  def __init__(self, base_url: str = BASE_URL, concurrency: int = SCRAPE_CONCURRENCY, requests_per_second: float = SCRAPE_REQUESTS_PER_SECOND, max_retries: int = 3, index: ScrapeIndex | None = None):
+    self.base_url = base_url.rstrip("/")
+    self.index = index
+    self.concurrency = max(1, concurrency)
+    self.max_retries = max_retries
+    self.rate_limiter = RateLimiter(requests_per_second)
+    self.session = requests.Session()
+    self.session.headers["User-Agent"] = SCRAPE_USER_AGENT
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  # GET json from `path` on base_url, waiting out 429 / 5xx responses
+  def get_json(self, path: str) -> object:
+    url = self.base_url + path
+    for attempt in range(self.max_retries + 1):
+      self.rate_limiter.wait()
+      response = self.session.get(url, params={"raw_json": 1}, timeout=30)
+      if response.status_code == 429 or response.status_code >= 500:
+        delay = retry_after_seconds(response.headers.get("Retry-After"), 2 ** attempt)
+        Log.warn(f"Got {response.status_code} from {url}, retrying in {delay:.0f}s")
+        time.sleep(delay)
+        continue
+      response.raise_for_status()
+      return response.json()
+    raise requests.HTTPError(f"Giving up on {url} after {self.max_retries + 1} attempts")
+
+  # {title, href, link, over_18} of every thread on the first page of the subreddit
+  # `link` is where the listing's title links to, the thread itself for text posts. malformed entries are skipped
+  def fetch_threads(self, subreddit: str) -> list[dict]:
+    listing = self.get_json(f"{subreddit.rstrip('/')}/.json")
+    threads = []
+    for child in listing["data"]["children"]:
+      try:
+        post = child["data"]
+        threads.append({"title": post["title"], "href": post["permalink"], "link": post.get("url", ""), "over_18": post.get("over_18", False)})
+      except (KeyError, TypeError, AttributeError) as ex:
+        Log.error(f"Skipping a malformed thread in the listing of {subreddit}")
+        Log.error(ex)
+    return threads
+
+  # post body or top level comments of a thread as text
+  def fetch_thread_texts(self, href: str) -> list[str | None]:
+    post_listing, comment_listing = self.get_json(f"{href.rstrip('/')}/.json")
+    if SCRAPE_ONLY_POST:
+      body_html = post_listing["data"]["children"][0]["data"].get("selftext_html")
+      return [html_to_text(body_html) if body_html else None]
+    return [html_to_text(child["data"]["body_html"]) for child in comment_listing["data"]["children"] if child["kind"] == "t1" and child["data"].get("body_html")]
+
+  # same records as scrape.scrape_reddit, returns the file name the content was saved to, None if nothing new was found
+  def scrape(self, subreddit: str) -> str | None:
+    Log.info(f"Fetching thread titles and links of {subreddit}")
+    threads = self.fetch_threads(subreddit)
+    num_threads = len(threads)
+    # like the browser scrapers, only threads whose title links to the thread itself (text posts) are scraped
+    threads = [thread for thread in threads if "/comments/" in thread["link"] and not (SKIP_NSFW and thread["over_18"])]
+    if num_threads > len(threads):
+      Log.info(f"Skipping {num_threads - len(threads)} link or not safe for work posts")
+    if self.index is not None:
+      num_threads = len(threads)
+      threads = [thread for thread in threads if not self.index.is_done(thread["href"])]
+      if num_threads > len(threads):
+        Log.info(f"Skipping {num_threads - len(threads)} already scraped threads")
+
+    def scrape_thread(thread: dict) -> list[dict[str, str]] | None:
+      try:
+        records = thread_records(thread, self.fetch_thread_texts(thread["href"]))
+        Log.info(f"Gathered {'post content' if SCRAPE_ONLY_POST else 'top comments'}: {thread['title']} at {self.base_url + thread['href']}")
+        return records
+      except (requests.RequestException, ValueError, KeyError, IndexError, TypeError, AttributeError) as ex:
+        Log.error(f"Failed to scrape {self.base_url + thread['href']}")
+        Log.error(ex)
+        return None
+
+    # map keeps the listing order
+    writer = ContentWriter(subreddit, self.index)
+    with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+      for thread, records in zip(threads, pool.map(scrape_thread, threads)):
+        if records is not None:
+          writer.add_thread(thread, records)
+    return writer.close()
+
+  def close(self) -> None:
+    self.session.close()
+
+# scrape the first page of each subreddit, returns the file names the content was saved to
+def scrape_reddit_http(subreddits: list[str], base_url: str = BASE_URL, index: ScrapeIndex | None = None) -> list[str | None]:
+  scraper = RedditHttpScraper(base_url, index=index)
+  try:
+    return [scraper.scrape(subreddit) for subreddit in subreddits]
+  finally:
+    scraper.close()
@@ -0,0 +1,189 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import NamedTuple, TYPE_CHECKING
+
+from util import Log
+from audio import read_wav, write_wav
+from consts import JOB_STORE_PATH, JOB_CHECKPOINT_DIR, JOB_MAX_ATTEMPTS
+
+if TYPE_CHECKING:
+  from render_video import RenderJob, RenderStage
+
+# job fields saved with every checkpoint, everything later stages read from earlier ones
+CHECKPOINT_FIELDS = ["title", "content", "speech_length", "video_length", "word_timings", "chunks", "tts_word_timings", "speed_applied", "speech_key", "speech_cached", "sample_rate"]
+
+# work files saved with every checkpoint that exist at that point
+CHECKPOINT_FILES = ["speech.txt", "speech_pre.wav", "speech.wav", "sub.srt"]
+
+# statuses a job is never rendered again from
+FINAL_STATUSES = {"done", "rejected", "filtered"}
+
+# what the store knows about one comment
+# status: "pending", "running", "done", "rejected" by a stage, "filtered" before rendering, or "failed"
+# stage: the last stage that completed, the job continues with the stage after it
+class JobRecord(NamedTuple):
+  key: str
+  title: str
+  status: str
+  stage: str
+  reason: str
+  attempts: int
+  updated: float
+
+# durable state of every render job, keyed by the comment it renders. a job is checkpointed after every stage
+# (its fields and work files), so a restarted run continues each job after its last completed stage, retries
+# failed jobs up to `max_attempts` times and never renders done or rejected ones again. titles are kept from
+# the first run, so %date, %uuid and %randnum in TITLE_FORMAT do not change between runs
+class JobStore:
+  def __init__(self, path: str = JOB_STORE_PATH, checkpoint_dir: str = JOB_CHECKPOINT_DIR, max_attempts: int = JOB_MAX_ATTEMPTS):
+    self.checkpoint_dir = checkpoint_dir
+    self.max_attempts = max_attempts
+    Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+    self._lock = Lock()
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self._db:
+      self._db.execute("CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, title TEXT NOT NULL, status TEXT NOT NULL, stage TEXT NOT NULL DEFAULT '', reason TEXT NOT NULL DEFAULT '', attempts INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)")
+
+  def get(self, key: str) -> JobRecord | None:
+    with self._lock:
+      row = self._db.execute("SELECT key, title, status, stage, reason, attempts, updated FROM jobs WHERE key = ?", (key,)).fetchone()
+    return JobRecord(*row) if row is not None else None
+
+  def _update(self, key: str, **columns) -> None:
+    columns["updated"] = time.time()
+    with self._lock, self._db:
+      self._db.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in columns)} WHERE key = ?", (*columns.values(), key))
+
+  # whether a job still has to be rendered, adds new jobs to the store. a known job gets its first title back
+  def should_render(self, job: "RenderJob") -> bool:
+    with self._lock, self._db:
+      self._db.execute("INSERT OR IGNORE INTO jobs (key, title, status, updated) VALUES (?, ?, 'pending', ?)", (job.key, job.title, time.time()))
+    record = self.get(job.key)
+    assert record is not None
+    job.title = record.title
+    if record.status in FINAL_STATUSES:
+      Log.verbose(f"Skipping video #{job.index}, already {record.status}{': ' + record.reason if record.reason else ''}")
+      return False
+    if record.status == "failed" and record.attempts >= self.max_attempts:
+      Log.verbose(f"Skipping video #{job.index}, failed {record.attempts} times: {record.reason}")
+      return False
+    return True
+
+  # rejected before rendering, e.g. by the length prefilter
+  def filter(self, job: "RenderJob", reason: str) -> None:
+    self._update(job.key, status="filtered", reason=reason)
+
+  def _checkpoint_path(self, job: "RenderJob") -> str:
+    return os.path.join(self.checkpoint_dir, job.key[:2], job.key)
+
+  # start rendering a job, returns the index of the stage to continue with after restoring its last checkpoint
+  def begin(self, job: "RenderJob", stage_names: list[str]) -> int:
+    record = self.get(job.key)
+    with self._lock, self._db:
+      self._db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated = ? WHERE key = ?", (time.time(), job.key))
+    if record is None or record.stage not in stage_names or not self._restore(job):
+      return 0
+    Log.info(f"Resuming video #{job.index} after stage '{record.stage}'")
+    return stage_names.index(record.stage) + 1
+
+  # save the job's fields and work files after `stage` completed
+  def complete(self, job: "RenderJob", stage: str, last: bool = False) -> None:
+    checkpoint = self._checkpoint_path(job)
+    if last:
+      shutil.rmtree(checkpoint, ignore_errors=True)
+      self._update(job.key, status="done", stage=stage, reason="")
+      return
+
+    # write into a fresh directory and swap it in, a crash never leaves a half written checkpoint
+    temp_checkpoint = f"{checkpoint}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_checkpoint, ignore_errors=True)
+    Path(temp_checkpoint).mkdir(parents=True)
+    state = {name: getattr(job, name) for name in CHECKPOINT_FIELDS}
+    for name in CHECKPOINT_FILES:
+      if os.path.exists(os.path.join(job.work_dir, name)):
+        shutil.copyfile(os.path.join(job.work_dir, name), os.path.join(temp_checkpoint, name))
+    # speech that is only in memory so far
+    state["waveform"] = job.waveform is not None
+    if job.waveform is not None:
+      write_wav(os.path.join(temp_checkpoint, "waveform.wav"), job.waveform, job.sample_rate)
+    with open(os.path.join(temp_checkpoint, "job.json"), "w", encoding="utf-8") as f:
+      json.dump(state, f)
+    shutil.rmtree(checkpoint, ignore_errors=True)
+    os.replace(temp_checkpoint, checkpoint)
+    self._update(job.key, stage=stage)
+
+  def _restore(self, job: "RenderJob") -> bool:
+    from chunked_tts import SpeechChunk
+
+    checkpoint = self._checkpoint_path(job)
+    try:
+      with open(os.path.join(checkpoint, "job.json"), "r", encoding="utf-8") as f:
+        state = json.load(f)
+    except (OSError, ValueError) as ex:
+      Log.warn(f"Could not restore the checkpoint of video #{job.index}, starting over")
+      Log.warn(ex)
+      return False
+
+    Path(job.work_dir).mkdir(parents=True, exist_ok=True)
+    for name in CHECKPOINT_FILES:
+      if os.path.exists(os.path.join(checkpoint, name)):
+        shutil.copyfile(os.path.join(checkpoint, name), os.path.join(job.work_dir, name))
+    for name in CHECKPOINT_FIELDS:
+      setattr(job, name, state[name])
+    job.word_timings = [(start, word) for start, word in job.word_timings]
+    job.tts_word_timings = [(start, word) for start, word in job.tts_word_timings]
+    job.chunks = [SpeechChunk(*chunk) for chunk in job.chunks]
+    if state["waveform"]:
+      job.waveform, job.sample_rate = read_wav(os.path.join(checkpoint, "waveform.wav"))
+    return True
+
+  # a stage stopped the job. rejections (job.rejection set) are final, failures are retried by a later run
+  def stop(self, job: "RenderJob", stage: str, reason: str = "") -> None:
+    if job.rejection:
+      shutil.rmtree(self._checkpoint_path(job), ignore_errors=True)
+      self._update(job.key, status="rejected", reason=f"{stage}: {job.rejection}")
+    else:
+      self._update(job.key, status="failed", reason=f"{stage}: {reason or 'stage failed'}")
+
+  # number of jobs per status
+  def summary(self) -> dict[str, int]:
+    with self._lock:
+      return dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+# wrap render stages so every job is checkpointed in `store` after each stage and continues after its last
+# checkpoint, stages before it are skipped
+def checkpoint_stages(stages: list[tuple[str, "RenderStage"]], store: JobStore) -> list[tuple[str, "RenderStage"]]:
+  names = [name for name, _ in stages]
+
+  def wrap(stage_index: int, name: str, stage: "RenderStage") -> "RenderStage":
+    def run(job: "RenderJob") -> bool:
+      if stage_index == 0:
+        job.resume_stage = store.begin(job, names)
+      if stage_index < job.resume_stage:
+        return True
+      try:
+        ok = stage(job)
+      except Exception as ex:
+        store.stop(job, name, str(ex))
+        raise
+      if ok:
+        store.complete(job, name, last=stage_index == len(stages) - 1)
+      else:
+        store.stop(job, name)
+      return ok
+    return run
+
+  return [(name, wrap(i, name, stage)) for i, (name, stage) in enumerate(stages)]
+
+# the store at JOB_STORE_PATH, or None if job state is not kept
+def open_job_store() -> JobStore | None:
+  return JobStore() if JOB_STORE_PATH else None
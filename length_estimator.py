@@ -0,0 +1,125 @@
+import json
+import os
+import re
+from pathlib import Path
+from threading import Lock
+
+from util import Log
+from consts import SPEECH_SPEED, MIN_VIDEO_LENGTH, MAX_VIDEO_LENGTH, LENGTH_MODEL_PATH, LENGTH_ESTIMATE_MARGIN
+
+# keep only the most recent samples so the model follows changes to the TTS setup
+MAX_SAMPLES = 2000
+
+# number of samples needed before the fitted model replaces the defaults
+MIN_SAMPLES_TO_FIT = 20
+
+# default seconds of speech (before speed up) per (character, word, pause), roughly what ljspeech vits produces
+DEFAULT_COEFFICIENTS = [0.065, 0.0, 0.25, 0.5]
+
+# features used to predict speech length: (spoken characters, words, pauses)
+def text_features(text: str) -> list[float]:
+  return [
+    float(sum(1 for c in text if c.isalnum())),
+    float(len(text.split())),
+    float(len(re.findall(r"[.!?,;:]+(?:\s|$)", text))),
+  ]
+
+# solve the least squares fit y = X * coefficients with a tiny ridge term to keep it stable
+def _fit(rows: list[list[float]], targets: list[float]) -> list[float]:
+  n = len(rows[0])
+  # normal equations (X^T X + ridge) c = X^T y
+  a = [[sum(row[i] * row[j] for row in rows) + (1e-6 if i == j else 0.0) for j in range(n)] for i in range(n)]
+  b = [sum(row[i] * y for row, y in zip(rows, targets)) for i in range(n)]
+
+  # gaussian elimination with partial pivoting
+  for col in range(n):
+    pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+    a[col], a[pivot] = a[pivot], a[col]
+    b[col], b[pivot] = b[pivot], b[col]
+    if abs(a[col][col]) < 1e-12:
+      raise ValueError("Samples are degenerate, can not fit length model")
+    for r in range(col + 1, n):
+      factor = a[r][col] / a[col][col]
+      for c in range(col, n):
+        a[r][c] -= factor * a[col][c]
+      b[r] -= factor * b[col]
+
+  coefficients = [0.0] * n
+  for r in reversed(range(n)):
+    coefficients[r] = (b[r] - sum(a[r][c] * coefficients[c] for c in range(r + 1, n))) / a[r][r]
+  return coefficients
+
+# predicts the final (after SPEECH_SPEED) speech length of text without running TTS, calibrated from
+# the measured lengths of previous renders, so obviously too short / long content can be skipped up front
+class LengthEstimator:
+  def __init__(self, model_path: str = LENGTH_MODEL_PATH):
+    self.model_path = model_path
+    self.coefficients = DEFAULT_COEFFICIENTS[:]
+    self.margin = LENGTH_ESTIMATE_MARGIN
+    self.samples: list[list[float]] = [] # list of [*features, seconds before speed up]
+    self._unsaved = 0
+    self._lock = Lock()
+
+    if os.path.exists(model_path):
+      try:
+        with open(model_path, "r") as f:
+          self.samples = json.load(f)["samples"][-MAX_SAMPLES:]
+        self.refit()
+      except (OSError, ValueError, KeyError) as ex:
+        Log.warn(f"Could not load length model from '{model_path}', using defaults")
+        Log.warn(ex)
+
+  # fit coefficients and the relative error margin from the recorded samples
+  def refit(self) -> None:
+    if len(self.samples) < MIN_SAMPLES_TO_FIT:
+      return
+    rows = [sample[:-1] + [1.0] for sample in self.samples]
+    targets = [sample[-1] for sample in self.samples]
+    try:
+      self.coefficients = _fit(rows, targets)
+    except ValueError as ex:
+      Log.warn(ex)
+      return
+
+    # margin covers twice the typical relative error, but never less than the configured margin
+    errors = [abs(self._raw_prediction(row[:-1]) - y) / y for row, y in zip(rows, targets) if y > 0]
+    if errors:
+      mean_square = sum(e * e for e in errors) / len(errors)
+      self.margin = max(LENGTH_ESTIMATE_MARGIN, 2 * mean_square ** 0.5)
+    Log.verbose(f"Length model fitted on {len(self.samples)} samples, margin {self.margin:.0%}")
+
+  def _raw_prediction(self, features: list[float]) -> float:
+    return sum(c * x for c, x in zip(self.coefficients, features + [1.0]))
+
+  # predicted speech length in seconds after applying SPEECH_SPEED
+  def predict(self, text: str) -> float:
+    return max(0.0, self._raw_prediction(text_features(text))) / SPEECH_SPEED
+
+  # False only if the content is outside of the desired length even allowing for the prediction error,
+  # borderline content passes and is checked again after TTS
+  def should_render(self, text: str) -> bool:
+    predicted = self.predict(text)
+    if MIN_VIDEO_LENGTH != -1 and predicted * (1 + self.margin) < MIN_VIDEO_LENGTH:
+      return False
+    if MAX_VIDEO_LENGTH != -1 and predicted * (1 - self.margin) > MAX_VIDEO_LENGTH:
+      return False
+    return True
+
+  # add the measured final length of rendered speech for text
+  def record(self, text: str, speech_length: float) -> None:
+    if speech_length <= 0:
+      return
+    with self._lock:
+      self.samples.append(text_features(text) + [speech_length * SPEECH_SPEED])
+      self.samples = self.samples[-MAX_SAMPLES:]
+      self._unsaved += 1
+      # refit and save every so often, fitting is cheap but not free
+      if self._unsaved >= MIN_SAMPLES_TO_FIT:
+        self.refit()
+        self.save()
+
+  def save(self) -> None:
+    Path(os.path.dirname(self.model_path) or ".").mkdir(parents=True, exist_ok=True)
+    with open(self.model_path, "w") as f:
+      json.dump({"samples": self.samples}, f)
+    self._unsaved = 0
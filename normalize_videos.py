@@ -1,37 +1,134 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import subprocess
+import shutil
 import os
 from sys import exit as sysexit
 
-from util import Log, validate_file_extension, get_video_length, add_hwaccel_to_ffmpeg_command
-from consts import CLIP_LENGTH, FPS, WIDTH, HEIGHT, FFMPEG_ACCELERATION, FFMPEG_VIDEO_BITRATE
+from util import Log, validate_file_extension, probe_video, add_hwaccel_to_ffmpeg_command, encoder_args, set_concurrent_encodes
+from clip_manifest import ClipManifest, SourceVideo, Clip, quick_file_hash
+from ffmpeg_runner import FfmpegError, run_ffmpeg, format_stats
+from consts import CLIP_LENGTH, FPS, WIDTH, HEIGHT, FFMPEG_ACCELERATION, NORMALIZE_WORKERS
 
 # widescreen (crop sides): ffmpeg -i screen-20250315-125016.mp4 -r 60 -vf 'crop=ih/16*9:ih,scale=1080:1920' ../video/bkg0.mp4
 # naive scale: ffmpeg -i tmp.mp4 -r 60 -vf 'scale=1080:1920' bkg0.mp4
 
-def render_video_split(filename: str, start_time: int, output_filename: str) -> None:
+# widescreen sources are cropped to 9:16 (better result), narrower ones are squished to keep all content
+def build_normalize_filter(width: int, height: int) -> str:
+  if width * 16 >= height * 9:
+    return f"crop=ih/16*9:ih,scale={WIDTH}:{HEIGHT}"
+  return f"scale={WIDTH}:{HEIGHT}"
+
+# offsets in seconds of the clips taken from a source, skipping the first and last clip
+def split_offsets(duration: float) -> list[int]:
+  return list(range(CLIP_LENGTH, int(duration) - CLIP_LENGTH, CLIP_LENGTH))
+
+# decode the source once and write every clip with the segment muxer, keyframes are forced at every clip boundary
+def build_split_command(filename: str, start_time: int, num_clips: int, video_filter: str, output_pattern: str) -> list[str]:
+  return add_hwaccel_to_ffmpeg_command(["ffmpeg", "-ss", str(start_time), "-i", filename, "-t", str(num_clips * CLIP_LENGTH),
+    "-r", str(FPS), "-vf", video_filter] + encoder_args() + [
+    "-force_key_frames", f"expr:gte(t,n_forced*{CLIP_LENGTH})",
+    "-f", "segment", "-segment_time", str(CLIP_LENGTH), "-segment_format", "mp4", "-reset_timestamps", "1",
+    "-y", output_pattern], FFMPEG_ACCELERATION)
+
+# probe and fingerprint a source video for the clip manifest
+def describe_source(filename: str) -> SourceVideo:
+  width, height, duration, fps = probe_video(filename)
+  stat = os.stat(filename)
+  return SourceVideo(filename, stat.st_mtime, stat.st_size, quick_file_hash(filename), width, height, duration, fps)
+
+# split one source video into clips named `<name>_<offset>.mp4`, returns the source and the clips written
+# or None if ffmpeg failed. sources too short to split have no clips
+def split_video(filename: str, splits_dir: str = "./video/splits") -> tuple[SourceVideo, list[Clip]] | None:
+  source = describe_source(filename)
+  offsets = split_offsets(source.duration)
+  if len(offsets) == 0:
+    Log.warn(f"Skipping '{filename}', it is too short to split into {CLIP_LENGTH}s clips")
+    return (source, [])
+
+  video_name, _ = os.path.splitext(os.path.basename(filename))
+  video_filter = build_normalize_filter(source.width, source.height)
+  Log.info(f"Splitting {filename} ({source.width}x{source.height}, {source.duration:.0f}s) into {len(offsets)} clips using '{video_filter}'")
+
+  # write segments to a temporary folder first so a failed split never looks like a finished one
+  temp_dir = os.path.join(splits_dir, f".tmp-{video_name}")
+  shutil.rmtree(temp_dir, ignore_errors=True)
+  Path(temp_dir).mkdir(parents=True)
   try:
-    # try widescreen crop first (better result)
-    command = add_hwaccel_to_ffmpeg_command(["ffmpeg", "-ss", str(start_time), "-i", filename, "-r", str(FPS), "-t", str(CLIP_LENGTH), "-vf", f"crop=ih/16*9:ih,scale={WIDTH}:{HEIGHT}", "-b:v", FFMPEG_VIDEO_BITRATE, output_filename], FFMPEG_ACCELERATION)
-    subprocess.run(command, check=True)
-  except subprocess.CalledProcessError as ex1:
-    # try naive scale if fails
-    try:
-      # first, remove empty failed container
+    command = build_split_command(filename, offsets[0], len(offsets), video_filter, os.path.join(temp_dir, "%06d.mp4"))
+    Log.info(format_stats(run_ffmpeg(command, f"split {video_name}", duration=len(offsets) * CLIP_LENGTH)))
+
+    clips = []
+    for i, offset in enumerate(offsets):
+      segment = os.path.join(temp_dir, f"{i:06d}.mp4")
+      if os.path.exists(segment):
+        clip_file = os.path.join(splits_dir, f"{video_name}_{offset}.mp4")
+        os.replace(segment, clip_file)
+        clips.append(Clip(clip_file, filename, offset, CLIP_LENGTH, WIDTH, HEIGHT, FPS, os.path.getsize(clip_file)))
+    return (source, clips)
+  except FfmpegError as ex:
+    Log.error(f"Failed to split video '{filename}'")
+    Log.error(ex)
+    Log.error(ex.log)
+    return None
+  finally:
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+# whether a source still has to be split, sources only probed for virtual clips have no splits yet
+def needs_split(manifest: ClipManifest, filename: str) -> bool:
+  if not manifest.is_unchanged(filename):
+    return True
+  source = manifest.get_source(filename)
+  return source is not None and len(split_offsets(source.duration)) > 0 and not manifest.has_clips(filename)
+
+# add splits made before the manifest existed (found by name) so their sources are not split again
+def import_existing_splits(manifest: ClipManifest, videos: list[str], splits_dir: str = "./video/splits") -> int:
+  splits_by_name: dict[str, list[str]] = {}
+  for split in os.listdir(splits_dir):
+    if split.rfind("_") != -1 and validate_file_extension(split):
+      splits_by_name.setdefault(split[:split.rfind("_")], []).append(split)
+
+  num_imported = 0
+  for video in videos:
+    filename = "./video/" + video
+    video_name, _ = os.path.splitext(video)
+    if video_name not in splits_by_name or manifest.has_clips(filename):
+      continue
+    clips = []
+    for split in splits_by_name[video_name]:
       try:
-        os.remove(output_filename)
-      except FileNotFoundError:
-        # did not get created at all <-- okay
-        pass
-      # then run naive scale (simple squish)
-      command = add_hwaccel_to_ffmpeg_command(["ffmpeg", "-ss", str(start_time), "-i", filename, "-r", str(FPS), "-t", str(CLIP_LENGTH), "-vf", f"scale={WIDTH}:{HEIGHT}", "-b:v", FFMPEG_VIDEO_BITRATE, output_filename], FFMPEG_ACCELERATION)
-      subprocess.run(command, check=True)
-    except subprocess.CalledProcessError as ex2:
-      Log.error(f"Failed to split video '{filename}'")
-      Log.error(ex1)
-      Log.error(ex2)
-      return
-  Log.info(f"Successfully exported {filename} to {output_filename}")
+        offset = float(split[split.rfind("_") + 1:split.rfind(".")])
+      except ValueError:
+        continue
+      clip_file = os.path.join(splits_dir, split)
+      clips.append(Clip(clip_file, filename, offset, CLIP_LENGTH, WIDTH, HEIGHT, FPS, os.path.getsize(clip_file)))
+    manifest.add_source(describe_source(filename), clips)
+    num_imported += 1
+  return num_imported
+
+# virtual clips of every source in `video_dir`, cut and normalized while rendering instead of split up front.
+# source probes are kept in the clip manifest so only new or changed sources are probed
+def load_virtual_clip_pool(video_dir: str = "./video") -> list[Clip]:
+  manifest = ClipManifest()
+  clips = []
+  try:
+    for video in sorted(os.listdir(video_dir)):
+      filename = os.path.join(video_dir, video)
+      if not os.path.isfile(filename) or not validate_file_extension(video):
+        continue
+      source = manifest.get_source(filename)
+      if source is None or not manifest.is_unchanged(filename):
+        try:
+          source = describe_source(filename)
+        except (subprocess.CalledProcessError, KeyError, IndexError, ValueError) as ex:
+          Log.error(f"Failed to probe video '{filename}', skipping it")
+          Log.error(ex)
+          continue
+        manifest.add_source(source, [])
+      clips.extend(Clip(filename, filename, offset, CLIP_LENGTH, source.width, source.height, source.fps, 0) for offset in split_offsets(source.duration))
+  finally:
+    manifest.close()
+  return clips
 
 def normalize_all():
   videos = []
@@ -45,27 +142,44 @@ def normalize_all():
 
   Log.info(f"Beginning processing of {len(videos)} videos: {videos}")
 
-  # extract splits that already exist and skip later
   Path("./video/splits").mkdir(parents=True, exist_ok=True)
-  existing_splits = os.listdir("./video/splits")
-  existing_splits = list(set([video[:video.rfind("_")] + ".mp4" for video in existing_splits if video.rfind("_") != -1]))
+  manifest = ClipManifest()
+  num_imported = import_existing_splits(manifest, videos)
+  if num_imported > 0:
+    Log.info(f"Added existing splits of {num_imported} videos to the clip manifest")
+  num_pruned = manifest.prune_missing()
+  if num_pruned > 0:
+    Log.info(f"Removed {num_pruned} deleted clips from the clip manifest")
 
-  num_skipped = 0
+  # skip sources that were split before and have not changed since
+  to_process = [video for video in videos if needs_split(manifest, "./video/" + video)]
+  num_skipped = len(videos) - len(to_process)
+  if num_skipped > 0:
+    Log.info(f"Skipping {num_skipped} videos, splits already exist for them")
+
+  # each source is decoded by one ffmpeg process, run a few sources at once and split the cores between them
   num_processed = 0
+  with ProcessPoolExecutor(max_workers=max(1, NORMALIZE_WORKERS), initializer=set_concurrent_encodes, initargs=(NORMALIZE_WORKERS,)) as pool:
+    futures = {pool.submit(split_video, "./video/" + video): video for video in to_process}
+    for i, future in enumerate(as_completed(futures)):
+      video = futures[future]
+      try:
+        result = future.result()
+      except Exception as ex:
+        Log.error(f"Failed to split video '{video}'")
+        Log.error(ex)
+        continue
+      if result is None:
+        continue
+      # sources too short to split are recorded too, so they are not probed again next time
+      source, clips = result
+      manifest.add_source(source, clips)
+      Log.info(f"Processed video {i+1}/{len(to_process)}: {video} ({len(clips)} clips)")
+      num_processed += 1
 
-  # process all videos
-  for i, video in enumerate(videos):
-    Log.info(f"Processing video {i+1}/{len(videos)}: {video}")
-    if (video in existing_splits):
-      Log.info(f"Skipping, splits already exist for this video")
-      num_skipped += 1
-      continue
-    video_name, _ = os.path.splitext(video)
-    for j in range(CLIP_LENGTH, int(get_video_length("./video/" + video)) - CLIP_LENGTH, CLIP_LENGTH):
-      render_video_split("./video/" + video, j, f"./video/splits/{video_name}_{j}.mp4")
-    num_processed += 1
-  
+  Log.info(f"Clip manifest has {manifest.num_clips()} clips")
+  manifest.close()
   Log.info(f"Completed processing videos! Processed {num_processed} and skipped {num_skipped}")
 
 if __name__ == "__main__":
-  normalize_all()
\ No newline at end of file
+  normalize_all()
@@ -0,0 +1,133 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+import multiprocessing
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Thread
+from typing import Callable, Iterable
+
+from util import Log, set_concurrent_encodes
+from aligners import create_aligner
+from artifact_cache import ArtifactCache
+from clip_scheduler import ClipScheduler
+from chunked_tts import ChunkedSynthesizer
+from consts import TTS_CHUNKED, ALIGNER, ALIGNER_FALLBACK_TO_GENTLE, CACHE_ENABLED, BACKGROUND_REELS, JOB_STORE_PATH, PARALLEL_LOOKAHEAD, CONTENT_POLL_INTERVAL
+from render_video import RenderJob, RenderStage, load_tts, build_render_stages, run_stages, encodes_per_render
+from reels import ReelIndex
+from job_store import JobStore
+
+# marks the end of the jobs read for `run_parallel`
+_END_OF_JOBS = None
+
+# seconds to wait for the next job while filling the lookahead, a file that is already written reads much faster
+_ARRIVAL_WAIT = 0.1
+
+# per worker process state, set up once by `_init_worker`
+_worker_stages: list[tuple[str, RenderStage]] = []
+
+def _init_worker(gentle_url: str, clips: ClipScheduler, num_workers: int) -> None:
+  global _worker_stages
+
+  # split cpu threads between workers so torch does not oversubscribe the machine
+  import torch
+  torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+  # and the same for ffmpeg, every worker encodes at the same time
+  set_concurrent_encodes(num_workers * encodes_per_render())
+
+  # each worker loads the TTS model once and reuses it for every job it is given
+  # chunked synthesis runs in order on the worker's own model since workers can not start a pool of their own
+  tts = load_tts()
+  synthesizer = ChunkedSynthesizer(tts, 1) if TTS_CHUNKED else None
+  aligner = create_aligner(ALIGNER, gentle_url, ALIGNER_FALLBACK_TO_GENTLE)
+  cache = ArtifactCache() if CACHE_ENABLED else None
+  # reels are rendered by the parent before the workers start, workers only reserve segments
+  reels = ReelIndex() if BACKGROUND_REELS else None
+  # the parent decides which jobs to render, workers checkpoint them in the same store
+  store = JobStore() if JOB_STORE_PATH else None
+  _worker_stages = build_render_stages(aligner, tts, clips, synthesizer=synthesizer, cache=cache, reels=reels, store=store)
+
+# render one job inside a worker, in a scratch directory that is removed afterwards
+# returns (exported, job) so the caller sees what the stages measured
+def _render_job(job: RenderJob) -> tuple[bool, RenderJob]:
+  Path("./work").mkdir(parents=True, exist_ok=True)
+  job.work_dir = tempfile.mkdtemp(prefix=f"job-{job.index}-", dir="./work")
+  try:
+    return (run_stages(job, _worker_stages), job)
+  except Exception as ex:
+    Log.error(f"An error occurred trying to render video #{job.index} - {job.title}")
+    Log.error(ex)
+    return (False, job)
+  finally:
+    shutil.rmtree(job.work_dir, ignore_errors=True)
+
+# render jobs on a pool of worker processes. jobs are read on a thread, up to `lookahead` ahead of the workers,
+# and of those the longest by `predict_length` is submitted next so long renders start early and all workers
+# finish at about the same time. only as many jobs as there are workers are submitted at once, so later jobs can
+# still be sorted in. a tailed .jsonl file is rendered while it grows. returns the number of exported videos
+# `clips` has to be a `SchedulerManager` proxy so all workers draw from the same rotation
+def run_parallel(jobs: Iterable[RenderJob], gentle_url: str, clips: ClipScheduler, num_workers: int, predict_length: Callable[[RenderJob], float], on_finish: Callable[[RenderJob, bool], None] | None = None, lookahead: int = PARALLEL_LOOKAHEAD) -> int:
+  num_workers = max(1, num_workers)
+  lookahead = max(1, lookahead)
+  num_exported = 0
+
+  # reading a tailed file blocks until the scraper appends the next record, so it happens on its own thread
+  arrivals: Queue = Queue(maxsize=1)
+
+  def feed() -> None:
+    try:
+      for job in jobs:
+        arrivals.put(job)
+    except Exception as ex:
+      Log.error("An error occurred reading the jobs to render")
+      Log.error(ex)
+    finally:
+      arrivals.put(_END_OF_JOBS)
+  Thread(target=feed, name="parallel-feed", daemon=True).start()
+
+  waiting: list[tuple[float, RenderJob]] = [] # (predicted length, job) read but not submitted yet
+  futures: dict[Future, RenderJob] = {}
+  reading = True
+  num_done = 0
+
+  # spawn instead of fork, torch does not survive being forked after initialization
+  context = multiprocessing.get_context("spawn")
+  with ProcessPoolExecutor(max_workers=num_workers, mp_context=context, initializer=_init_worker, initargs=(gentle_url, clips, num_workers)) as pool:
+    while reading or len(waiting) > 0 or len(futures) > 0:
+      # fill the lookahead with what was read, only wait for the next job when nothing else is left to do
+      while reading and len(waiting) < lookahead:
+        try:
+          job = arrivals.get(timeout=None if len(waiting) == 0 and len(futures) == 0 else _ARRIVAL_WAIT)
+        except Empty:
+          break
+        if job is _END_OF_JOBS:
+          reading = False
+        else:
+          waiting.append((predict_length(job), job))
+
+      waiting.sort(key=lambda item: item[0])
+      while len(waiting) > 0 and len(futures) < num_workers:
+        _, job = waiting.pop()
+        futures[pool.submit(_render_job, job)] = job
+      if len(futures) == 0:
+        continue
+
+      # with an idle worker, check for newly read jobs every now and then
+      done, _ = wait(futures, timeout=CONTENT_POLL_INTERVAL if reading and len(futures) < num_workers else None, return_when=FIRST_COMPLETED)
+      for future in done:
+        job = futures.pop(future)
+        try:
+          exported, job = future.result()
+        except Exception as ex:
+          # worker process died, e.g. out of memory
+          Log.error(f"Worker failed trying to render video #{job.index} - {job.title}")
+          Log.error(ex)
+          exported = False
+        num_done += 1
+        num_exported += int(exported)
+        if on_finish is not None:
+          on_finish(job, exported)
+        Log.info(f"Finished {num_done} videos, {len(futures) + len(waiting)} in flight or waiting ({'exported' if exported else 'not exported'}: '{job.title}')")
+
+  return num_exported
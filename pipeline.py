@@ -0,0 +1,79 @@
+from queue import Queue
+from threading import Thread, Lock
+from typing import Callable, Iterable
+
+from util import Log
+from render_video import RenderJob, RenderStage
+
+# marks the end of the job stream on a stage queue
+_END_OF_JOBS = None
+
+# runs jobs through the render stages with every stage on its own worker thread(s), connected by bounded
+# queues. this lets job N+1 go through TTS and alignment while job N is still encoding, so the total time
+# tends toward the slowest stage instead of the sum of all stages. returns the number of exported videos
+def run_pipeline(jobs: Iterable[RenderJob], stages: list[tuple[str, RenderStage]], queue_size: int = 2, stage_workers: dict[str, int] | None = None, on_finish: Callable[[RenderJob, bool], None] | None = None) -> int:
+  queues: list[Queue] = [Queue(maxsize=max(1, queue_size)) for _ in stages]
+  stage_workers = stage_workers or {}
+  workers_left = [max(1, stage_workers.get(name, 1)) for name, _ in stages]
+  lock = Lock()
+  num_exported = 0
+
+  def finish(job: RenderJob, exported: bool) -> None:
+    if on_finish is not None:
+      try:
+        on_finish(job, exported)
+      except Exception as ex:
+        Log.error(f"An error occurred cleaning up video #{job.index} - {job.title}")
+        Log.error(ex)
+
+  def work(stage_index: int) -> None:
+    nonlocal num_exported
+    name, stage = stages[stage_index]
+    inbox = queues[stage_index]
+    outbox = queues[stage_index + 1] if stage_index + 1 < len(stages) else None
+
+    while True:
+      job = inbox.get()
+      if job is _END_OF_JOBS:
+        # put the marker back for sibling workers, last worker out passes it downstream
+        with lock:
+          workers_left[stage_index] -= 1
+          is_last = workers_left[stage_index] == 0
+        if not is_last:
+          inbox.put(_END_OF_JOBS)
+        elif outbox is not None:
+          outbox.put(_END_OF_JOBS)
+        return
+
+      try:
+        ok = stage(job)
+      except Exception as ex:
+        Log.error(f"An error occurred in stage '{name}' trying to render video #{job.index} - {job.title}")
+        Log.error(ex)
+        ok = False
+
+      if not ok:
+        finish(job, False)
+      elif outbox is not None:
+        outbox.put(job)
+      else:
+        with lock:
+          num_exported += 1
+        finish(job, True)
+
+  threads: list[Thread] = []
+  for i, (name, _) in enumerate(stages):
+    for j in range(workers_left[i]):
+      thread = Thread(target=work, args=(i,), name=f"stage-{name}-{j}", daemon=True)
+      thread.start()
+      threads.append(thread)
+
+  # feeding blocks once the first queue is full, so only a bounded number of jobs are in flight
+  for job in jobs:
+    queues[0].put(job)
+  queues[0].put(_END_OF_JOBS)
+
+  for thread in threads:
+    thread.join()
+
+  return num_exported
@@ -0,0 +1,156 @@
+import os
+import random
+import sqlite3
+import subprocess
+import time
+from pathlib import Path
+from threading import Lock
+
+from util import Log, add_hwaccel_to_ffmpeg_command, encoder_args, set_concurrent_encodes
+from clip_manifest import Clip, clip_id
+from ffmpeg_runner import FfmpegError, FfmpegProcess, format_stats
+from render_video import pipe_windows
+from consts import CLIP_LENGTH, XFADE_LENGTH, WIDTH, HEIGHT, FPS, FFMPEG_ACCELERATION, REEL_DIR, REEL_CLIPS
+
+# length in seconds of `num_clips` clips joined with crossfades
+def reel_length(num_clips: int) -> float:
+  return num_clips * CLIP_LENGTH - (num_clips - 1) * XFADE_LENGTH
+
+# encode a reel from the crossfaded background windows piped in as mpegts, see `pipe_windows`. keyframes
+# every second keep seeking to a random offset cheap
+def build_reel_command(output_file: str) -> list[str]:
+  return ["ffmpeg", "-f", "mpegts", "-i", "pipe:0", "-map", "0:v", "-an", "-r", str(FPS), "-force_key_frames", "expr:gte(t,n_forced)", "-f", "mp4", "-y"] + encoder_args() + [output_file]
+
+# long background reels pre-rendered from the clip pool, so a render takes one reel input at an offset
+# instead of opening and crossfading dozens of clips. time handed out to renders is reserved so videos
+# in a batch do not share background footage, once every reel is used up the reservations start over
+class ReelIndex:
+  def __init__(self, reel_dir: str = REEL_DIR):
+    self.reel_dir = reel_dir
+    Path(reel_dir).mkdir(parents=True, exist_ok=True)
+    self._lock = Lock()
+    self._db = sqlite3.connect(os.path.join(reel_dir, "index.sqlite"), timeout=30, check_same_thread=False)
+    with self._db:
+      self._db.execute("CREATE TABLE IF NOT EXISTS reels (id INTEGER PRIMARY KEY, path TEXT NOT NULL, duration REAL NOT NULL, created REAL NOT NULL)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS reel_clips (clip TEXT PRIMARY KEY, reel INTEGER NOT NULL)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS reservations (reel INTEGER NOT NULL, start REAL NOT NULL, end REAL NOT NULL)")
+
+  # list of (id, path, duration) of all reels
+  def reels(self) -> list[tuple[int, str, float]]:
+    with self._lock:
+      return self._db.execute("SELECT id, path, duration FROM reels ORDER BY id").fetchall()
+
+  # pool entries not in any reel yet
+  def unused_clips(self, pool: list[str] | list[Clip]) -> list[str | Clip]:
+    with self._lock:
+      used = set(clip for (clip,) in self._db.execute("SELECT clip FROM reel_clips"))
+    return [clip for clip in pool if clip_id(clip) not in used]
+
+  # render a reel from `clips` and add it to the index, returns False if ffmpeg failed. the clips are crossfaded
+  # window by window like streaming composition, so at most two of them are decoded at a time however long the reel is
+  def add_reel(self, clips: list[str] | list[Clip]) -> bool:
+    with self._lock:
+      reel_id = self._db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM reels").fetchone()[0]
+    output_file = os.path.join(self.reel_dir, f"reel-{reel_id:04d}.mp4")
+    temp_file = os.path.join(self.reel_dir, f".reel-{reel_id:04d}.{os.getpid()}.mp4")
+
+    cmd = add_hwaccel_to_ffmpeg_command(build_reel_command(temp_file), FFMPEG_ACCELERATION)
+    Log.info(f"Rendering background reel #{reel_id} from {len(clips)} clips ({reel_length(len(clips)):.0f}s)")
+    try:
+      encoder = FfmpegProcess(cmd, f"reel #{reel_id}", temp_file, reel_length(len(clips)), stdin=subprocess.PIPE)
+      pipe_windows(encoder, clips, f"reel #{reel_id}")
+      Log.info(format_stats(encoder.wait()))
+    except FfmpegError as e:
+      Log.error("Error rendering background reel with ffmpeg: " + str(e))
+      Log.error(e.log)
+      try:
+        os.remove(temp_file)
+      except FileNotFoundError:
+        pass
+      return False
+    os.replace(temp_file, output_file)
+
+    with self._lock, self._db:
+      self._db.execute("INSERT INTO reels (id, path, duration, created) VALUES (?, ?, ?, ?)", (reel_id, output_file, reel_length(len(clips)), time.time()))
+      self._db.executemany("INSERT OR REPLACE INTO reel_clips (clip, reel) VALUES (?, ?)", [(clip_id(clip), reel_id) for clip in clips])
+    return True
+
+  # render reels from clips that arrived since the last update, returns the number of new reels.
+  # only full reels of `reel_clips` clips are made so leftovers wait for more clips, unless there are no reels yet
+  def update(self, pool: list[str] | list[Clip], reel_clips: int = REEL_CLIPS) -> int:
+    unused = self.unused_clips(pool)
+    random.shuffle(unused)
+    groups = [unused[i:i + reel_clips] for i in range(0, len(unused), reel_clips)]
+    if len(groups) > 0 and len(groups[-1]) < reel_clips and (len(self.reels()) > 0 or len(groups) > 1):
+      groups.pop()
+
+    num_added = 0
+    for group in groups:
+      if len(group) >= 2 and self.add_reel(group):
+        num_added += 1
+    return num_added
+
+  # free (start, end) spans of a reel given its reservations
+  @staticmethod
+  def _free_spans(duration: float, reserved: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    spans = []
+    position = 0.0
+    for start, end in sorted(reserved):
+      if start > position:
+        spans.append((position, start))
+      position = max(position, end)
+    if duration > position:
+      spans.append((position, duration))
+    return spans
+
+  def _pick_segment(self, length: float) -> tuple[int, str, float] | None:
+    candidates = [] # list of (reel id, path, earliest start, latest start)
+    for reel_id, path, duration in self._db.execute("SELECT id, path, duration FROM reels").fetchall():
+      reserved = self._db.execute("SELECT start, end FROM reservations WHERE reel = ?", (reel_id,)).fetchall()
+      for start, end in self._free_spans(duration, reserved):
+        if end - start >= length:
+          candidates.append((reel_id, path, start, end - length))
+    if len(candidates) == 0:
+      return None
+    # start near the beginning of a random free span, packing reels tightly while still varying the footage
+    reel_id, path, earliest, latest = random.choice(candidates)
+    return (reel_id, path, earliest + random.uniform(0, min(latest - earliest, CLIP_LENGTH)))
+
+  # reserve `length` seconds of reel at a random offset not handed out before, returned as a clip
+  # ready for `build_ffmpeg_command`. returns None if no reel is long enough
+  def reserve(self, length: float) -> Clip | None:
+    with self._lock, self._db:
+      # lock the database so parallel workers never get overlapping segments
+      self._db.execute("BEGIN IMMEDIATE")
+      if self._db.execute("SELECT COALESCE(MAX(duration), 0) FROM reels").fetchone()[0] < length:
+        return None
+      segment = self._pick_segment(length)
+      if segment is None and self._db.execute("SELECT COUNT(*) FROM reservations").fetchone()[0] > 0:
+        Log.info("All background reel time has been used, reusing reels")
+        self._db.execute("DELETE FROM reservations")
+        segment = self._pick_segment(length)
+      if segment is None:
+        return None
+      reel_id, path, offset = segment
+      offset = round(offset, 3)
+      self._db.execute("INSERT INTO reservations (reel, start, end) VALUES (?, ?, ?)", (reel_id, offset, offset + length))
+    return Clip(path, path, offset, length, WIDTH, HEIGHT, FPS, 0)
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+# render reels for any new clips in the pool, then return the index for rendering
+def open_reels(pool: list[str] | list[Clip]) -> ReelIndex:
+  # reels are rendered one at a time, each as a background window encode next to the reel encode
+  set_concurrent_encodes(2)
+  reels = ReelIndex()
+  num_added = reels.update(pool)
+  Log.info(f"Background reels: {len(reels.reels())} ({num_added} new)")
+  return reels
+
+if __name__ == "__main__":
+  from clip_manifest import load_clip_pool
+  from normalize_videos import load_virtual_clip_pool
+  from consts import CLIP_SOURCE
+  open_reels(load_virtual_clip_pool() if CLIP_SOURCE == "virtual" else load_clip_pool()).close()
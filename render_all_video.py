@@ -1,72 +1,220 @@
-import json
 from datetime import datetime
 from uuid import uuid4
 from random import randint, choice
 from TTS.api import TTS
 import os
+import shutil
 from sys import exit as sysexit
+from typing import Callable, Iterable, Iterator
 
-from util import Log, validate_audio_extension, validate_file_extension, clean_file_name, format_string, GpuDevice
-from render_video import render_video
-from consts import TITLE_FORMAT, CONTENT_FORMAT, FFMPEG_ACCELERATION, TTS_MODEL, GENTLE_URL, COMMENTS_START_INDEX, COMMENTS_END_INDEX, COMMENTS_FILE_PATH
+from util import Log, Metrics, set_concurrent_encodes, validate_audio_extension, clean_file_name, format_string
+from clip_manifest import load_clip_pool
+from clip_scheduler import ClipScheduler, SchedulerManager
+from normalize_videos import load_virtual_clip_pool
+from render_video import RenderJob, load_tts, build_render_stages, run_stages, encodes_per_render
+from aligners import Aligner, create_aligner
+from artifact_cache import ArtifactCache, cache_key, log_cache_stats
+from reels import ReelIndex, open_reels
+from content_stream import ContentProgress, latest_content_file, read_content
+from job_store import JobStore, open_job_store
+from fingerprints import content_fingerprint, open_fingerprint_index
+from chunked_tts import ChunkedSynthesizer, get_speaking_rate
+from length_estimator import LengthEstimator
+from pipeline import run_pipeline
+from parallel import run_parallel
+from consts import TITLE_FORMAT, CONTENT_FORMAT, GENTLE_URL, COMMENTS_START_INDEX, COMMENTS_END_INDEX, COMMENTS_FILE_PATH, RENDER_MODE, PIPELINE_QUEUE_SIZE, PIPELINE_STAGE_WORKERS, RENDER_WORKERS, TTS_CHUNKED, TTS_CHUNK_WORKERS, PREFILTER_BY_LENGTH, ALIGNER, ALIGNER_FALLBACK_TO_GENTLE, GENTLE_MAX_IN_FLIGHT, CACHE_ENABLED, CLIP_SOURCE, BACKGROUND_REELS
 
 # format title with supported tags by calling `format_string` internally
-def format_title(title: str, index: int = 0, mystr: str = "") -> str:
+def format_title(title: str, index: int = 0, mystr: str = "", fingerprint: str = "") -> str:
   cur_date = datetime.now().strftime("%m-%d-%y")
   random_uuid = str(uuid4())
   random_num = randint(1000, 9999)
-  return format_string(TITLE_FORMAT, title=title, date=cur_date, index=str(index), uuid=random_uuid, randnum=str(random_num), mystr=mystr)
+  return format_string(TITLE_FORMAT, title=title, date=cur_date, index=str(index), uuid=random_uuid, randnum=str(random_num), mystr=mystr, hash=fingerprint[:8])
 
-# render all videos in the specified json file
+# build a render job for the comment at `index` of the comments file
+def create_job(comment: dict[str, str], index: int, audio_pool: list[str], work_dir: str = "./work") -> RenderJob:
+  fingerprint = content_fingerprint(comment["comment_text"])
+  title = clean_file_name(format_title(comment["title"], index, fingerprint=fingerprint))
+  content = format_string(CONTENT_FORMAT, title=comment["title"], content=comment["comment_text"])
+  return RenderJob(title, content, choice(audio_pool) if audio_pool else None, work_dir, index, key=cache_key("job", comment["title"], comment["comment_text"]), fingerprint=fingerprint, raw_content=content)
+
+# save the metrics record of a finished job, see `Metrics`
+def write_job_metrics(job: RenderJob, exported: bool) -> None:
+  result = "exported" if exported else "rejected" if job.rejection else "failed"
+  job.metrics["counters"].update(speech_seconds=job.speech_length, video_seconds=job.video_length)
+  Metrics.write_record("render", result, job.metrics, index=job.index, title=job.title, key=job.key, rejection=job.rejection,
+                       resumed_after_stage=job.resume_stage, peak_rss=job.peak_rss, ffmpeg=[stats._asdict() for stats in job.ffmpeg_stats])
+
+# render comments with overlapping stages, every job gets its own work directory since several are in flight
+def render_pipelined(jobs: Iterable[RenderJob], aligner: Aligner, tts: TTS, synthesizer: ChunkedSynthesizer | None, cache: ArtifactCache | None, clips: ClipScheduler, reels: ReelIndex | None, store: JobStore | None, on_finish: Callable[[RenderJob, bool], None]) -> int:
+  def pipeline_jobs():
+    for job in jobs:
+      job.work_dir = f"./work/job-{job.index}"
+      Log.info(f"Queueing video #{job.index}: '{job.title}'")
+      yield job
+
+  def cleanup(job: RenderJob, exported: bool) -> None:
+    shutil.rmtree(job.work_dir, ignore_errors=True)
+    on_finish(job, exported)
+
+  stages = build_render_stages(aligner, tts, clips, synthesizer=synthesizer, cache=cache, reels=reels, store=store)
+  Log.info(f"Rendering with pipelined stages: {', '.join(name for name, _ in stages)}")
+  # alignment mostly waits on the network, so run as many as gentle accepts at once
+  stage_workers = {"align": GENTLE_MAX_IN_FLIGHT, **PIPELINE_STAGE_WORKERS}
+  set_concurrent_encodes(stage_workers.get("encode", 1) * encodes_per_render())
+  return run_pipeline(pipeline_jobs(), stages, PIPELINE_QUEUE_SIZE, stage_workers, cleanup)
+
+# render all videos in the specified json or jsonl file. jsonl files are rendered while the scraper is still
+# appending to them, and a later run continues after the last record that finished rendering
 def render_all_videos(json_file: str, gentle_url: str, start_index: int=0, end_index: int=-1):
-  comments = [] # list with dict {title, comment_text}
-  with open(json_file.strip(), "r") as f:
-    comments = json.load(f)
-  
+  json_file = json_file.strip()
+  if json_file == "latest":
+    json_file = latest_content_file()
+    Log.info(f"Using the latest content file '{json_file}'")
+
+  progress = ContentProgress(json_file) if json_file.endswith(".jsonl") else None
+  offset, first_index = progress.load() if progress is not None else (0, start_index)
+  if progress is not None and first_index > 0:
+    Log.info(f"Resuming '{json_file}' at record #{first_index}")
+
   Log.info(f"Loading video and audio pool")
   try:
-    video_pool = ["./video/splits/" + video for video in os.listdir("./video/splits") if validate_file_extension(video)]
+    video_pool = load_virtual_clip_pool() if CLIP_SOURCE == "virtual" else load_clip_pool()
     if len(video_pool) == 0:
       raise FileNotFoundError()
   except FileNotFoundError:
-    Log.fatal(f"No background videos found at video/splits/, create video/ folder, add background clips, and preprocess into splits first")
+    if CLIP_SOURCE == "virtual":
+      Log.fatal(f"No background videos found at video/, create video/ folder and add background videos first")
+    else:
+      Log.fatal(f"No background videos found at video/splits/, create video/ folder, add background clips, and preprocess into splits first")
     sysexit(1)
   audio_pool = ["./audio/" + audio for audio in os.listdir("./audio") if validate_audio_extension(audio)]
   if len(audio_pool) == 0:
     Log.warn(f"No background audio found in audio/, videos will not have background music")
-  
-  # initialize TTS engine, using cuda if available, otherwise only CPU supported
-  Log.info("Initializing TTS engine")
-  if FFMPEG_ACCELERATION == GpuDevice.CUDA:
-    Log.info("Using CUDA for TTS, importing torch...")
-    import torch
-    if (torch.cuda.is_available()):
-      tts = TTS(TTS_MODEL).to("cuda")
-    else:
-      Log.warn("CUDA was not available, falling back to CPU")
-      tts = TTS(TTS_MODEL).to("cpu")
+
+  estimator = LengthEstimator()
+  # jobs done, rejected or failed too often in earlier runs are skipped, the rest continue where they stopped
+  store = open_job_store()
+  # content already rendered or uploaded from any content file, or claimed earlier in this run, is skipped first
+  fingerprints = open_fingerprint_index()
+  num_jobs = 0
+  num_skipped = 0
+  num_duplicates = 0
+  num_rejected = 0
+
+  # jobs are created as records are read, so rendering starts before the whole file is there
+  def read_jobs() -> Iterator[RenderJob]:
+    nonlocal num_jobs, num_rejected, num_skipped, num_duplicates
+    for index, comment, start, end in read_content(json_file, offset, first_index):
+      if end_index != -1 and index >= end_index:
+        return
+      if index < start_index:
+        continue
+      job = create_job(comment, index, audio_pool)
+      if progress is not None:
+        progress.start(index, start, end)
+      if fingerprints is not None and fingerprints.claim(job.fingerprint, comment["comment_text"]) is not None:
+        Log.verbose(f"Skipping video #{index}, its content was already rendered")
+        num_duplicates += 1
+        if progress is not None:
+          progress.finish(index)
+        continue
+      if store is not None and not store.should_render(job):
+        num_skipped += 1
+        if fingerprints is not None:
+          fingerprints.release(job.fingerprint)
+        if progress is not None:
+          progress.finish(index)
+        continue
+
+      # drop content that will clearly be too short or too long before paying for TTS
+      if PREFILTER_BY_LENGTH and not estimator.should_render(job.raw_content):
+        num_rejected += 1
+        if store is not None:
+          store.filter(job, "length prefilter")
+        if fingerprints is not None:
+          fingerprints.release(job.fingerprint)
+        if progress is not None:
+          progress.finish(index)
+        continue
+      num_jobs += 1
+      yield job
+
+  # calibrate the length prediction with every measured speech length, on the same unfiltered text it predicts from
+  def on_finish(job: RenderJob, exported: bool) -> None:
+    estimator.record(job.raw_content, job.speech_length)
+    write_job_metrics(job, exported)
+    if fingerprints is not None:
+      if exported:
+        fingerprints.add(job.fingerprint, job.output_file)
+      else:
+        fingerprints.release(job.fingerprint)
+    if progress is not None:
+      progress.finish(job.index)
+
+  jobs = read_jobs()
+
+  # parallel workers open the same cache themselves, this one is only used for the stats there
+  cache = ArtifactCache() if CACHE_ENABLED else None
+  cache_stats_before = cache.stats() if cache is not None else {}
+
+  # render reels for new clips up front, every mode then only reserves segments of them
+  reels = open_reels(video_pool) if BACKGROUND_REELS else None
+
+  # parallel workers load their own TTS engine
+  if RENDER_MODE == "parallel":
+    Log.info(f"Rendering videos in parallel with {RENDER_WORKERS} worker processes")
+    # workers draw background clips from one scheduler served by a manager process
+    with SchedulerManager() as manager:
+      clips = manager.ClipScheduler(video_pool)
+      num_exported = run_parallel(jobs, gentle_url, clips, RENDER_WORKERS, lambda job: estimator.predict(job.raw_content), on_finish)
+      clips.save()
+    Log.info(f"Parallel workers exported {num_exported}/{num_jobs} videos")
   else:
-    Log.info("Using CPU for TTS")
-    tts = TTS(TTS_MODEL).to("cpu")
-  Log.info("Initialized TTS engine")
-
-  end_index = end_index if end_index != -1 and end_index < len(comments) else len(comments)
-  Log.info(f"Rendering out {end_index - start_index} videos")
-
-  num_rendered = 0
-  for i in range(start_index, end_index):
-    num_rendered += 1
-    comment = comments[i]
-    title = clean_file_name(format_title(comment["title"], i))
-    content = format_string(CONTENT_FORMAT, title=comment["title"], content=comment["comment_text"])
-    Log.info(f"Rendering video {num_rendered}/{end_index - start_index}: '{title}'")
-    try:
-      render_video(gentle_url, content, tts, video_pool, choice(audio_pool), title)
-    except Exception as ex:
-      Log.error(f"An error occurred trying to render video #{i} - {title}")
-      Log.error(ex)
-  
+    aligner = create_aligner(ALIGNER, gentle_url, ALIGNER_FALLBACK_TO_GENTLE)
+    tts = load_tts()
+    synthesizer = ChunkedSynthesizer(tts, TTS_CHUNK_WORKERS, speaking_rate=get_speaking_rate(tts)) if TTS_CHUNKED else None
+    clips = ClipScheduler(video_pool)
+
+    if RENDER_MODE == "pipeline":
+      num_exported = render_pipelined(jobs, aligner, tts, synthesizer, cache, clips, reels, store, on_finish)
+      Log.info(f"Pipeline exported {num_exported}/{num_jobs} videos")
+    else:
+      set_concurrent_encodes(encodes_per_render())
+      stages = build_render_stages(aligner, tts, clips, synthesizer=synthesizer, cache=cache, reels=reels, store=store)
+      for job in jobs:
+        Log.info(f"Rendering video #{job.index}: '{job.title}'")
+        exported = False
+        try:
+          exported = run_stages(job, stages)
+        except Exception as ex:
+          Log.error(f"An error occurred trying to render video #{job.index} - {job.title}")
+          Log.error(ex)
+        on_finish(job, exported)
+
+    clips.save()
+    if synthesizer is not None:
+      synthesizer.close()
+
+  if PREFILTER_BY_LENGTH:
+    Log.info(f"Length prefilter rejected {num_rejected}/{num_jobs + num_rejected} comments")
+  if num_duplicates > 0:
+    Log.info(f"Skipped {num_duplicates} comments whose content was already rendered")
+  if num_skipped > 0:
+    Log.info(f"Skipped {num_skipped} comments that were already rendered, rejected or failed too often in earlier runs")
+  estimator.save()
+  if store is not None:
+    Log.info("Job states: " + ", ".join(f"{count} {status}" for status, count in sorted(store.summary().items())))
+    store.close()
+  if fingerprints is not None:
+    fingerprints.close()
+  if reels is not None:
+    reels.close()
+  if cache is not None:
+    log_cache_stats(cache, cache_stats_before)
+    cache.close()
+  Metrics.summarize("render")
   Log.info("Completed rendering all videos!")
 
 if __name__ == "__main__":
-  render_all_videos(COMMENTS_FILE_PATH, GENTLE_URL, COMMENTS_START_INDEX, COMMENTS_END_INDEX)
\ No newline at end of file
+  render_all_videos(COMMENTS_FILE_PATH, GENTLE_URL, COMMENTS_START_INDEX, COMMENTS_END_INDEX)
@@ -1,16 +1,51 @@
-import requests
 from datetime import timedelta
 from TTS.api import TTS
 from pathlib import Path
 from math import ceil
+from dataclasses import dataclass, field
+from typing import Callable, TYPE_CHECKING
 import subprocess
+import shutil
 import os
-import random
 
-from util import Log, validate_file_extension, get_video_length, add_hwaccel_to_ffmpeg_command
+import numpy as np
+
+from aligners import Aligner, GentleAligner
+from artifact_cache import ArtifactCache, cache_key
+from audio import write_wav, read_wav, time_stretch
+from chunked_tts import ChunkedSynthesizer, SpeechChunk, set_speaking_rate, get_speaking_rate
+from util import Log, Metrics, get_video_length, add_hwaccel_to_ffmpeg_command, encoder_args, intermediate_encoder_args, new_metrics, GpuDevice
 from content_filter import clean_text
-from normalize_videos import CLIP_LENGTH
-from consts import XFADE_LENGTH, SPEECH_SPEED, MIN_VIDEO_LENGTH, MAX_VIDEO_LENGTH, FFMPEG_ACCELERATION, FFMPEG_VIDEO_BITRATE
+from clip_manifest import Clip, load_clip_pool
+from clip_scheduler import ClipScheduler
+from job_store import JobStore, checkpoint_stages
+from ffmpeg_runner import FfmpegError, FfmpegProcess, FfmpegStats, run_ffmpeg, format_stats
+from normalize_videos import CLIP_LENGTH, build_normalize_filter
+from consts import FPS, WIDTH, HEIGHT, XFADE_LENGTH, SPEECH_SPEED, MIN_VIDEO_LENGTH, MAX_VIDEO_LENGTH, FFMPEG_ACCELERATION, TTS_MODEL, SPEECH_SPEED_METHOD, TTS_CHUNK_MAX_CHARS, TTS_SENTENCE_SILENCE, COMPOSE_MODE
+
+if TYPE_CHECKING:
+  from reels import ReelIndex
+
+# initialize TTS engine, using cuda if available, otherwise only CPU supported
+def load_tts(model: str = TTS_MODEL) -> TTS:
+  Log.info("Initializing TTS engine")
+  if FFMPEG_ACCELERATION == GpuDevice.CUDA:
+    Log.info("Using CUDA for TTS, importing torch...")
+    import torch
+    if (torch.cuda.is_available()):
+      tts = TTS(model).to("cuda")
+    else:
+      Log.warn("CUDA was not available, falling back to CPU")
+      tts = TTS(model).to("cpu")
+  else:
+    Log.info("Using CPU for TTS")
+    tts = TTS(model).to("cpu")
+
+  # let the model speak faster itself instead of time-stretching its output afterwards
+  if SPEECH_SPEED_METHOD == "model" and not set_speaking_rate(tts, SPEECH_SPEED):
+    Log.warn(f"TTS model {model} has no speaking rate control, falling back to time-stretching")
+  Log.info("Initialized TTS engine")
+  return tts
 
 def format_timestamp(seconds: int) -> str:
   td = timedelta(seconds=seconds)
@@ -26,37 +61,69 @@ def create_srt(word_timings: list[tuple[int, str]]) -> tuple[str, int]:
     srt_content += f"{i+1}\n{format_timestamp(start_time)} --> {format_timestamp(end_time)}\n{word_timings[i][1]}\n\n"
   return (srt_content, ceil(word_timings[-1][0] + 1))
 
-# select a specified number of videos randomly until exhausted, then repeat
-def select_videos(video_files: list[str], num_videos: int) -> list[str]:
-  if len(video_files) == 0:
-    raise ValueError("No videos were provided in video_files, please place videos in video/ folder and run the video normalizer")
-  
-  selected_items = []
-  available_items = video_files[:]  # Copy of the original list
-  
-  while len(selected_items) < num_videos:
-    if not available_items:
-      available_items = video_files[:]  # Refill the list when it runs out
-    
-    to_pick = min(num_videos - len(selected_items), len(available_items))
-    chosen = random.sample(available_items, to_pick)  # Pick unique items
-    selected_items.extend(chosen)
-    
-    # Remove selected items from available pool
-    for item in chosen:
-      available_items.remove(item)
-
-  return selected_items
+# input arguments for background clips, virtual clips and reel segments are cut out of their file with -ss / -t
+def build_background_inputs(video_files: list[str] | list[Clip]) -> list[str]:
+  cmd = []
+  for file in video_files:
+    if isinstance(file, Clip):
+      cmd.extend(["-ss", str(file.offset), "-t", str(file.duration)])
+      file = file.path
+    cmd.append("-i")
+    cmd.append(file)
+  return cmd
+
+# video stream name of each background clip starting at input `first_stream`, clips not already at
+# WIDTH x HEIGHT, FPS are normalized first. returns (filter_complex, stream names)
+def build_normalized_streams(video_files: list[str] | list[Clip], first_stream: int) -> tuple[str, list[str]]:
+  filter_complex = ""
+  video_streams = []
+  for i, file in enumerate(video_files):
+    if isinstance(file, Clip) and (file.width, file.height, file.fps) != (WIDTH, HEIGHT, FPS):
+      filter_complex += f"[{first_stream + i}:v]{build_normalize_filter(file.width, file.height)},fps={FPS},setsar=1[c{i}];"
+      video_streams.append(f"[c{i}]")
+    else:
+      video_streams.append(f"[{first_stream + i}:v]")
+  return (filter_complex, video_streams)
+
+# filtergraph that joins the background clips starting at input `first_stream` with crossfades
+# returns (filter_complex, name of the output stream)
+def build_background_filter(video_files: list[str] | list[Clip], first_stream: int) -> tuple[str, str]:
+  filter_complex, video_streams = build_normalized_streams(video_files, first_stream)
+
+  # video_files has 1 video --> no xfade, pass video feed directly
+  # video_files has 2+ videos --> xfade pairs until last, then into vfin
+  if len(video_files) == 1:
+    return (filter_complex, video_streams[0])
+
+  offset_amount = CLIP_LENGTH - XFADE_LENGTH
+  for i in range(len(video_files) - 1):
+    prev_stream = video_streams[0] if i == 0 else f"[v{i}]"
+    out_name = "[vfin]" if i + 2 == len(video_files) else f"[v{i + 1}]"
+
+    filter_complex += f"{prev_stream}{video_streams[i + 1]}xfade=transition=fade:duration={XFADE_LENGTH}:offset={offset_amount * (i + 1)}{out_name};"
+
+  return (filter_complex, "[vfin]")
+
+# filters that burn subtitles into `video_stream` as [vout] and mix the speech (input 0) with the background
+# audio (input 1) if there is any. returns (filter, name of the audio output stream)
+def build_overlay_filter(video_stream: str, transcript_file: str, audio_file: str | None) -> tuple[str, str]:
+  filter_complex = f"{video_stream}subtitles={transcript_file}:force_style='Fontsize=30,Alignment=10,Fontname=Roboto Black,Outline=2,Shadow=4'[vout];"
+
+  if audio_file is not None:
+    filter_complex += "[0:a][1:a]amix=inputs=2:duration=shortest:weights=6 1[aout]"
+    return (filter_complex, "[aout]")
+  return (filter_complex, "[0:a]")
 
 # example:
 # ffmpeg -i video/bkg.mp4 -i work/speech.wav -map 0:v -map 1:a -vf "subtitles=work/sub.srt:force_style='Fontsize=36,Alignment=10,Fontname=Roboto Black'" -t 11 -b:v 8M -b:a 192k work/fin.mp4
 # enhanced:
 # ffmpeg -i test/out2.wav -i "audio/El Pesaj y el Moro - Cumbia Deli.mp3" -i "video/splits/screen-20250319-105225_15.mp4" -i "video/splits/screen-20250315-125016_250.mp4" -i "video/splits/screen-20250319-104529_130.mp4" -filter_complex "[2:v][3:v]xfade=transition=fade:duration=1:offset=4[v23];[v23][4:v]xfade=transition=fade:duration=1:offset=8[v234];[v234]subtitles=test/sub.srt:force_style='Fontsize=30,Alignment=10,Fontname=Roboto Black,Outline=2,Shadow=4'[vout];[0:a][1:a]amix=inputs=2:duration=shortest:weights=5 1[aout]" -map "[vout]" -map "[aout]" test/final.mp4
-def build_ffmpeg_command(video_files: list[str], speech_file: str, transcript_file: str, video_length: int, video_title: str, audio_file: str | None) -> list[str]:
+def build_ffmpeg_command(video_files: list[str] | list[Clip], speech_file: str, transcript_file: str, video_length: int, output_file: str, audio_file: str | None) -> list[str]:
   # stream order:
   # 0: speech_file
   # 1: audio_file <-- optional
   # 1+ or 2+: video_files
+  # video_files are normalized split files, virtual clips cut out of their source, or a single background reel segment
 
   num_videos = len(video_files)
   if num_videos == 0:
@@ -65,150 +132,436 @@ def build_ffmpeg_command(video_files: list[str], speech_file: str, transcript_fi
   cmd = ["ffmpeg"]
 
   cmd.append("-i")
-  cmd.append(f'"{speech_file}"')
+  cmd.append(speech_file)
 
   # background audio file
   if audio_file is not None:
     cmd.append("-i")
-    cmd.append(f'"{audio_file}"')
+    cmd.append(audio_file)
 
   # background video clips
-  for file in video_files:
-    cmd.append("-i")
-    cmd.append(f'"{file}"')
+  cmd.extend(build_background_inputs(video_files))
 
   # build complex filter
   cmd.append("-filter_complex")
 
-  # video_files has 1 video --> no xfade, pass video feed directly
-  # video_files has 2+ videos --> xfade pairs until last, then into vout
-  filter_complex = ""
-  semi_vout_name = ""
-  aout_name = ""
+  filter_complex, semi_vout_name = build_background_filter(video_files, 1 if audio_file is None else 2)
+  overlay_filter, aout_name = build_overlay_filter(semi_vout_name, transcript_file, audio_file)
+  filter_complex += overlay_filter
+
+  cmd.append(filter_complex)
+  cmd.extend(["-map", "[vout]", "-map", aout_name, "-t", str(video_length), "-c:a", "aac", "-f", "mp4", "-y"] + encoder_args() + [output_file])
 
-  if num_videos == 1:
-    semi_vout_name = "[1:v]" if audio_file is None else "[2:v]"
+  return cmd
+
+# the part of a background clip from `start` lasting `length` seconds, as a clip that can be cut with -ss / -t
+def cut_clip(file: str | Clip, start: float, length: float) -> Clip:
+  if isinstance(file, Clip):
+    return file._replace(offset=file.offset + start, duration=length)
+  return Clip(file, file, start, length, WIDTH, HEIGHT, FPS, 0)
+
+# streaming composition renders the background one crossfade window at a time instead of in one filtergraph:
+# window 0 is the first clip up to its fade out, window k crossfades the tail of clip k-1 into clip k and
+# plays clip k up to its own fade out. every window lasts CLIP_LENGTH - XFADE_LENGTH seconds, the last one
+# plays its clip to the end. windows are written as lossless mpegts with continuous timestamps so they
+# can be piped one after another into the final encoder, keeping at most two clips decoded at a time
+def build_window_command(video_files: list[str] | list[Clip], window: int) -> list[str]:
+  step = CLIP_LENGTH - XFADE_LENGTH
+  length = CLIP_LENGTH if window + 1 == len(video_files) else step
+  parts = [cut_clip(video_files[window], 0, length)]
+  if window > 0:
+    parts.insert(0, cut_clip(video_files[window - 1], step, XFADE_LENGTH))
+
+  filter_complex, video_streams = build_normalized_streams(parts, 0)
+  if window > 0:
+    filter_complex += f"{video_streams[0]}{video_streams[1]}xfade=transition=fade:duration={XFADE_LENGTH}:offset=0[vout]"
   else:
-    offset_amount = CLIP_LENGTH - XFADE_LENGTH
-    for i in range(num_videos - 1):
-      #video = video_files[i]
-      stream_index = i + 1 if audio_file is None else i + 2
-      
-      prev_stream = ""
-      if i == 0:
-        prev_stream = f"[{stream_index}:v]"
-      else:
-        prev_stream = f"[v{stream_index - 1}]"
-      
-      out_name = "[vfin]" if i + 2 == num_videos else f"[v{stream_index}]"
-
-      filter_complex += f"{prev_stream}[{stream_index + 1}:v]xfade=transition=fade:duration={XFADE_LENGTH}:offset={offset_amount * (i + 1)}{out_name};"
-
-    semi_vout_name = "[vfin]"
-  
-  filter_complex += f"{semi_vout_name}subtitles={transcript_file}:force_style='Fontsize=30,Alignment=10,Fontname=Roboto Black,Outline=2,Shadow=4'[vout];"
-  
+    filter_complex += f"{video_streams[0]}null[vout]"
+
+  return ["ffmpeg", "-nostdin"] + build_background_inputs(parts) + ["-filter_complex", filter_complex, "-map", "[vout]", "-an"] + \
+    intermediate_encoder_args() + ["-output_ts_offset", str(window * step), "-f", "mpegts", "pipe:1"]
+
+# x264 encodes a single render runs at once, streaming composition encodes a background window next to the
+# final video. render modes pass their number of concurrent renders times this to `set_concurrent_encodes`
+def encodes_per_render() -> int:
+  return 2 if COMPOSE_MODE == "streaming" else 1
+
+# final encode for streaming composition, the background arrives as mpegts on stdin
+def build_streaming_ffmpeg_command(speech_file: str, transcript_file: str, video_length: int, output_file: str, audio_file: str | None) -> list[str]:
+  cmd = ["ffmpeg", "-i", speech_file]
   if audio_file is not None:
-    filter_complex += "[0:a][1:a]amix=inputs=2:duration=shortest:weights=6 1[aout]"
-    aout_name = "[aout]"
-  else:
-    aout_name = "[0:a]"
-  
-  cmd.append(f'"{filter_complex}"')
-  cmd.extend(["-map", "\"[vout]\"", "-map", f'"{aout_name}"', "-t", str(video_length), "-c:v", "libx264", "-c:a", "aac", "-f", "mp4", "-y", "-b:v", FFMPEG_VIDEO_BITRATE, f"\"./out/{video_title}.mp4\""])
+    cmd.extend(["-i", audio_file])
+  cmd.extend(["-f", "mpegts", "-i", "pipe:0"])
 
+  filter_complex, aout_name = build_overlay_filter(f"[{1 if audio_file is None else 2}:v]", transcript_file, audio_file)
+  cmd.extend(["-filter_complex", filter_complex, "-map", "[vout]", "-map", aout_name, "-t", str(video_length), "-c:a", "aac", "-f", "mp4", "-y"] + encoder_args() + [output_file])
   return cmd
 
 def build_ffmpeg_audio_speed_command(speech_file: str, output_file_name: str, rate: float = SPEECH_SPEED) -> list[str]:
-  cmd = ["ffmpeg", "-i", f'"{speech_file}"', "-af", f"atempo={rate}", "-y", f'"{output_file_name}"']
+  cmd = ["ffmpeg", "-i", speech_file, "-af", f"atempo={rate}", "-y", output_file_name]
   return cmd
 
-def render_video(gentle_url: str, content: str, tts: TTS, video_files: list[str], audio_file: str | None, video_title: str, censor_text: bool = True) -> None:
-  # create working directory if not exists
-  Path("./work").mkdir(parents=True, exist_ok=True)
-
+# state for a single video as it moves through the render stages
+@dataclass
+class RenderJob:
+  title: str
+  content: str
+  audio_file: str | None
+  work_dir: str = "./work"
+  index: int = 0
+  speech_length: float = 0
+  video_length: int = 0
+  word_timings: list[tuple[float, str]] = field(default_factory=list)
+  chunks: list[SpeechChunk] = field(default_factory=list)
+  # synthesized speech kept in memory when the speed up is done in-process
+  waveform: np.ndarray | None = None
+  sample_rate: int = 0
+  # speed up already applied by the TTS model itself
+  speed_applied: float = 1
+  # word timings predicted by the TTS model, in seconds of the synthesized speech before speed up
+  tts_word_timings: list[tuple[float, str]] = field(default_factory=list)
+  # artifact cache key of the synthesized speech, and whether the sped up speech came from the cache
+  speech_key: str = ""
+  speech_cached: bool = False
+  # peak memory in bytes of the final composition
+  peak_rss: int = 0
+  # stats of every ffmpeg call made for this job
+  ffmpeg_stats: list[FfmpegStats] = field(default_factory=list)
+  # identifies the comment in the job store, the stage a resumed job continues with, and why a stage
+  # rejected the job (left empty when a stage failed instead)
+  key: str = ""
+  resume_stage: int = 0
+  # fingerprint of the comment's normalized content, the same for duplicates scraped from anywhere
+  fingerprint: str = ""
+  rejection: str = ""
+  # the formatted comment before the content filter, the length prediction is made and calibrated on this text
+  raw_content: str = ""
+  # seconds spent per stage and counters, see `Metrics`
+  metrics: dict[str, dict[str, float]] = field(default_factory=new_metrics)
+
+  @property
+  def transcript_file(self) -> str:
+    return os.path.join(self.work_dir, "speech.txt")
+
+  @property
+  def speech_pre_file(self) -> str:
+    return os.path.join(self.work_dir, "speech_pre.wav")
+
+  @property
+  def speech_file(self) -> str:
+    return os.path.join(self.work_dir, "speech.wav")
+
+  @property
+  def srt_file(self) -> str:
+    return os.path.join(self.work_dir, "sub.srt")
+
+  @property
+  def output_file(self) -> str:
+    return f"./out/{self.title}.mp4"
+
+  # ffmpeg writes here and the file is moved to `output_file` once it is complete
+  @property
+  def partial_output_file(self) -> str:
+    return os.path.join(self.work_dir, "out.mp4")
+
+# a render stage takes a job and returns False if the job should not continue
+RenderStage = Callable[[RenderJob], bool]
+
+# apply content filter and skip videos that already exist
+def prepare_job(job: RenderJob, censor_text: bool = True) -> bool:
   # apply content filter if requested
   if censor_text:
-    content = clean_text(content)
-    video_title = clean_text(video_title)
+    job.content = clean_text(job.content)
+    job.title = clean_text(job.title)
 
   # skip if this file already exists
-  if os.path.exists(f"./out/{video_title}.mp4"):
-    Log.info(f"Skipping, video \"{video_title}.mp4\" already exists")
-    return
+  if os.path.exists(job.output_file):
+    Log.info(f"Skipping, video \"{job.title}.mp4\" already exists")
+    job.rejection = "already exists"
+    return False
+
+  # create working directory if not exists
+  Path(job.work_dir).mkdir(parents=True, exist_ok=True)
+  return True
+
+# cache keys of a job's artifacts, each covers every setting the artifact depends on
+def speech_cache_key(job: RenderJob, chunked: bool, with_timings: bool) -> str:
+  chunking = (TTS_CHUNK_MAX_CHARS, TTS_SENTENCE_SILENCE) if chunked else None
+  model_speed = SPEECH_SPEED if SPEECH_SPEED_METHOD == "model" else 1
+  return cache_key("speech", job.content, TTS_MODEL, chunking, model_speed, with_timings)
+
+def stretched_cache_key(job: RenderJob) -> str:
+  return cache_key("stretched", job.speech_key, SPEECH_SPEED, SPEECH_SPEED_METHOD)
 
+def alignment_cache_key(job: RenderJob, aligner: Aligner) -> str:
+  return cache_key("alignment", stretched_cache_key(job), aligner.name, aligner.version)
+
+# what later stages need to know about synthesized speech besides the audio itself
+def _speech_metadata(job: RenderJob) -> dict:
+  return {"chunks": job.chunks, "tts_word_timings": job.tts_word_timings, "speed_applied": job.speed_applied, "speech_length": job.speech_length}
+
+def _restore_speech_metadata(job: RenderJob, metadata: dict) -> None:
+  job.chunks = [SpeechChunk(*chunk) for chunk in metadata["chunks"]]
+  job.tts_word_timings = [(start, word) for start, word in metadata["tts_word_timings"]]
+  job.speed_applied = metadata["speed_applied"]
+  job.speech_length = metadata["speech_length"]
+
+# `with_timings` collects word timings from the TTS model for aligners that need them
+def synthesize_speech(job: RenderJob, tts: TTS, synthesizer: ChunkedSynthesizer | None = None, with_timings: bool = False, cache: ArtifactCache | None = None) -> bool:
   # write transcript file
-  with open("./work/speech.txt", "w") as f:
-    f.write(content)
+  with open(job.transcript_file, "w") as f:
+    f.write(job.content)
+
+  # word timings are collected sentence by sentence, same as chunked synthesis without the worker pool
+  if synthesizer is None and with_timings:
+    synthesizer = ChunkedSynthesizer(tts, 1)
+  job.speech_key = speech_cache_key(job, synthesizer is not None, with_timings)
+
+  if cache is not None:
+    # sped up speech from an earlier run skips synthesis and speed up entirely
+    metadata = cache.get_json(stretched_cache_key(job), "speech.json")
+    if metadata is not None and cache.fetch(stretched_cache_key(job), "speech.wav", job.speech_file):
+      Log.info("Using cached sped up speech")
+      Metrics.count("cached_speech")
+      _restore_speech_metadata(job, metadata)
+      job.speech_cached = True
+      return True
+    # speech from an earlier run with different speed settings only skips synthesis
+    metadata = cache.get_json(job.speech_key, "speech_pre.json")
+    if metadata is not None and cache.fetch(job.speech_key, "speech_pre.wav", job.speech_pre_file):
+      Log.info("Using cached speech")
+      Metrics.count("cached_speech_pre")
+      _restore_speech_metadata(job, metadata)
+      if SPEECH_SPEED_METHOD != "ffmpeg":
+        job.waveform, job.sample_rate = read_wav(job.speech_pre_file)
+      return True
 
   # generate speech using provided TTS
   Log.info("Generating speech using TTS")
-  #tts = TTS("tts_models/en/ljspeech/vits").to("cpu")
-  tts.tts_to_file(text=content, file_path="./work/speech_pre.wav")
+  Metrics.count("tts_chars", len(job.content))
+  if synthesizer is not None:
+    # synthesize sentence by sentence, keeping the chunk boundaries for later stages
+    wav, sample_rate, job.chunks, job.tts_word_timings = synthesizer.synthesize(job.content, with_timings)
+  elif SPEECH_SPEED_METHOD != "ffmpeg":
+    wav, sample_rate = np.asarray(tts.tts(text=job.content), dtype=np.float32), tts.synthesizer.output_sample_rate
+  else:
+    tts.tts_to_file(text=job.content, file_path=job.speech_pre_file)
+    wav = None
+
+  # keep speech in memory if it is sped up in-process, otherwise ffmpeg reads it from disk
+  if wav is not None and SPEECH_SPEED_METHOD != "ffmpeg":
+    job.waveform, job.sample_rate = wav, sample_rate
+    job.speed_applied = get_speaking_rate(tts)
+  elif wav is not None:
+    write_wav(job.speech_pre_file, wav, sample_rate)
   Log.info("Completed generating speech")
 
-  # apply audio speed mulitplier with ffmpeg
-  Log.info(f"Applying audio multiplier of {SPEECH_SPEED}x")
-  cmd = build_ffmpeg_audio_speed_command("./work/speech_pre.wav", "./work/speech.wav", SPEECH_SPEED)
-  Log.verbose("Calling ffmpeg: " + " ".join(cmd))
-  try:
-    subprocess.run(" ".join(cmd), cwd=os.getcwd(), shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-  except subprocess.CalledProcessError as e:
-    Log.error("Error applying audio speed with ffmpeg: " + str(e))
-    Log.error(e.output)
-    return
+  if cache is not None:
+    if job.waveform is not None:
+      write_wav(job.speech_pre_file, job.waveform, job.sample_rate)
+    cache.put(job.speech_key, "speech_pre.wav", job.speech_pre_file)
+    cache.put_json(job.speech_key, "speech_pre.json", _speech_metadata(job))
+  return True
+
+# speeds up speech and rejects videos outside of the desired length
+def apply_speech_speed(job: RenderJob, cache: ArtifactCache | None = None) -> bool:
+  if job.speech_cached:
+    # already sped up, measured when it was cached
+    pass
+  elif job.waveform is not None:
+    # speed up in-process, whatever the TTS model did not already do, and measure by sample count
+    rate = SPEECH_SPEED / job.speed_applied
+    Log.info(f"Applying audio multiplier of {SPEECH_SPEED}x ({job.speed_applied:g}x by TTS model)")
+    wav = time_stretch(job.waveform, rate, job.sample_rate) if abs(rate - 1) > 1e-3 else job.waveform
+    write_wav(job.speech_file, wav, job.sample_rate)
+    job.speech_length = wav.size / job.sample_rate
+    job.waveform = None
+  else:
+    # apply audio speed mulitplier with ffmpeg
+    Log.info(f"Applying audio multiplier of {SPEECH_SPEED}x")
+    cmd = build_ffmpeg_audio_speed_command(job.speech_pre_file, job.speech_file, SPEECH_SPEED)
+    try:
+      job.ffmpeg_stats.append(run_ffmpeg(cmd, f"speed #{job.index}", job.speech_file))
+    except FfmpegError as e:
+      Log.error("Error applying audio speed with ffmpeg: " + str(e))
+      Log.error(e.log)
+      return False
+    job.speech_length = get_video_length(job.speech_file)
+
+  if cache is not None and not job.speech_cached:
+    cache.put(stretched_cache_key(job), "speech.wav", job.speech_file)
+    cache.put_json(stretched_cache_key(job), "speech.json", _speech_metadata(job))
 
   # check audio length and reject if too long / short
-  speech_length = get_video_length("./work/speech.wav")
-  if (MIN_VIDEO_LENGTH != -1 and speech_length < MIN_VIDEO_LENGTH) or (MAX_VIDEO_LENGTH != -1 and speech_length > MAX_VIDEO_LENGTH):
-    Log.info(f"Rejected, video length of {speech_length}s was outside desired length of {MIN_VIDEO_LENGTH}-{MAX_VIDEO_LENGTH}s")
-    return
-
-  # align text using gentle
-  # open files in binary mode
-  with open("./work/speech.wav", "rb") as speech_file, open("./work/speech.txt", "r") as transcript_file:
-    files = {
-      "audio": ("speech.wav", speech_file, "audio/wav"),
-      "transcript": ("speech.txt", transcript_file, "text/plain"),
-    }
-    request_url = gentle_url + "/transcriptions?async=false"
-    Log.info("Aligning speech text using " + request_url)
-    response = requests.post(request_url, files=files)
-    Log.info("Completed aligning text")
-
-  aligned_words = response.json()["words"]
-  words_timing = [] # list of tuple (start_time, word)
-
-  for word in aligned_words:
-    # if failed to align, just skip word
-    if "start" in word and "word" in word:
-      words_timing.append((word["start"], word["word"]))
-
-  # generate SRT for subtitles
+  if (MIN_VIDEO_LENGTH != -1 and job.speech_length < MIN_VIDEO_LENGTH) or (MAX_VIDEO_LENGTH != -1 and job.speech_length > MAX_VIDEO_LENGTH):
+    Log.info(f"Rejected, video length of {job.speech_length}s was outside desired length of {MIN_VIDEO_LENGTH}-{MAX_VIDEO_LENGTH}s")
+    job.rejection = f"length of {job.speech_length:.1f}s"
+    return False
+  return True
+
+# align speech and transcript into word timings for subtitles
+def align_speech(job: RenderJob, aligner: Aligner, cache: ArtifactCache | None = None) -> bool:
+  if cache is not None:
+    cached_timings = cache.get_json(alignment_cache_key(job, aligner), "words.json")
+    if cached_timings is not None:
+      Log.info("Using cached alignment")
+      Metrics.count("cached_alignment")
+      job.word_timings = [(start, word) for start, word in cached_timings]
+      return True
+
+  word_timings = aligner.align(job)
+  if not word_timings:
+    Log.error(f"Aligner '{aligner.name}' did not align any words")
+    return False
+  job.word_timings = word_timings
+
+  if cache is not None:
+    cache.put_json(alignment_cache_key(job, aligner), "words.json", job.word_timings)
+  return True
+
+# generate SRT for subtitles
+def write_srt(job: RenderJob, aligner: Aligner, cache: ArtifactCache | None = None) -> bool:
+  # subtitles only depend on the alignment, so they share its key
+  key = alignment_cache_key(job, aligner)
+  if cache is not None and cache.fetch(key, "sub.srt", job.srt_file):
+    Log.info("Using cached SRT")
+    Metrics.count("cached_srt")
+    job.video_length = ceil(job.word_timings[-1][0] + 1)
+    return True
+
   Log.info("Generating SRT")
-  srt_text, vid_length = create_srt(words_timing)
+  srt_text, job.video_length = create_srt(job.word_timings)
 
-  with open("./work/sub.srt", "w", encoding="utf-8") as f:
+  with open(job.srt_file, "w", encoding="utf-8") as f:
     f.write(srt_text)
 
+  if cache is not None:
+    cache.put(key, "sub.srt", job.srt_file)
   Log.info("SRT saved")
-  
+  return True
+
+def compose_video(job: RenderJob, clips: ClipScheduler, reels: "ReelIndex | None" = None) -> bool:
+  # take the background from a pre-rendered reel if there is one long enough, otherwise crossfade clips here
+  segment = reels.reserve(job.video_length) if reels is not None else None
+  if segment is not None:
+    Log.verbose(f"Using background reel {segment.path} at {segment.offset}s")
+    background = [segment]
+  else:
+    num_videos_needed = ceil(job.video_length / (CLIP_LENGTH - XFADE_LENGTH))
+    background = clips.draw(num_videos_needed)
+    if COMPOSE_MODE == "streaming":
+      Path("./out").mkdir(parents=True, exist_ok=True)
+      return compose_streaming(job, background)
+
   # build ffmpeg command and call
-  num_videos_needed = ceil(vid_length / (CLIP_LENGTH - XFADE_LENGTH))
-  cmd = build_ffmpeg_command(select_videos(video_files, num_videos_needed), "./work/speech.wav", "./work/sub.srt", vid_length, video_title, audio_file)
+  cmd = build_ffmpeg_command(background, job.speech_file, job.srt_file, job.video_length, job.partial_output_file, job.audio_file)
   cmd = add_hwaccel_to_ffmpeg_command(cmd, FFMPEG_ACCELERATION)
   Path("./out").mkdir(parents=True, exist_ok=True)
-  Log.verbose("Calling ffmpeg: " + " ".join(cmd))
   try:
-    subprocess.run(" ".join(cmd), cwd=os.getcwd(), shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-  except subprocess.CalledProcessError as e:
+    stats = run_ffmpeg(cmd, f"encode #{job.index}", job.partial_output_file, job.video_length)
+  except FfmpegError as e:
     Log.error("Error exporting video with ffmpeg: " + str(e))
-    Log.error(e.output)
-    return
+    Log.error(e.log)
+    return False
+  job.ffmpeg_stats.append(stats)
+  job.peak_rss = stats.peak_rss
+  Log.info(format_stats(stats))
+
+  return finish_output(job)
+
+# move a completed video to out/, an interrupted render never leaves a partial video there
+def finish_output(job: RenderJob) -> bool:
+  shutil.move(job.partial_output_file, job.output_file)
+  Log.info("Done! Exported video to " + job.output_file)
+  return True
+
+# pipe the background of `video_files` window by window into `encoder`, an ffmpeg reading mpegts on stdin, and
+# close its stdin. returns the peak memory of the largest window. a failed window cancels the encoder, so its
+# `wait` raises, unless the encoder already exited because it had all the input it needed
+def pipe_windows(encoder: FfmpegProcess, video_files: list[str] | list[Clip], name: str) -> int:
+  assert encoder.stdin is not None
+  window_peak = 0
+  try:
+    for window in range(len(video_files)):
+      # the encoder reports progress for the whole video, windows stay quiet
+      window_process = FfmpegProcess(build_window_command(video_files, window), f"window {window + 1}/{len(video_files)} {name}", stdout=encoder.stdin, on_progress=lambda progress: None)
+      try:
+        window_peak = max(window_peak, window_process.wait().peak_rss)
+      except FfmpegError as e:
+        # the final encoder stops reading once it has -t seconds, anything else is a real failure
+        if encoder.poll() is None:
+          Log.error(f"Error rendering background window {window + 1}/{len(video_files)} with ffmpeg: {e}")
+          Log.error(e.log)
+          encoder.cancel()
+        break
+  finally:
+    try:
+      encoder.stdin.close()
+    except BrokenPipeError:
+      pass
+  return window_peak
+
+# compose with the background rendered window by window into the final encoder, so memory does not grow
+# with the video length. logs the peak memory of the encoder and of the largest window
+def compose_streaming(job: RenderJob, video_files: list[str] | list[Clip]) -> bool:
+  cmd = add_hwaccel_to_ffmpeg_command(build_streaming_ffmpeg_command(job.speech_file, job.srt_file, job.video_length, job.partial_output_file, job.audio_file), FFMPEG_ACCELERATION)
+  Log.verbose(f"Streaming {len(video_files)} background windows into the encoder")
+
+  encoder = FfmpegProcess(cmd, f"encode #{job.index}", job.partial_output_file, job.video_length, stdin=subprocess.PIPE)
+  window_peak = pipe_windows(encoder, video_files, f"#{job.index}")
 
-  Log.info("Done! Exported video to " + f"./out/{video_title}.mp4")
+  try:
+    stats = encoder.wait()
+  except FfmpegError as e:
+    Log.error("Error exporting video with ffmpeg: " + str(e))
+    Log.error(e.log)
+    return False
+
+  job.ffmpeg_stats.append(stats)
+  job.peak_rss = stats.peak_rss + window_peak
+  Log.info(format_stats(stats))
+  Log.info(f"Streaming composition peak memory: encoder {stats.peak_rss / 2 ** 20:.0f} MiB, largest window {window_peak / 2 ** 20:.0f} MiB")
+  return finish_output(job)
+
+# wrap render stages so the time every job spends in each of them is recorded in `job.metrics`, stages listed in
+# PROFILE_STAGES are run under a profiler
+def instrument_stages(stages: list[tuple[str, RenderStage]]) -> list[tuple[str, RenderStage]]:
+  def wrap(name: str, stage: RenderStage) -> RenderStage:
+    def run(job: RenderJob) -> bool:
+      with Metrics.recording(job.metrics), Metrics.timer(name), Metrics.profile(name, f"job-{job.index}"):
+        return stage(job)
+    return run
+
+  return [(name, wrap(name, stage)) for name, stage in stages]
+
+# ordered list of (stage name, stage) that turns a job into a finished video
+# `clips` is shared by all renders of a batch, pass a `SchedulerManager` proxy of it to worker processes
+# with a job store every job is checkpointed after each stage and resumed after its last checkpoint
+def build_render_stages(aligner: Aligner, tts: TTS, clips: ClipScheduler, censor_text: bool = True, synthesizer: ChunkedSynthesizer | None = None, cache: ArtifactCache | None = None, reels: "ReelIndex | None" = None, store: JobStore | None = None) -> list[tuple[str, RenderStage]]:
+  stages: list[tuple[str, RenderStage]] = [
+    ("filter", lambda job: prepare_job(job, censor_text)),
+    ("tts", lambda job: synthesize_speech(job, tts, synthesizer, aligner.needs_tts_timings, cache)),
+    ("speed", lambda job: apply_speech_speed(job, cache)),
+    ("align", lambda job: align_speech(job, aligner, cache)),
+    ("srt", lambda job: write_srt(job, aligner, cache)),
+    ("encode", lambda job: compose_video(job, clips, reels)),
+  ]
+  # stages skipped by a resumed job are not timed
+  stages = instrument_stages(stages)
+  return checkpoint_stages(stages, store) if store is not None else stages
+
+# run a job through every stage in order, returns True if the video was exported
+def run_stages(job: RenderJob, stages: list[tuple[str, RenderStage]]) -> bool:
+  for _, stage in stages:
+    if not stage(job):
+      return False
+  return True
+
+def render_video(gentle_url: str, content: str, tts: TTS, video_files: list[str] | list[Clip], audio_file: str | None, video_title: str, censor_text: bool = True, work_dir: str = "./work") -> bool:
+  job = RenderJob(video_title, content, audio_file, work_dir)
+  return run_stages(job, build_render_stages(GentleAligner(gentle_url), tts, ClipScheduler(video_files, state_path=""), censor_text))
 
 # test render a single video
 if __name__ == "__main__":
-  video_pool = ["./video/splits/" + video for video in os.listdir("./video/splits") if validate_file_extension(video)]
+  video_pool = load_clip_pool()
   render_video("http://localhost:32768", "Hello world! This is a test! It is working very good. idk man idc what's going on with 2/3rds of the population. You know, this is a very long piece of text. I wonder how long the resuling video will be then. I don't really know man. I guess we'll have to see.", TTS("tts_models/en/ljspeech/vits").to("cpu"), video_pool, "./audio/Traverse The Sky - Asher Fulero.mp3", "faster")
\ No newline at end of file
@@ -1,33 +1,138 @@
-from playwright.sync_api import sync_playwright
 from datetime import datetime
+from urllib.parse import urlparse
+import asyncio
 import json
 from pathlib import Path
 import emoji
 import re
 
 from util import Log
-from consts import BASE_URL, SUBREDDIT, SKIP_NSFW, SCRAPE_ONLY_POST
+from scrape_index import ScrapeIndex, open_scrape_index
+from content_stream import JsonlWriter
+from consts import BASE_URL, SUBREDDIT, SKIP_NSFW, SCRAPE_ONLY_POST, SCRAPE_BACKEND, SUBREDDITS, SCRAPE_CONCURRENCY, SCRAPE_HEADLESS, SCRAPE_OUTPUT
+
+# old.reddit selectors for thread links on a listing, the post body and the top level comments of a thread
+THREAD_LINK_SELECTOR = "a.title"
+POST_BODY_SELECTOR = "div.sitetable.linklisting > * > div.entry.unvoted > div.expando > form > div.usertext-body.may-blank-within.md-container"
+TOP_COMMENT_SELECTOR = "div.sitetable.nestedlisting > * > div.entry.unvoted > * > div.usertext-body.may-blank-within.md-container"
+
+# resource types the async scraper never loads, only the html is needed
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet", "imageset", "texttrack", "manifest"}
 
 # helper function to remove emojis and links and strip whitespace
 def clean_text_content(text: str) -> str:
   # replace emojis with "<emoji name> emoji"
   return emoji.demojize(re.sub(r"https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&\/\/=]*)", "", text), delimiters=("", " emoji ")).replace("_", " ").strip()
 
+# whether a thread from the listing should be scraped, logs why not
+def should_scrape_thread(thread: dict[str, str], index: ScrapeIndex | None = None) -> bool:
+  if "/comments/" not in thread["href"]:
+    Log.info(f"Skipping, may be ad")
+    return False
+  if SKIP_NSFW and "/over18" in thread["href"]:
+    Log.info(f"Skipping not safe for work post")
+    return False
+  if index is not None and index.is_done(thread["href"]):
+    Log.info(f"Skipping, already scraped")
+    return False
+  return True
+
+# absolute url of a link on the listing, links may be relative to base_url
+def thread_url(base_url: str, href: str) -> str:
+  return href if href.startswith("http") else base_url + href
+
+# {title, comment_text, href} records for the texts found in one thread. href tells apart threads with the
+# same title in the index, it is not saved to the content files
+def thread_records(thread: dict[str, str], texts: list[str | None]) -> list[dict[str, str]]:
+  return [{"title": thread["title"], "comment_text": clean_text_content(text), "href": thread["href"]} for text in texts if text is not None]
+
+# the {title, comment_text} of a record that is saved to the content files
+def content_record(record: dict[str, str]) -> dict[str, str]:
+  return {"title": record["title"], "comment_text": record["comment_text"]}
+
+# new file name in content/ for the content of a subreddit, creates the directory
+def content_file_name(subreddit: str, extension: str = "json") -> str:
+  # create output directory if not exists
+  Path("./content").mkdir(parents=True, exist_ok=True)
+  return f"./content/comments-{subreddit.replace('/r/', '')}-{datetime.now().strftime('%m-%d-%y-%H-%M-%S')}.{extension}"
+
+# write scraped content to a new json file in content/, returns its file name
+def save_comments(comments: list[dict[str, str]], subreddit: str) -> str:
+  # write out json file with content
+  file_name = content_file_name(subreddit)
+  Log.info(f"Completed scraping comments, saving to '{file_name}'")
+
+  with open(file_name, "w") as f:
+    json.dump([content_record(comment) for comment in comments], f)
+
+  Log.info("Successfully saved content!")
+
+  return file_name
+
+# collects the content of one subreddit, call `add_thread` for every thread that was scraped.
+# "json" output is saved in one go by `close`, "jsonl" output is appended and flushed thread by thread so
+# render_all_video.py can render while the scrape is running. with an index only comments that no earlier run
+# emitted are kept, and threads are remembered once their content is written
+class ContentWriter:
+  def __init__(self, subreddit: str, index: ScrapeIndex | None = None, output: str = SCRAPE_OUTPUT):
+    self.subreddit = subreddit
+    self.index = index
+    self.num_scraped = 0
+    self.comments: list[dict[str, str]] = [] # json output only
+    self.threads: list[dict[str, str]] = []
+    self.jsonl: JsonlWriter | None = None
+    if output == "jsonl":
+      self.jsonl = JsonlWriter(content_file_name(subreddit, "jsonl"))
+      Log.info(f"Streaming content to '{self.jsonl.path}'")
+
+  @property
+  def streaming(self) -> bool:
+    return self.jsonl is not None
+
+  def add_thread(self, thread: dict[str, str], records: list[dict[str, str]]) -> None:
+    self.num_scraped += len(records)
+    if self.index is not None:
+      records = self.index.unseen(records)
+    if self.jsonl is None:
+      self.comments.extend(records)
+      self.threads.append(thread)
+      return
+    for record in records:
+      self.jsonl.write(content_record(record))
+    if self.index is not None:
+      self.index.add(self.subreddit, [thread], records)
+
+  # finish the file, returns its name or None if there was nothing new to save
+  def close(self) -> str | None:
+    if self.jsonl is not None:
+      self.jsonl.close()
+      Log.info(f"Completed scraping comments, saved {self.jsonl.num_records} new of {self.num_scraped} to '{self.jsonl.path}'")
+      return self.jsonl.path
+
+    if self.index is None:
+      return save_comments(self.comments, self.subreddit)
+    Log.info(f"{len(self.comments)} of {self.num_scraped} scraped comments in {self.subreddit} are new")
+    file_name = save_comments(self.comments, self.subreddit) if len(self.comments) > 0 else None
+    self.index.add(self.subreddit, self.threads, self.comments)
+    return file_name
+
 # scrape entire first page of reddit, each thread's first page of top level comments
 # returns file name of where json data was saved
-def scrape_reddit(subreddit: str="/r/AskReddit") -> str:
+def scrape_reddit(subreddit: str="/r/AskReddit", base_url: str = BASE_URL, index: ScrapeIndex | None = None, headless: bool = False) -> str | None:
+  from playwright.sync_api import sync_playwright
+
   threads: list[dict[str, str]] = [] # list of dict {title, href}
-  comments: list[dict[str, str]] = [] # list of dict {title, comment_text}
+  writer = ContentWriter(subreddit, index)
 
   # launch playwright to scrape
   with sync_playwright() as p:
     Log.info("Launching browser")
-    browser = p.chromium.launch(headless=False)
+    browser = p.chromium.launch(headless=headless)
     page = browser.new_page()
-    page.goto(BASE_URL + subreddit)
+    page.goto(base_url + subreddit)
 
     Log.info("Fetching thread titles and links")
-    raw_links = page.locator("a.title").all()
+    raw_links = page.locator(THREAD_LINK_SELECTOR).all()
     for link in raw_links:
       href = link.get_attribute("href")
       text = link.text_content()
@@ -38,47 +143,119 @@ def scrape_reddit(subreddit: str="/r/AskReddit") -> str:
       Log.info("Starting main loop to gather post contents")
     else:
       Log.info("Starting main loop to gather top comments")
-    
+
     for i in range(len(threads)):
-      Log.info(f"Gathering {'post content' if SCRAPE_ONLY_POST else 'top comments'} in link {i+1}/{len(threads)}: {threads[i]['title']} at {BASE_URL + threads[i]['href']}")
-      
-      if "/comments/" not in threads[i]["href"]:
-        Log.info(f"Skipping, may be ad")
+      Log.info(f"Gathering {'post content' if SCRAPE_ONLY_POST else 'top comments'} in link {i+1}/{len(threads)}: {threads[i]['title']} at {thread_url(base_url, threads[i]['href'])}")
+
+      if not should_scrape_thread(threads[i], index):
         continue
-      
-      if SKIP_NSFW and "/over18" in threads[i]["href"]:
-        Log.info(f"Skipping not safe for work post")
 
-      page.goto(BASE_URL + threads[i]["href"])
-      
+      page.goto(thread_url(base_url, threads[i]["href"]))
+
       if SCRAPE_ONLY_POST:
-        post_body = page.locator("div.sitetable.linklisting > * > div.entry.unvoted > div.expando > form > div.usertext-body.may-blank-within.md-container")
-        post_body_text = post_body.text_content()
-        if post_body_text is not None:
-          comments.append({"title": threads[i]["title"], "comment_text": clean_text_content(post_body_text)})
+        writer.add_thread(threads[i], thread_records(threads[i], [page.locator(POST_BODY_SELECTOR).text_content()]))
       else:
-        raw_top_comments = page.locator("div.sitetable.nestedlisting > * > div.entry.unvoted > * > div.usertext-body.may-blank-within.md-container").all()
+        writer.add_thread(threads[i], thread_records(threads[i], [comment.text_content() for comment in page.locator(TOP_COMMENT_SELECTOR).all()]))
 
-        for comment in raw_top_comments:
-          comment_text = comment.text_content()
-          if comment_text is not None:
-            comments.append({"title": threads[i]["title"], "comment_text": clean_text_content(comment_text)})
-    
     browser.close()
-    
-  # create output directory if not exists
-  Path("./content").mkdir(parents=True, exist_ok=True)
 
-  # write out json file with content
-  file_name = f"./content/comments-{subreddit.replace('/r/', '')}-{datetime.now().strftime('%m-%d-%y-%H-%M-%S')}.json"
-  Log.info(f"Completed scraping comments, saving to '{file_name}'")
+  return writer.close()
 
-  with open(file_name, "w") as f:
-    json.dump(comments, f)
+# scrape the first page of several subreddits with a pool of `concurrency` pages loading threads at once.
+# only the html of base_url is loaded, images, media, fonts, stylesheets and third-party scripts are blocked
+# returns the file names the content of each subreddit was saved to, None where nothing new was found
+async def scrape_reddit_async(subreddits: list[str], base_url: str = BASE_URL, concurrency: int = SCRAPE_CONCURRENCY, headless: bool = SCRAPE_HEADLESS, index: ScrapeIndex | None = None) -> list[str | None]:
+  from playwright.async_api import async_playwright, Route
 
-  Log.info("Successfully saved content!")
+  base_host = urlparse(base_url).hostname
 
-  return file_name
+  async def block_resources(route: Route) -> None:
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or (request.resource_type == "script" and urlparse(request.url).hostname != base_host):
+      await route.abort()
+    else:
+      await route.continue_()
+
+  async with async_playwright() as p:
+    Log.info(f"Launching browser with {concurrency} pages")
+    browser = await p.chromium.launch(headless=headless)
+    context = await browser.new_context()
+    await context.route("**/*", block_resources)
+    pages = [await context.new_page() for _ in range(max(1, concurrency))]
+
+    # listings first, one subreddit per page
+    async def fetch_listing(page, subreddit: str) -> list[dict[str, str]]:
+      await page.goto(base_url + subreddit, wait_until="domcontentloaded")
+      threads = []
+      for link in await page.locator(THREAD_LINK_SELECTOR).all():
+        href = await link.get_attribute("href")
+        text = await link.text_content()
+        if href is not None and text is not None:
+          threads.append({"title": text, "href": href})
+      Log.info(f"Found {len(threads)} threads in {subreddit}")
+      return threads
+
+    listings: list[list[dict[str, str]]] = []
+    for start in range(0, len(subreddits), len(pages)):
+      batch = subreddits[start:start + len(pages)]
+      listings.extend(await asyncio.gather(*(fetch_listing(page, subreddit) for page, subreddit in zip(pages, batch))))
+
+    # then every thread of every subreddit, each page worker takes the next thread from the queue
+    queue: asyncio.Queue[tuple[int, int, dict[str, str]]] = asyncio.Queue()
+    for subreddit_index, threads in enumerate(listings):
+      for thread_index, thread in enumerate(threads):
+        if should_scrape_thread(thread, index):
+          queue.put_nowait((subreddit_index, thread_index, thread))
+    num_threads = queue.qsize()
+    num_done = 0
+    writers = [ContentWriter(subreddit, index) for subreddit in subreddits]
+    # json output keeps the listing order, streamed output is written as threads finish
+    results: dict[tuple[int, int], list[dict[str, str]]] = {}
+
+    async def page_worker(page) -> None:
+      nonlocal num_done
+      while not queue.empty():
+        subreddit_index, thread_index, thread = queue.get_nowait()
+        url = thread_url(base_url, thread["href"])
+        try:
+          await page.goto(url, wait_until="domcontentloaded")
+          if SCRAPE_ONLY_POST:
+            texts = [await page.locator(POST_BODY_SELECTOR).text_content()]
+          else:
+            texts = [await comment.text_content() for comment in await page.locator(TOP_COMMENT_SELECTOR).all()]
+          records = thread_records(thread, texts)
+          if writers[subreddit_index].streaming:
+            writers[subreddit_index].add_thread(thread, records)
+          else:
+            results[(subreddit_index, thread_index)] = records
+          num_done += 1
+          Log.info(f"Gathered {'post content' if SCRAPE_ONLY_POST else 'top comments'} {num_done}/{num_threads}: {thread['title']} at {url}")
+        except Exception as ex:
+          Log.error(f"Failed to scrape {url}")
+          Log.error(ex)
+
+    await asyncio.gather(*(page_worker(page) for page in pages))
+    await browser.close()
+
+  # keep the listing order in the saved files
+  for subreddit_index, writer in enumerate(writers):
+    for thread_index, thread in enumerate(listings[subreddit_index]):
+      if (subreddit_index, thread_index) in results:
+        writer.add_thread(thread, results[(subreddit_index, thread_index)])
+  return [writer.close() for writer in writers]
 
 if __name__ == "__main__":
-  scrape_reddit(SUBREDDIT)
\ No newline at end of file
+  subreddits = [SUBREDDIT] + [subreddit for subreddit in SUBREDDITS if subreddit != SUBREDDIT]
+  index = open_scrape_index()
+  try:
+    if SCRAPE_BACKEND == "http":
+      from http_scraper import scrape_reddit_http
+      scrape_reddit_http(subreddits, index=index)
+    elif SCRAPE_BACKEND == "async":
+      asyncio.run(scrape_reddit_async(subreddits, index=index))
+    else:
+      for subreddit in subreddits:
+        scrape_reddit(subreddit, index=index)
+  finally:
+    if index is not None:
+      index.close()
@@ -0,0 +1,73 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+
+from consts import SCRAPE_INDEX_PATH, SCRAPE_REVISIT_HOURS, SCRAPE_ONLY_POST
+
+# reddit's id of a thread from its link, e.g. "/r/AskReddit/comments/1abcde/title/" -> "1abcde"
+def thread_id(href: str) -> str | None:
+  match = re.search(r"/comments/([a-z0-9]+)", href)
+  return match.group(1) if match is not None else None
+
+# identifies a scraped comment by its content, the same comment scraped twice hashes the same
+def record_hash(record: dict[str, str]) -> str:
+  return hashlib.sha256(f"{record['title']}\0{record['comment_text']}".encode("utf-8")).hexdigest()
+
+# persistent index of the threads and comments scrape.py has already emitted, so later runs only fetch
+# threads that may have changed and only save comments that were not saved before
+class ScrapeIndex:
+  def __init__(self, path: str = SCRAPE_INDEX_PATH, revisit_hours: float = SCRAPE_REVISIT_HOURS):
+    self.revisit_seconds = revisit_hours * 3600
+    Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+    self._lock = Lock()
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self._db:
+      self._db.execute("CREATE TABLE IF NOT EXISTS threads (id TEXT PRIMARY KEY, subreddit TEXT NOT NULL, title TEXT NOT NULL, only_post INTEGER NOT NULL, scraped REAL NOT NULL)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS comments (hash TEXT PRIMARY KEY, thread TEXT, scraped REAL NOT NULL)")
+
+  # whether a thread was fully scraped before and does not need fetching again. a post body does not change,
+  # top comments are fetched again once the thread was last scraped more than `revisit_hours` ago
+  def is_done(self, href: str) -> bool:
+    id = thread_id(href)
+    if id is None:
+      return False
+    with self._lock:
+      row = self._db.execute("SELECT scraped FROM threads WHERE id = ? AND only_post = ?", (id, int(SCRAPE_ONLY_POST))).fetchone()
+    if row is None:
+      return False
+    return SCRAPE_ONLY_POST or time.time() - row[0] < self.revisit_seconds
+
+  # records not emitted by an earlier scrape, duplicates within `records` are dropped too
+  def unseen(self, records: list[dict[str, str]]) -> list[dict[str, str]]:
+    fresh = []
+    hashes = set()
+    with self._lock:
+      for record in records:
+        hash = record_hash(record)
+        if hash in hashes or self._db.execute("SELECT 1 FROM comments WHERE hash = ?", (hash,)).fetchone() is not None:
+          continue
+        hashes.add(hash)
+        fresh.append(record)
+    return fresh
+
+  # remember threads as fully scraped and their records as emitted, call once the records are saved.
+  # records are tied to their thread by the href they carry, titles are not unique
+  def add(self, subreddit: str, threads: list[dict[str, str]], records: list[dict[str, str]]) -> None:
+    now = time.time()
+    with self._lock, self._db:
+      self._db.executemany("INSERT OR REPLACE INTO threads (id, subreddit, title, only_post, scraped) VALUES (?, ?, ?, ?, ?)",
+                           [(thread_id(thread["href"]), subreddit, thread["title"], int(SCRAPE_ONLY_POST), now) for thread in threads if thread_id(thread["href"]) is not None])
+      self._db.executemany("INSERT OR IGNORE INTO comments (hash, thread, scraped) VALUES (?, ?, ?)",
+                           [(record_hash(record), thread_id(record["href"]), now) for record in records])
+
+  def close(self) -> None:
+    with self._lock:
+      self._db.close()
+
+# the index at SCRAPE_INDEX_PATH, or None if incremental scraping is turned off
+def open_scrape_index() -> ScrapeIndex | None:
+  return ScrapeIndex() if SCRAPE_INDEX_PATH else None
@@ -0,0 +1,78 @@
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, NamedTuple
+
+import pytest
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+class Request(NamedTuple):
+  method: str
+  path: str
+  headers: dict[str, str]
+  body: bytes
+
+# status, headers and body a stand-in server answers with
+Response = tuple[int, dict[str, str], bytes]
+
+# http server on localhost answering every request with `handler(request)`, the requests it got are kept in order
+class StandInServer:
+  def __init__(self, handler: Callable[[Request], Response]):
+    self.handler = handler
+    self.requests: list[Request] = []
+    self._lock = Lock()
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def _respond(self):
+        request = Request(self.command, self.path, dict(self.headers), self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        with server._lock:
+          server.requests.append(request)
+        status, headers, body = server.handler(request)
+        self.send_response(status)
+        for name, value in headers.items():
+          self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      do_GET = _respond
+      do_POST = _respond
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+    self._thread = Thread(target=self._server.serve_forever, name="stand-in-server", daemon=True)
+    self._thread.start()
+
+  def paths(self) -> list[str]:
+    with self._lock:
+      return [request.path for request in self.requests]
+
+  def stop(self) -> None:
+    self._server.shutdown()
+    self._server.server_close()
+
+# starts stand-in servers for a test, `stand_in_server(handler)` returns a running StandInServer
+@pytest.fixture
+def stand_in_server():
+  servers: list[StandInServer] = []
+
+  def start(handler: Callable[[Request], Response]) -> StandInServer:
+    servers.append(StandInServer(handler))
+    return servers[-1]
+  yield start
+  for server in servers:
+    server.stop()
+
+# logs, content files and indexes are written relative to the working directory, keep them out of the repository
+@pytest.fixture(autouse=True)
+def work_in_tmp_path(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
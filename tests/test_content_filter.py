@@ -0,0 +1,63 @@
+import random
+import re
+from fnmatch import fnmatchcase
+
+import pytest
+from better_profanity import profanity
+
+from content_filter import SubstitutionEngine, clean_text, clean_texts, substitutions
+
+# rules that exercise every wildcard form, fnmatch character classes and non-ascii patterns
+WILDCARD_RULES = [("*kill*", "unalive"), ("r?d?", "robot"), ("lol*", "laughing"), ("*ing", "in"), ("caf[eé]", "coffee shop"), ("ß", "ss")]
+
+# the original rule-by-rule substitution the compiled engine has to match
+def substitute_reference(text: str, rules: list[tuple[str, str]]) -> str:
+  def replace_word(word):
+    lower_word = word.lower()
+    for pattern, substitute in rules:
+      lower_pattern = pattern.lower()
+      if fnmatchcase(lower_word, lower_pattern):
+        final_substitute = substitute
+        # *word*
+        if lower_pattern[0] == "*" and lower_pattern[-1] == "*":
+          final_substitute = f"\\1{substitute}\\2"
+        # *word
+        elif lower_pattern[0] == "*":
+          final_substitute = f"\\1{substitute}"
+        # word*
+        elif lower_pattern[-1] == "*":
+          final_substitute = f"{substitute}\\1"
+
+        return re.sub(re.escape(lower_pattern).replace('\\*', '(.*)'), final_substitute, word, flags=re.IGNORECASE)
+    return word
+
+  return ' '.join(replace_word(word) for word in text.split())
+
+# random comment-like texts mixing rule words in different cases and punctuation with ordinary words
+def random_corpus(rules: list[tuple[str, str]], num_texts: int, seed: int = 0) -> list[str]:
+  rng = random.Random(seed)
+  vocabulary = [pattern.replace("*", "x").replace("?", "y") for pattern, _ in rules]
+  vocabulary += ["the", "and", "my", "friend", "said", "killer", "skill", "Kill!", "U.", "r2d2", "café", "\u212aill", "damn", "hell", "wHaT", "ok"]
+  texts = []
+  for _ in range(num_texts):
+    words = []
+    for _ in range(rng.randint(1, 60)):
+      word = rng.choice(vocabulary)
+      words.append(rng.choice([word, word.upper(), word.capitalize()]) + rng.choice(["", "", "", ".", ",", "!", "?"]))
+    texts.append(rng.choice([" ", "  ", "\n"]).join(words))
+  return texts
+
+@pytest.mark.parametrize("rules", [substitutions, WILDCARD_RULES + substitutions, substitutions + WILDCARD_RULES], ids=["shipped", "wildcards-first", "wildcards-last"])
+def test_engine_matches_reference(rules):
+  engine = SubstitutionEngine(rules)
+  for text in random_corpus(rules, 2000):
+    assert engine.substitute(text) == substitute_reference(text, rules), text
+
+def test_clean_text_matches_reference():
+  for text in random_corpus(substitutions, 100, seed=1):
+    assert clean_text(text) == profanity.censor(substitute_reference(text, substitutions)).replace("****", "beep"), text
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_clean_texts_matches_clean_text(workers):
+  texts = random_corpus(substitutions, 40, seed=2)
+  assert clean_texts(texts, workers) == [clean_text(text) for text in texts]
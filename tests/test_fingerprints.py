@@ -0,0 +1,24 @@
+import hashlib
+
+import numpy as np
+
+from fingerprints import _MINHASH_A, _MINHASH_B, _MINHASH_PRIME, SHINGLE_WORDS, minhash_signature, normalize_content
+
+# the permutations computed with python ints, which cannot overflow
+def minhash_reference(text: str) -> list[int]:
+  words = normalize_content(text).split(" ")
+  shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+  prime = int(_MINHASH_PRIME)
+  hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") % prime for shingle in shingles]
+  return [min((int(a) * x + int(b)) % prime for x in hashes) for a, b in zip(_MINHASH_A, _MINHASH_B)]
+
+def test_minhash_matches_reference():
+  for text in ["ok", "the quick brown fox jumps over the lazy dog", "My roommate ate my leftovers AGAIN and then lied about it. " * 20]:
+    assert minhash_signature(text).tolist() == minhash_reference(text), text
+
+def test_minhash_similar_texts_share_values():
+  text = " ".join(f"word{i}" for i in range(200))
+  edited = text.replace("word100 ", "changed ")
+  unrelated = " ".join(f"other{i}" for i in range(200))
+  assert np.mean(minhash_signature(text) == minhash_signature(edited)) > 0.8
+  assert np.mean(minhash_signature(text) == minhash_signature(unrelated)) < 0.1
@@ -0,0 +1,164 @@
+import email.parser
+import email.policy
+import json
+import time
+from threading import Lock, Thread
+
+import pytest
+
+import gentle_client
+from gentle_client import CircuitBreaker, GentleClient, GentleError
+
+# transcript of a multipart alignment request
+def request_transcript(request) -> str:
+  message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(f"Content-Type: {request.headers['Content-Type']}\r\n\r\n".encode() + request.body)
+  parts = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True) for part in message.iter_parts()}
+  return parts["transcript"].decode("utf-8")
+
+# gentle's answer, one word per second of the transcript
+def words_response(transcript: str):
+  words = [{"word": word, "start": i, "end": i + 1, "case": "success"} for i, word in enumerate(transcript.split())]
+  return 200, {"Content-Type": "application/json"}, json.dumps({"words": words}).encode("utf-8")
+
+def aligning(request):
+  return words_response(request_transcript(request))
+
+def failing(request):
+  return 500, {}, b"internal error"
+
+# answers with the statuses in `statuses` first, then aligns
+def scripted(statuses: list[int]):
+  statuses = list(statuses)
+  lock = Lock()
+
+  def handler(request):
+    with lock:
+      status = statuses.pop(0) if statuses else 200
+    return words_response(request_transcript(request)) if status == 200 else (status, {}, b"error")
+  return handler
+
+# backoff sleeps of the client, without waiting
+@pytest.fixture
+def sleeps(monkeypatch):
+  delays = []
+  monkeypatch.setattr(gentle_client.time, "sleep", delays.append)
+  return delays
+
+def test_align_returns_words(stand_in_server):
+  server = stand_in_server(aligning)
+  client = GentleClient([server.url])
+  assert [word["word"] for word in client.align(b"RIFF", "hello there world")] == ["hello", "there", "world"]
+  assert server.paths() == ["/transcriptions?async=false"]
+  client.close()
+
+def test_retries_server_errors_with_backoff(stand_in_server, sleeps):
+  server = stand_in_server(scripted([500, 503]))
+  client = GentleClient([server.url], max_retries=3, backoff=2)
+  assert len(client.align(b"RIFF", "hello world")) == 2
+  assert len(server.requests) == 3
+  # backoff doubles after every attempt, with up to 50% jitter either way
+  assert len(sleeps) == 2
+  assert 1 <= sleeps[0] <= 3 and 2 <= sleeps[1] <= 6
+  client.close()
+
+def test_gives_up_after_max_retries(stand_in_server, sleeps):
+  server = stand_in_server(failing)
+  client = GentleClient([server.url], max_retries=2, backoff=1, breaker_threshold=10)
+  with pytest.raises(GentleError):
+    client.align(b"RIFF", "hello world")
+  assert len(server.requests) == 3
+  client.close()
+
+def test_circuit_breaker_cycle(monkeypatch):
+  now = [100.0]
+  monkeypatch.setattr(gentle_client.time, "monotonic", lambda: now[0])
+  breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+  breaker.record_failure()
+  assert breaker.allow()
+  breaker.record_failure()
+  # open: nothing goes through until the reset timeout passed
+  assert not breaker.allow()
+  now[0] += 10
+  # half open: a single trial request
+  assert breaker.allow()
+  assert not breaker.allow()
+  # a failed trial opens it again
+  breaker.record_failure()
+  assert not breaker.allow()
+  now[0] += 10
+  assert breaker.allow()
+  # a successful trial closes it
+  breaker.record_success()
+  assert breaker.allow() and breaker.allow()
+
+def test_open_breaker_stops_requests(stand_in_server, sleeps):
+  server = stand_in_server(failing)
+  client = GentleClient([server.url], max_retries=4, backoff=1, breaker_threshold=2, breaker_reset=60)
+  with pytest.raises(GentleError, match="circuit breaker open"):
+    client.align(b"RIFF", "hello world")
+  # the breaker tripped after two failures, the remaining attempts never reached the server
+  assert len(server.requests) == 2
+  client.close()
+
+def test_round_robin_across_servers(stand_in_server):
+  servers = [stand_in_server(aligning) for _ in range(3)]
+  client = GentleClient([server.url for server in servers])
+  for _ in range(6):
+    client.align(b"RIFF", "hello")
+  assert [len(server.requests) for server in servers] == [2, 2, 2]
+  client.close()
+
+def test_failing_server_is_skipped(stand_in_server, sleeps):
+  broken = stand_in_server(failing)
+  working = stand_in_server(aligning)
+  client = GentleClient([broken.url, working.url], max_retries=1, backoff=1, breaker_threshold=1, breaker_reset=60)
+  for _ in range(4):
+    client.align(b"RIFF", "hello")
+  # the first request fails over to the working server, after that the broken one's breaker is open
+  assert len(broken.requests) == 1
+  assert len(working.requests) == 4
+  client.close()
+
+def test_in_flight_limit(stand_in_server):
+  lock = Lock()
+  in_flight = [0, 0] # now, most at once
+
+  def slow(request):
+    with lock:
+      in_flight[0] += 1
+      in_flight[1] = max(in_flight[1], in_flight[0])
+    time.sleep(0.2)
+    with lock:
+      in_flight[0] -= 1
+    return aligning(request)
+
+  server = stand_in_server(slow)
+  client = GentleClient([server.url], max_in_flight=2)
+  threads = [Thread(target=client.align, args=(b"RIFF", "hello")) for _ in range(6)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(server.requests) == 6
+  assert in_flight[1] == 2
+  client.close()
+
+def test_align_many_keeps_order_and_reports_failures(stand_in_server, tmp_path):
+  def handler(request):
+    transcript = request_transcript(request)
+    return failing(request) if transcript == "broken" else words_response(transcript)
+
+  servers = [stand_in_server(handler) for _ in range(2)]
+  client = GentleClient([server.url for server in servers], max_in_flight=3, max_retries=0, breaker_threshold=100)
+  transcripts = ["one", "two words", "broken", "three words here", "four words are here"]
+  items = []
+  for i, transcript in enumerate(transcripts):
+    (tmp_path / f"{i}.wav").write_bytes(b"RIFF")
+    (tmp_path / f"{i}.txt").write_text(transcript)
+    items.append((str(tmp_path / f"{i}.wav"), str(tmp_path / f"{i}.txt")))
+
+  results = client.align_many(items)
+  assert isinstance(results[2], GentleError)
+  assert [[word["word"] for word in words] for i, words in enumerate(results) if i != 2] == [transcript.split() for i, transcript in enumerate(transcripts) if i != 2]
+  assert all(len(server.requests) > 0 for server in servers)
+  client.close()
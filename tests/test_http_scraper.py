@@ -0,0 +1,120 @@
+import json
+import os
+import re
+import time
+from email.utils import formatdate
+from urllib.parse import urlsplit
+
+import pytest
+
+import http_scraper
+from conftest import FIXTURES_DIR
+from http_scraper import RedditHttpScraper, retry_after_seconds
+from scrape_index import ScrapeIndex
+
+RECORDED_DIR = os.path.join(FIXTURES_DIR, "reddit_json")
+
+# recorded responses of reddit's json endpoints: the AskReddit listing and one file per thread
+def recorded(request):
+  path = urlsplit(request.path).path
+  match = re.fullmatch(r"/r/AskReddit/comments/([a-z0-9]+)/[^/]+/\.json", path)
+  if path == "/r/AskReddit/.json":
+    file_name = "listing-AskReddit.json"
+  elif match is not None:
+    file_name = f"thread-{match.group(1)}.json"
+  else:
+    return 404, {}, b""
+  with open(os.path.join(RECORDED_DIR, file_name), "rb") as f:
+    return 200, {"Content-Type": "application/json"}, f.read()
+
+# records of the recorded threads after clean_text_content
+EXPECTED_RECORDS = [
+  {"title": "What's the best advice you ever ignored?", "comment_text": "Wear sunscreen. I did not, and now I look like a leather handbag grinning face with sweat emoji"},
+  {"title": "What's the best advice you ever ignored?", "comment_text": "\"Save for retirement early.\" Compound interest is no joke & I learned that the hard way.\n\nRead more at  if you care."},
+  {"title": "Which food is overrated & why?", "comment_text": "Avocado toast. It's just mashed fruit on bread."},
+]
+
+# delays the scraper waited, without waiting
+@pytest.fixture
+def sleeps(monkeypatch):
+  delays = []
+  monkeypatch.setattr(http_scraper.time, "sleep", delays.append)
+  return delays
+
+def scrape(url: str, index: ScrapeIndex | None = None) -> list[dict[str, str]] | None:
+  scraper = RedditHttpScraper(url, requests_per_second=0, index=index)
+  try:
+    file_name = scraper.scrape("/r/AskReddit")
+  finally:
+    scraper.close()
+  if file_name is None:
+    return None
+  with open(file_name, "r") as f:
+    return json.load(f)
+
+def test_scrape_recorded_responses(stand_in_server):
+  server = stand_in_server(recorded)
+  assert scrape(server.url) == EXPECTED_RECORDS
+  # link and nsfw posts are never fetched, the malformed listing entry is skipped and the malformed thread fails alone
+  assert sorted(urlsplit(path).path for path in server.paths()) == [
+    "/r/AskReddit/.json",
+    "/r/AskReddit/comments/1f00001/whats_the_best_advice_you_ever_ignored/.json",
+    "/r/AskReddit/comments/1f00002/which_food_is_overrated_why/.json",
+    "/r/AskReddit/comments/1f00006/whats_a_skill_everyone_should_learn/.json",
+  ]
+  assert all(request.headers["User-Agent"] == http_scraper.SCRAPE_USER_AGENT for request in server.requests)
+
+def test_fetch_threads_skips_malformed_entries(stand_in_server):
+  server = stand_in_server(recorded)
+  scraper = RedditHttpScraper(server.url, requests_per_second=0)
+  threads = scraper.fetch_threads("/r/AskReddit")
+  scraper.close()
+  assert [thread["href"].split("/")[4] for thread in threads] == ["1f00001", "1f00002", "1f00003", "1f00004", "1f00006"]
+  assert [thread["over_18"] for thread in threads] == [False, False, False, True, False]
+
+def test_index_skips_scraped_threads(stand_in_server, tmp_path):
+  server = stand_in_server(recorded)
+  index = ScrapeIndex(str(tmp_path / "scraped.sqlite"))
+  assert scrape(server.url, index) == EXPECTED_RECORDS
+  num_requests = len(server.requests)
+  # only the thread that failed is fetched again, and it has nothing new
+  assert scrape(server.url, index) is None
+  assert [urlsplit(path).path.split("/")[4] for path in server.paths()[num_requests + 1:]] == ["1f00006"]
+  index.close()
+
+# answers the first request of every path with 429 and `retry_after`, then with the recording
+def rate_limited(retry_after: str):
+  seen = set()
+
+  def handler(request):
+    if request.path not in seen:
+      seen.add(request.path)
+      return 429, {"Retry-After": retry_after}, b""
+    return recorded(request)
+  return handler
+
+def test_retry_after_seconds(stand_in_server, sleeps):
+  server = stand_in_server(rate_limited("7"))
+  assert scrape(server.url) == EXPECTED_RECORDS
+  assert sleeps == [7.0] * 4
+
+def test_retry_after_http_date(stand_in_server, sleeps):
+  server = stand_in_server(rate_limited(formatdate(time.time() + 120, usegmt=True)))
+  assert scrape(server.url) == EXPECTED_RECORDS
+  assert len(sleeps) == 4 and all(100 < delay <= 120 for delay in sleeps)
+
+def test_gives_up_when_rate_limited(stand_in_server, sleeps):
+  server = stand_in_server(lambda request: (429, {"Retry-After": "1"}, b""))
+  scraper = RedditHttpScraper(server.url, requests_per_second=0, max_retries=2)
+  with pytest.raises(http_scraper.requests.HTTPError):
+    scraper.get_json("/r/AskReddit/.json")
+  scraper.close()
+  assert len(server.requests) == 3
+
+def test_retry_after_parsing():
+  assert retry_after_seconds(None, 4) == 4
+  assert retry_after_seconds("2.5", 4) == 2.5
+  assert retry_after_seconds("-3", 4) == 0
+  assert retry_after_seconds("soon", 4) == 4
+  assert retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT", 4) == 0
+  assert 58 < retry_after_seconds(formatdate(time.time() + 60, usegmt=True), 4) <= 60
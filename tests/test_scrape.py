@@ -0,0 +1,84 @@
+import asyncio
+import json
+import os
+import re
+from urllib.parse import urlsplit
+
+import pytest
+
+pytest.importorskip("playwright")
+
+from conftest import FIXTURES_DIR
+from scrape import scrape_reddit, scrape_reddit_async
+from scrape_index import ScrapeIndex
+
+PAGES_DIR = os.path.join(FIXTURES_DIR, "old_reddit")
+
+# saved old.reddit pages with relative links: the AskReddit listing and the threads it links to.
+# everything else, like stylesheets, fonts and images, is not found
+def old_reddit(request):
+  path = urlsplit(request.path).path
+  match = re.fullmatch(r"/r/AskReddit/comments/([a-z0-9]+)/[^/]+/", path)
+  file_name = "listing-AskReddit.html" if path.rstrip("/") == "/r/AskReddit" else f"thread-{match.group(1)}.html" if match is not None else None
+  if file_name is None or not os.path.exists(os.path.join(PAGES_DIR, file_name)):
+    return 404, {"Content-Type": "text/plain"}, b"not found"
+  with open(os.path.join(PAGES_DIR, file_name), "rb") as f:
+    return 200, {"Content-Type": "text/html; charset=utf-8"}, f.read()
+
+EXPECTED_RECORDS = [
+  {"title": "What's the best advice you ever ignored?", "comment_text": "Wear sunscreen. I did not, and now I look like a leather handbag grinning face with sweat emoji"},
+  {"title": "What's the best advice you ever ignored?", "comment_text": "\"Save for retirement early.\" Compound interest is no joke & I learned that the hard way.\nRead more at  if you care."},
+  {"title": "Which food is overrated & why?", "comment_text": "Avocado toast. It's just mashed fruit on bread."},
+  {"title": "What's a skill everyone should learn?", "comment_text": "Cooking a few basic meals cooking emoji  saves so much money."},
+  {"title": "What's a skill everyone should learn?", "comment_text": "Changing a tire."},
+]
+
+FOOD_THREAD = "/r/AskReddit/comments/1f00002/which_food_is_overrated_why/"
+
+# playwright is installed but may have no browser to launch
+@pytest.fixture(scope="module", autouse=True)
+def browser():
+  from playwright.sync_api import Error, sync_playwright
+  try:
+    with sync_playwright() as p:
+      p.chromium.launch(headless=True).close()
+  except Error as ex:
+    pytest.skip(f"playwright can not launch chromium: {str(ex).splitlines()[0]}")
+
+def load(file_name: str | None) -> list[dict[str, str]] | None:
+  if file_name is None:
+    return None
+  with open(file_name, "r") as f:
+    return json.load(f)
+
+def test_async_scraper_matches_sync_scraper(stand_in_server):
+  server = stand_in_server(old_reddit)
+  assert load(scrape_reddit("/r/AskReddit", server.url, headless=True)) == EXPECTED_RECORDS
+  num_requests = len(server.requests)
+  assert [load(file_name) for file_name in asyncio.run(scrape_reddit_async(["/r/AskReddit"], server.url, concurrency=2, headless=True))] == [EXPECTED_RECORDS]
+
+  # the nsfw thread is never opened, and the async scraper does not load stylesheets, fonts or images
+  assert not any(path.startswith("/over18") for path in server.paths())
+  async_paths = [urlsplit(path).path for path in server.paths()[num_requests:]]
+  assert not any(path.startswith("/static/") for path in async_paths)
+  assert sorted(path for path in async_paths if path.startswith("/r/")) == [
+    "/r/AskReddit",
+    "/r/AskReddit/comments/1f00001/whats_the_best_advice_you_ever_ignored/",
+    FOOD_THREAD,
+    "/r/AskReddit/comments/1f00006/whats_a_skill_everyone_should_learn/",
+  ]
+
+def test_async_scraper_skips_indexed_threads(stand_in_server, tmp_path):
+  server = stand_in_server(old_reddit)
+  index = ScrapeIndex(str(tmp_path / "scraped.sqlite"))
+  index.add("/r/AskReddit", [{"title": "Which food is overrated & why?", "href": FOOD_THREAD}], [])
+
+  [file_name] = asyncio.run(scrape_reddit_async(["/r/AskReddit"], server.url, concurrency=2, headless=True, index=index))
+  assert load(file_name) == [record for record in EXPECTED_RECORDS if record["title"] != "Which food is overrated & why?"]
+  assert FOOD_THREAD not in server.paths()
+
+  # every thread is indexed now, a second run only loads the listing
+  num_requests = len(server.requests)
+  assert asyncio.run(scrape_reddit_async(["/r/AskReddit"], server.url, concurrency=2, headless=True, index=index)) == [None]
+  assert [path for path in server.paths()[num_requests:] if path.startswith("/r/")] == ["/r/AskReddit"]
+  index.close()
@@ -0,0 +1,17 @@
+from scrape import thread_records
+from scrape_index import ScrapeIndex
+
+def test_same_title_threads_keep_their_own_comments(tmp_path):
+  index = ScrapeIndex(str(tmp_path / "scraped.sqlite"))
+  threads = [
+    {"title": "What's your unpopular opinion?", "href": "/r/AskReddit/comments/1f00001/whats_your_unpopular_opinion/"},
+    {"title": "What's your unpopular opinion?", "href": "/r/AskReddit/comments/1f00002/whats_your_unpopular_opinion/"},
+  ]
+  records = thread_records(threads[0], ["Pineapple belongs on pizza."]) + thread_records(threads[1], ["Mornings are the best part of the day."])
+  index.add("/r/AskReddit", threads, records)
+
+  assert all(index.is_done(thread["href"]) for thread in threads)
+  assert index.unseen(records) == []
+  comments = dict(index._db.execute("SELECT thread, hash FROM comments").fetchall())
+  assert sorted(comments) == ["1f00001", "1f00002"]
+  index.close()
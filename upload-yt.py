@@ -4,7 +4,8 @@ import shutil
 from pathlib import Path
 
 from consts import DESCRIPTION, UPLOAD_WAIT_TIME, UPLOAD_INTERVAL, UPLOAD_START_INDEX, UPLOAD_END_INDEX
-from util import Log, validate_file_extension
+from util import Log, Metrics, validate_file_extension, clean_file_name, new_metrics
+from fingerprints import open_fingerprint_index
 
 def upload_one_video(page: Page, video_path: str) -> None:
   Log.info(f"Starting upload of {video_path}")
@@ -93,6 +94,9 @@ def upload_all_videos() -> None:
   # create out/done/ folder for completed uploads if not already exist
   Path("./out/done").mkdir(parents=True, exist_ok=True)
 
+  # uploaded content is marked so it is never rendered again
+  fingerprints = open_fingerprint_index()
+
   # launch browser with persistent context
   with sync_playwright() as p:
     device = p.devices["Desktop Chrome HiDPI"]
@@ -144,9 +148,14 @@ def upload_all_videos() -> None:
         continue
 
       # attempt upload and move to done/
+      metrics = new_metrics()
       try:
-        upload_one_video(page, video_path)
+        with Metrics.recording(metrics), Metrics.timer("upload"), Metrics.profile("upload", clean_file_name(video)):
+          upload_one_video(page, video_path)
+        Metrics.write_record("upload", "uploaded", metrics, video=video, size=os.path.getsize(video_path))
         Log.info(f"Completed uploading {video}")
+        if fingerprints is not None and not fingerprints.mark_uploaded(video):
+          Log.verbose(f"{video} is not in the content fingerprint index")
         # move file to done/ folder
         try:
           shutil.move(video_path, f"./out/done/{video}")
@@ -157,6 +166,7 @@ def upload_all_videos() -> None:
       except Exception as ex:
         Log.error(f"Failed to upload {videos[i]}")
         Log.error(ex)
+        Metrics.write_record("upload", "failed", metrics, video=video, error=str(ex))
         # return to main page ("refresh")
         page.goto("https://studio.youtube.com")
       
@@ -165,7 +175,11 @@ def upload_all_videos() -> None:
       page.wait_for_timeout(UPLOAD_INTERVAL * 1000)
 
     Log.info(f"Completed uploading {end_index - start_index} videos!")
+    Metrics.summarize("upload")
     browser.close()
 
+  if fingerprints is not None:
+    fingerprints.close()
+
 if __name__ == "__main__":
   upload_all_videos()
\ No newline at end of file
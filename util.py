@@ -1,14 +1,16 @@
 from datetime import datetime
+import json
 import os
 import re
 import subprocess
+import threading
+import time
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
-from typing import Any, TextIO
+from typing import Any, Iterator, NamedTuple, TextIO
 import atexit
 
-from consts import LOG_VERBOSITY
-
 VIDEO_CONTAINERS = [".mp4", ".mov", ".mkv", ".avi", ".flv", ".webm", ".3gp"]
 AUDIO_CONTAINERS = [".mp3", ".wav", ".aiff", ".flac", ".m4a", ".ogg", ".mka"]
 
@@ -30,6 +32,60 @@ FFMPEG_ENCODER_STRINGS: dict[GpuDevice, tuple[str, str]] = {
   GpuDevice.METAL: ("videotoolbox", "h264_videotoolbox")
 }
 
+# video encoder settings of a quality / speed trade-off, the named profiles are in ENCODE_PROFILES in consts
+# preset and tune are x264's. with a crf the quality is constant and `bitrate` caps it, without one `bitrate`
+# is the target. hardware encoders only use the bitrate and the GOP length (seconds between keyframes)
+class EncodeProfile(NamedTuple):
+  preset: str
+  crf: int | None
+  bitrate: str
+  tune: str | None
+  gop_seconds: float | None
+
+# number of encodes that run at the same time on this machine, every encoder gets its share of the cores
+_concurrent_encodes = 1
+
+# set by the render modes: worker processes in parallel mode, encode workers in pipeline mode, split workers when normalizing
+def set_concurrent_encodes(num_encodes: int) -> None:
+  global _concurrent_encodes
+  _concurrent_encodes = max(1, num_encodes)
+
+# threads for one x264 encode, ENCODE_THREADS or the cpu cores split between the concurrent encodes
+def encoder_threads() -> int:
+  from consts import ENCODE_THREADS
+  if ENCODE_THREADS > 0:
+    return ENCODE_THREADS
+  return max(1, (os.cpu_count() or 1) // _concurrent_encodes)
+
+# lossless x264 output options for intermediate video that is encoded again, like the background windows of
+# streaming composition. not from a profile, any loss here would be encoded a second time
+def intermediate_encoder_args() -> list[str]:
+  return ["-c:v", "libx264", "-preset", "ultrafast", "-qp", "0", "-threads", str(encoder_threads())]
+
+# output options that select and configure the video encoder for `device` from an encode profile,
+# ENCODE_PROFILE by default. goes right before the output file
+def encoder_args(profile: str | None = None, device: GpuDevice | None = None) -> list[str]:
+  # imported here since consts imports GpuDevice from this module
+  from consts import ENCODE_PROFILE, ENCODE_PROFILES, FFMPEG_ACCELERATION, FPS
+  name = profile if profile is not None else ENCODE_PROFILE
+  if name not in ENCODE_PROFILES:
+    raise ValueError(f"Unknown encode profile '{name}', expected one of: {', '.join(ENCODE_PROFILES)}")
+  settings = ENCODE_PROFILES[name]
+  device = device if device is not None else FFMPEG_ACCELERATION
+  gop = ["-g", str(max(1, round(settings.gop_seconds * FPS)))] if settings.gop_seconds is not None else []
+
+  if device != GpuDevice.CPU and device in FFMPEG_ENCODER_STRINGS:
+    return ["-c:v", FFMPEG_ENCODER_STRINGS[device][1], "-b:v", settings.bitrate] + gop
+
+  args = ["-c:v", "libx264", "-preset", settings.preset]
+  if settings.crf is not None:
+    args += ["-crf", str(settings.crf), "-maxrate", settings.bitrate, "-bufsize", settings.bitrate]
+  else:
+    args += ["-b:v", settings.bitrate]
+  if settings.tune:
+    args += ["-tune", settings.tune]
+  return args + gop + ["-threads", str(encoder_threads())]
+
 class Log:
   _log_file: TextIO | None = None
 
@@ -48,11 +104,13 @@ class Log:
     
     Path("./logs").mkdir(parents=True, exist_ok=True)
     log_path: str = f"./logs/run-{datetime.now().strftime('%m-%d-%y-%H-%M-%S')}.txt"
-    log_file = open(log_path, "a")
-    atexit.register(log_file.close)
+    Log._log_file = open(log_path, "a")
+    atexit.register(Log._log_file.close)
   
   @staticmethod
   def _should_log(level: str) -> bool:
+    # imported here since consts imports GpuDevice from this module
+    from consts import LOG_VERBOSITY
     # should only log with level >= configured LOG_VERBOSITY, with default verbosity of "verbose"
     return Log._log_levels.get(level, 99) >= Log._log_levels.get(LOG_VERBOSITY, 0)
 
@@ -94,6 +152,194 @@ class Log:
   def fatal(message: Any, show_timestamp: bool = True) -> None:
     Log._log(message, "fatal", show_timestamp)
 
+# a job's metrics record: seconds spent per stage and counters, filled in by `Metrics.timer` and `Metrics.count`
+def new_metrics() -> dict[str, dict[str, float]]:
+  return {"timings": {}, "counters": {}}
+
+# linear interpolation between closest ranks, `q` from 0 to 1
+def percentile(values: list[float], q: float) -> float:
+  if len(values) == 0:
+    return 0
+  ordered = sorted(values)
+  position = (len(ordered) - 1) * q
+  lower = int(position)
+  upper = min(lower + 1, len(ordered) - 1)
+  return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+# machine readable counterpart of `Log`: per stage timers and counters of every job, written as one json line per
+# job to METRICS_DIR/jobs-<run>.jsonl, summarized as p50/p95 per stage at the end of a batch and kept up to date in
+# a prometheus text file. timers and counters go to the record of the job the current thread is working on, so
+# helpers deep inside a stage (ffprobe, ffmpeg) add to the right job without passing it around
+class Metrics:
+  _run_name: str = datetime.now().strftime('%m-%d-%y-%H-%M-%S')
+  _lock = threading.Lock()
+  _current = threading.local()
+  # every recorded job's stage timings and counters of this run, by kind of job
+  _timings: dict[str, dict[str, list[float]]] = {}
+  _counters: dict[str, dict[str, float]] = {}
+  _results: dict[str, dict[str, int]] = {}
+
+  @staticmethod
+  def _enabled() -> bool:
+    # imported here since consts imports GpuDevice from this module
+    from consts import METRICS_DIR
+    return METRICS_DIR != ""
+
+  # make `record` the current thread's job record while the block runs
+  @staticmethod
+  @contextmanager
+  def recording(record: dict[str, dict[str, float]]) -> Iterator[None]:
+    previous = getattr(Metrics._current, "record", None)
+    Metrics._current.record = record
+    try:
+      yield
+    finally:
+      Metrics._current.record = previous
+
+  # add the seconds the block takes to `name` in the current job record. a timer inside another one is recorded
+  # as "<outer>.<name>", e.g. "speed.probe", and its time is part of the outer timer's
+  @staticmethod
+  @contextmanager
+  def timer(name: str) -> Iterator[None]:
+    stack: list[str] = Metrics._current.__dict__.setdefault("timers", [])
+    name = f"{stack[-1]}.{name}" if len(stack) > 0 else name
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      stack.pop()
+      record = getattr(Metrics._current, "record", None)
+      if record is not None:
+        record["timings"][name] = record["timings"].get(name, 0) + time.perf_counter() - start
+
+  # add `value` to counter `name` of the current job record
+  @staticmethod
+  def count(name: str, value: float = 1) -> None:
+    record = getattr(Metrics._current, "record", None)
+    if record is not None:
+      record["counters"][name] = record["counters"].get(name, 0) + value
+
+  # run the block under cProfile or tracemalloc if `stage` is in PROFILE_STAGES, results are saved to
+  # METRICS_DIR/profiles/<run>/<job>-<stage>.prof (load with pstats or snakeviz) or .txt (top allocations)
+  @staticmethod
+  @contextmanager
+  def profile(stage: str, job_name: str) -> Iterator[None]:
+    from consts import METRICS_DIR, PROFILE_STAGES, PROFILE_MODE
+    if stage not in PROFILE_STAGES or METRICS_DIR == "":
+      yield
+      return
+
+    profile_dir = os.path.join(METRICS_DIR, "profiles", Metrics._run_name)
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    profile_path = os.path.join(profile_dir, f"{job_name}-{stage}")
+    if PROFILE_MODE == "tracemalloc":
+      import tracemalloc
+      # tracemalloc traces every thread, stages running at the same time in pipeline mode show up in each other's dumps
+      started = not tracemalloc.is_tracing()
+      if started:
+        tracemalloc.start(25)
+      tracemalloc.reset_peak()
+      before = tracemalloc.take_snapshot()
+      try:
+        yield
+      finally:
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        before = before.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        _, peak = tracemalloc.get_traced_memory()
+        if started:
+          tracemalloc.stop()
+        with open(profile_path + ".txt", "w", encoding="utf-8") as f:
+          f.write(f"peak traced memory: {peak / 2 ** 20:.1f} MiB\n\ntop allocations made during '{stage}':\n")
+          for stat in snapshot.compare_to(before, "lineno")[:30]:
+            f.write(f"{stat}\n")
+    else:
+      import cProfile
+      # profiles the calling thread only, work handed to other processes is not included
+      profiler = cProfile.Profile()
+      profiler.enable()
+      try:
+        yield
+      finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path + ".prof")
+
+  # save a finished job's record and update the batch statistics and prometheus file
+  # `kind` separates e.g. renders from uploads, `result` is what happened to the job ("exported", "failed", ...)
+  @staticmethod
+  def write_record(kind: str, result: str, record: dict[str, dict[str, float]], **fields: Any) -> None:
+    if not Metrics._enabled():
+      return
+    from consts import METRICS_DIR
+    line = {"kind": kind, "result": result, "time": datetime.now().isoformat(timespec="seconds"), **fields,
+            "total": sum(seconds for name, seconds in record["timings"].items() if "." not in name), "timings": record["timings"], "counters": record["counters"]}
+
+    with Metrics._lock:
+      Path(METRICS_DIR).mkdir(parents=True, exist_ok=True)
+      with open(os.path.join(METRICS_DIR, f"{kind}s-{Metrics._run_name}.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(line, default=str) + "\n")
+      for name, seconds in record["timings"].items():
+        Metrics._timings.setdefault(kind, {}).setdefault(name, []).append(seconds)
+      for name, value in record["counters"].items():
+        counters = Metrics._counters.setdefault(kind, {})
+        counters[name] = counters.get(name, 0) + value
+      results = Metrics._results.setdefault(kind, {})
+      results[result] = results.get(result, 0) + 1
+      Metrics._write_prometheus()
+
+  # prometheus text exposition of this run's statistics, rewritten after every job so it can be scraped
+  # while the batch runs, e.g. by node_exporter's textfile collector
+  @staticmethod
+  def _write_prometheus() -> None:
+    from consts import METRICS_DIR
+    lines = ["# HELP calersvm_stage_seconds Seconds a job spent in each stage during this run",
+             "# TYPE calersvm_stage_seconds summary"]
+    for kind, stages in sorted(Metrics._timings.items()):
+      for stage, values in sorted(stages.items()):
+        labels = f'kind="{kind}",stage="{stage}"'
+        lines.append(f'calersvm_stage_seconds{{{labels},quantile="0.5"}} {percentile(values, 0.5):.6f}')
+        lines.append(f'calersvm_stage_seconds{{{labels},quantile="0.95"}} {percentile(values, 0.95):.6f}')
+        lines.append(f"calersvm_stage_seconds_sum{{{labels}}} {sum(values):.6f}")
+        lines.append(f"calersvm_stage_seconds_count{{{labels}}} {len(values)}")
+    lines += ["# HELP calersvm_jobs_total Jobs finished during this run by result", "# TYPE calersvm_jobs_total counter"]
+    for kind, results in sorted(Metrics._results.items()):
+      for result, count in sorted(results.items()):
+        lines.append(f'calersvm_jobs_total{{kind="{kind}",result="{result}"}} {count}')
+    lines += ["# HELP calersvm_job_counter Sum of a per job counter during this run", "# TYPE calersvm_job_counter counter"]
+    for kind, counters in sorted(Metrics._counters.items()):
+      for name, value in sorted(counters.items()):
+        lines.append(f'calersvm_job_counter{{kind="{kind}",name="{name}"}} {value:g}')
+
+    path = os.path.join(METRICS_DIR, "calersvm.prom")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+      f.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+  # log p50/p95 per stage of the jobs of `kind` recorded so far and save them to METRICS_DIR/summary-<run>.json
+  @staticmethod
+  def summarize(kind: str) -> None:
+    if not Metrics._enabled():
+      return
+    from consts import METRICS_DIR
+    with Metrics._lock:
+      stages = Metrics._timings.get(kind, {})
+      if len(stages) == 0:
+        return
+      summary = {stage: {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "total": sum(values)} for stage, values in stages.items()}
+      Log.info(f"Stage timings of {sum(Metrics._results.get(kind, {}).values())} {kind} jobs (p50 / p95 / total):")
+      for stage, stats in summary.items():
+        Log.info(f"  {stage}: {stats['p50']:.2f}s / {stats['p95']:.2f}s / {stats['total']:.0f}s over {stats['count']} jobs", show_timestamp=False)
+
+      path = os.path.join(METRICS_DIR, f"summary-{Metrics._run_name}.json")
+      try:
+        with open(path, "r", encoding="utf-8") as f:
+          summaries = json.load(f)
+      except (OSError, ValueError):
+        summaries = {}
+      summaries[kind] = {"stages": summary, "results": Metrics._results.get(kind, {}), "counters": Metrics._counters.get(kind, {})}
+      with open(path, "w", encoding="utf-8") as f:
+        json.dump(summaries, f, indent=2)
+
 # general validate file extension but defaults to video
 def validate_file_extension(filename: str, valid_extensions: list[str]=VIDEO_CONTAINERS) -> bool:
   _, extension = os.path.splitext(filename)
@@ -128,13 +374,28 @@ def clean_file_name(filename: str, replacement_text: str="") -> str:
 # source: https://stackoverflow.com/a/3844467
 # get length of video or audio file using ffmpeg in seconds
 def get_video_length(filename: str) -> float:
-  result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
-                             "format=duration", "-of",
-                             "default=noprint_wrappers=1:nokey=1", filename],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
+  with Metrics.timer("probe"):
+    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
+                               "format=duration", "-of",
+                               "default=noprint_wrappers=1:nokey=1", filename],
+              stdout=subprocess.PIPE,
+              stderr=subprocess.STDOUT)
   return float(result.stdout)
 
+# get (width, height, duration in seconds, frames per second) of the first video stream using ffprobe
+def probe_video(filename: str) -> tuple[int, int, float, float]:
+  with Metrics.timer("probe"):
+    result = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
+                               "stream=width,height,avg_frame_rate:format=duration", "-of", "json", filename],
+              stdout=subprocess.PIPE,
+              stderr=subprocess.STDOUT,
+              check=True)
+  info = json.loads(result.stdout)
+  stream = info["streams"][0]
+  numerator, _, denominator = stream.get("avg_frame_rate", "0/1").partition("/")
+  fps = float(numerator) / float(denominator) if denominator and float(denominator) != 0 else 0.0
+  return (int(stream["width"]), int(stream["height"]), float(info["format"]["duration"]), fps)
+
 # replaces placeholders in the format `%tag` with corresponding keyword arguments.
 def format_string(template: str, **kwargs) -> str:
   # match placeholders like %tag
@@ -147,6 +408,7 @@ def format_string(template: str, **kwargs) -> str:
   return pattern.sub(replace_match, template)
 
 # insert hardware acceleration components to ffmpeg command list
+# an existing `-c:v` is switched to the hardware encoder, so the command never ends up with two of them
 def add_hwaccel_to_ffmpeg_command(command: list[str], device: GpuDevice = GpuDevice.CPU) -> list[str]:
   if device == GpuDevice.CPU:
     return command
@@ -155,7 +417,10 @@ def add_hwaccel_to_ffmpeg_command(command: list[str], device: GpuDevice = GpuDev
     hwaccel, codec = FFMPEG_ENCODER_STRINGS[device]
     command.insert(1, "-hwaccel")
     command.insert(2, hwaccel)
-    command.insert(len(command) - 1, "-c:v")
-    command.insert(len(command) - 1, codec)
+    if "-c:v" in command:
+      command[command.index("-c:v") + 1] = codec
+    else:
+      command.insert(len(command) - 1, "-c:v")
+      command.insert(len(command) - 1, codec)
   
   return command